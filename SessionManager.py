@@ -1,63 +1,3592 @@
-from functools import wraps
-from typing import Union
-from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.exc import InvalidRequestError, IntegrityError
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from enum import Enum
+from functools import partial, wraps
+from typing import Callable, Union
+from sqlalchemy import Column, MetaData, String, Table, create_engine, delete, event, func, insert, inspect, literal_column, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.sql import compiler, visitors
+from sqlalchemy.orm import Session, make_transient_to_detached, sessionmaker
+from sqlalchemy.orm.interfaces import LoaderOption
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import DBAPIError, InvalidRequestError, IntegrityError
 from sqlalchemy.orm.session import _SessionBind
+from sqlalchemy.engine import Connection, Engine, MappingResult, Result, Row, RowMapping, ScalarResult
+from sqlalchemy.engine.default import DefaultDialect
+import asyncio
+import inspect as pyinspect
+import itertools
+import multiprocessing
+import bisect
+import dataclasses
+import datetime
+import decimal
+import hashlib
+import heapq
 import logging
+import os
+import pickle
+import random
+import re
+import threading
 import time
-from contextlib import contextmanager
+import uuid
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 
+try:
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+except ImportError:
+    # the asyncio extension requires greenlet, see sqlalchemy[asyncio], only AsyncSessionManager needs it
+    class AsyncEngine:
+        pass
+    AsyncSession = async_sessionmaker = create_async_engine = None
 
 
+class Propagation(Enum):
+    """
+    How a managed session behaves when another managed session of the same SessionManager is already open in the current context.
+    
+    REQUIRED: join the ambient session, the outermost managed session commits, rolls back and closes it.
+        A joined block without raise_on_error runs in a savepoint: when it fails its changes alone are rolled back
+        and its error is handled by its own raise_error_types, as if it had its own session. With raise_on_error its errors reach the outer block.
+    REQUIRES_NEW: always open a new session, committed and closed independently.
+    NESTED: open a savepoint on the ambient session, rolled back alone if the block fails.
+    
+    Without an ambient session every mode opens a new session.
+    A block with auto_commit never joins an ambient session opened without it, which would not commit its writes:
+    it logs a warning and opens a new session instead.
+    """
+    REQUIRED = "required"
+    REQUIRES_NEW = "requires_new"
+    NESTED = "nested"
+
+
+# SQLSTATE codes of serialization failures and deadlocks, and MySQL deadlock / lock wait timeout error numbers
+_transient_error_codes: frozenset = frozenset(("40001", "40P01", 1213, 1205))
+_transient_error_messages: tuple[str, ...] = ("database is locked", "deadlock", "could not serialize", "serialization failure", "lock wait timeout")
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """
+    Default error classifier of RetryPolicy: True for lock contention, deadlocks, serialization failures and invalidated connections.
+    """
+    
+    if not isinstance(e, DBAPIError):
+        return False
+    if e.connection_invalidated:
+        return True
+    
+    orig = e.orig
+    code = getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None) or (orig.args[0] if orig is not None and orig.args else None)
+    if code in _transient_error_codes:
+        return True
+    
+    message = str(orig).lower()
+    return any(transient_message in message for transient_message in _transient_error_messages)
+
+
+class RetryPolicy:
+    """
+    Retry policy of a decorated function: the whole unit of work is run again in a fresh session when it fails with a transient error.
+    
+    The delay before the n-th retry is base_delay * 2 ** (n - 1), capped to max_delay, with full jitter.
+    
+    args:
+        max_attempts (int): Maximum number of attempts, the first one included. Defaults to 3.
+        base_delay (float): Delay before the first retry, in seconds. Defaults to 0.05.
+        max_delay (float): Maximum delay between two attempts, in seconds. Defaults to 2.0.
+        deadline (float): Maximum time spent on all the attempts, in seconds. No retry is scheduled past the deadline. Defaults to None.
+        jitter (bool): If True, the delay is drawn uniformly between 0 and the computed delay. Defaults to True.
+        classifier (Callable[[BaseException], bool]): Tells whether an error is transient and worth a retry. Defaults to is_transient_error.
+    
+    The policy counts the calls, attempts, retries and exhausted calls of all the functions using it, see stats().
+    """
+    
+    def __init__(self, max_attempts: int=3, base_delay: float=0.05, max_delay: float=2.0, deadline: Union[float, None]=None, jitter: bool=True, classifier: Callable[[BaseException], bool]=is_transient_error):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1.")
+        
+        self.max_attempts: int = max_attempts
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.deadline: Union[float, None] = deadline
+        self.jitter: bool = jitter
+        self.classifier: Callable[[BaseException], bool] = classifier
+        
+        self._stats: dict[str, int] = {"calls": 0, "attempts": 0, "retries": 0, "exhausted": 0}
+        self._lock = threading.Lock()
+    
+    def next_delay(self, attempt: int, started: float) -> Union[float, None]:
+        """
+        returns:
+            Union[float, None]: The delay before the attempt following the failed one, None if no attempt is left.
+        """
+        
+        if attempt >= self.max_attempts:
+            return None
+        
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        
+        if self.deadline is not None and time.monotonic() - started + delay > self.deadline:
+            return None
+        return delay
+    
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+    
+    def _count(self, **counts: int):
+        with self._lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+
+class LoaderProfile:
+    """
+    Loader options added to the ORM selects run in the managed sessions using the profile, see SessionManager.register_loader_profile.
+    
+    args:
+        *options: Loader options, such as selectinload(User.posts), joinedload(Post.author), load_only(User.username) or raiseload(User.logs).
+            An option is added to the selects of the entity it starts from, a wildcard such as raiseload("*") to every select of entities.
+        raise_on_lazy_load (bool): If True, a lazy load in the session raises an InvalidRequestError instead of emitting its query,
+            so that a relationship missing from the options fails the tests instead of running one query per object. Defaults to False.
+    
+    A select given loader options of its own is left as it is, SQLAlchemy rejects two strategies for the same relationship.
+    
+    For example:
+    
+    USER_PAGE = LoaderProfile(selectinload(User.posts).joinedload(Post.author), load_only(User.username), raise_on_lazy_load=True)
+    """
+    
+    def __init__(self, *options, raise_on_lazy_load: bool=False):
+        for option in options:
+            if not isinstance(option, LoaderOption):
+                raise ValueError(f"{option!r} is not a loader option.")
+        
+        self.options: tuple = options
+        self.raise_on_lazy_load: bool = raise_on_lazy_load
+        # the entity each option starts from, None for a wildcard
+        self._roots: tuple = tuple(self._option_root(option) for option in options)
+    
+    def __repr__(self) -> str:
+        return f"LoaderProfile({', '.join(repr(option) for option in self.options)}, raise_on_lazy_load={self.raise_on_lazy_load!r})"
+    
+    @staticmethod
+    def _option_root(option):
+        path = getattr(option, "path", ())
+        root = path[0] if len(path) else None
+        # the path of a wildcard starts with a token instead of a mapper
+        return root if hasattr(root, "mapper") else None
+    
+    def apply(self, statement):
+        """
+        returns:
+            The select with the options starting from one of its entities, or the select itself if it has loader options of its own.
+        """
+        
+        if any(isinstance(option, LoaderOption) for option in statement._with_options):
+            return statement
+        
+        entities: list = [inspect(description["entity"]) for description in getattr(statement, "column_descriptions", ())
+                          if description["entity"] is not None and description["expr"] is description["entity"]]
+        if not entities:
+            return statement
+        
+        options: list = [option for option, root in zip(self.options, self._roots) if root is None or any(root is entity for entity in entities)]
+        return statement.options(*options) if options else statement
+
+
+class SessionPolicy:
+    """
+    Immutable settings of the managed sessions, resolved once and reused by every session_manager or session_management it is passed to.
+    
+    The args are the ones of session_management and are resolved the same way: reload_after_commit defaults to auto_commit,
+    read_only to not auto_commit, and verbose is turned into a logging level. The logging is configured once, when the policy is built.
+    A policy given to session_manager or session_management replaces all their other args.
+    
+    For example:
+    
+    WRITE = SessionPolicy(auto_commit=True, raise_on_error=True)
+    
+    @session_manager.session_management(policy=WRITE)
+    def create_user(username, session=None):
+        ...
+    """
+    
+    __slots__ = ("auto_commit", "reload_after_commit", "raise_error_types", "raise_on_error", "verbose", "propagation", "read_only", "retry", "yield_per", "priority", "admission_timeout", "snapshot", "loader_profile", "_explicit_read_only", "_arguments")
+    
+    def __init__(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[Exception, tuple[Exception], None]=None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR, propagation: Propagation=Propagation.REQUIRED, read_only: Union[bool, None]=None, retry: Union[RetryPolicy, None]=None, yield_per: int=1000, priority: int=0, admission_timeout: Union[float, None]=None, snapshot: Union[bool, list[str]]=False, loader_profile: Union[LoaderProfile, str, None]=None):
+        arguments: dict = dict(auto_commit=auto_commit, reload_after_commit=reload_after_commit, raise_error_types=raise_error_types, raise_on_error=raise_on_error, verbose=verbose,
+                               propagation=propagation, read_only=read_only, retry=retry, yield_per=yield_per, priority=priority, admission_timeout=admission_timeout, snapshot=snapshot,
+                               loader_profile=loader_profile)
+        
+        if reload_after_commit is None:
+            reload_after_commit = auto_commit
+        if read_only is None:
+            read_only = not auto_commit
+        if isinstance(verbose, bool):
+            verbose = logging.INFO if verbose else logging.ERROR
+        
+        # only a read_only=True given explicitly sends the sessions to the query only engine of a SQLite profile
+        resolved: dict = dict(arguments, reload_after_commit=reload_after_commit, read_only=read_only, verbose=verbose, _explicit_read_only=arguments["read_only"] is True, _arguments=arguments)
+        for name, value in resolved.items():
+            object.__setattr__(self, name, value)
+        
+        logging.basicConfig(level=verbose)
+    
+    def __setattr__(self, name: str, value):
+        raise AttributeError("SessionPolicy is immutable, use replace() to derive a new policy.")
+    
+    def __delattr__(self, name: str):
+        raise AttributeError("SessionPolicy is immutable, use replace() to derive a new policy.")
+    
+    def __repr__(self) -> str:
+        return "SessionPolicy(" + ", ".join(f"{name}={value!r}" for name, value in self._arguments.items()) + ")"
+    
+    def replace(self, **changes) -> "SessionPolicy":
+        """
+        returns:
+            SessionPolicy: A new policy built from the args of this one updated with changes, the defaults are resolved again.
+        """
+        
+        return SessionPolicy(**dict(self._arguments, **changes))
+
+
+class SQLiteProfile:
+    """
+    PRAGMAs applied to every new connection of a SQLite engine, and the kind of BEGIN emitted by its transactions, see SessionManager.set_engine.
+    
+    args:
+        journal_mode (str): WAL lets the readers run alongside a writer. None keeps the current mode. Defaults to "WAL".
+        synchronous (str): OFF, NORMAL, FULL or EXTRA. NORMAL is safe in WAL mode, a power loss may only lose the last commits. Defaults to "NORMAL".
+        mmap_size (int): Bytes of the database file read through memory mapping. Defaults to 256 MiB.
+        cache_size (int): Page cache size, in pages if positive, in KiB if negative. Defaults to -65536, 64 MiB.
+        busy_timeout (int): Milliseconds a connection waits for a lock before failing with "database is locked". Defaults to 5000.
+        temp_store (str): DEFAULT, FILE or MEMORY. Defaults to "MEMORY".
+        foreign_keys (bool): Enforces the foreign keys if True. None keeps the default of the build. Defaults to None.
+        query_only (bool): Rejects every write if True. Defaults to False.
+        begin (str): DEFERRED, IMMEDIATE or EXCLUSIVE. IMMEDIATE takes the write lock when the transaction begins,
+            so that two transactions never deadlock upgrading their read locks. Defaults to "IMMEDIATE".
+    
+    A None value leaves the PRAGMA as it is.
+    """
+    
+    def __init__(self, journal_mode: Union[str, None]="WAL", synchronous: Union[str, None]="NORMAL", mmap_size: Union[int, None]=256 * 1024 ** 2, cache_size: Union[int, None]=-65536, busy_timeout: Union[int, None]=5000, temp_store: Union[str, None]="MEMORY", foreign_keys: Union[bool, None]=None, query_only: Union[bool, None]=False, begin: str="IMMEDIATE"):
+        if begin.upper() not in ("DEFERRED", "IMMEDIATE", "EXCLUSIVE"):
+            raise ValueError(f"begin must be DEFERRED, IMMEDIATE or EXCLUSIVE, not {begin!r}.")
+        
+        self.journal_mode: Union[str, None] = journal_mode
+        self.synchronous: Union[str, None] = synchronous
+        self.mmap_size: Union[int, None] = mmap_size
+        self.cache_size: Union[int, None] = cache_size
+        self.busy_timeout: Union[int, None] = busy_timeout
+        self.temp_store: Union[str, None] = temp_store
+        self.foreign_keys: Union[bool, None] = foreign_keys
+        self.query_only: Union[bool, None] = query_only
+        self.begin: str = begin.upper()
+    
+    def __repr__(self) -> str:
+        return "SQLiteProfile(" + ", ".join(f"{name}={value!r}" for name, value in vars(self).items()) + ")"
+    
+    def statements(self) -> list[str]:
+        """
+        returns:
+            list[str]: The PRAGMA statements of the profile, journal_mode first and query_only last.
+        """
+        
+        pragmas: list[tuple[str, object]] = [
+            ("journal_mode", self.journal_mode), ("synchronous", self.synchronous), ("mmap_size", self.mmap_size), ("cache_size", self.cache_size),
+            ("busy_timeout", self.busy_timeout), ("temp_store", self.temp_store), ("foreign_keys", self.foreign_keys), ("query_only", self.query_only),
+        ]
+        return [f"PRAGMA {name} = {int(value) if isinstance(value, bool) else value}" for name, value in pragmas if value is not None]
+
+
+# profiles accepted by name by SessionManager.set_engine
+sqlite_profiles: dict[str, SQLiteProfile] = {
+    # durable commits, fsync on every commit
+    "safe": SQLiteProfile(synchronous="FULL", mmap_size=None, cache_size=None, temp_store=None),
+    "balanced": SQLiteProfile(),
+    # no fsync at all, a power loss may corrupt the database, for data that can be rebuilt
+    "fast": SQLiteProfile(synchronous="OFF", mmap_size=1024 ** 3, cache_size=-262144),
+    "read_only": SQLiteProfile(journal_mode=None, synchronous=None, query_only=True, begin="DEFERRED"),
+}
+
+# engines configured by apply_sqlite_profile, with their profile
+_sqlite_profiled_engines: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+_sqlite_pragma_names: dict[str, dict[int, str]] = {
+    "journal_mode": {}, "synchronous": {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}, "mmap_size": {}, "cache_size": {},
+    "busy_timeout": {}, "temp_store": {0: "DEFAULT", 1: "FILE", 2: "MEMORY"}, "foreign_keys": {}, "query_only": {},
+}
+
+
+def apply_sqlite_profile(engine, profile: Union[SQLiteProfile, str]) -> SQLiteProfile:
+    """
+    Applies the profile to every connection opened by the engine from now on, and emits BEGIN as set by the profile.
+    A connection with the session_manager_sqlite_begin execution option emits that mode instead:
+    SessionManager begins its read-only sessions DEFERRED, so that they do not queue behind the writers.
+    
+    The automatic BEGIN of the pysqlite driver is disabled, SQLAlchemy then emits it, which also makes the savepoints work.
+    The engine may be synchronous or asynchronous.
+    
+    returns:
+        SQLiteProfile: The profile applied.
+    """
+    
+    if isinstance(profile, str):
+        try:
+            profile = sqlite_profiles[profile]
+        except KeyError:
+            raise ValueError(f"no SQLite profile named {profile!r}, use one of {', '.join(sqlite_profiles)}.") from None
+    
+    engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+    if engine.dialect.name != "sqlite":
+        raise ValueError(f"SQLite profiles cannot be applied to a {engine.dialect.name} engine.")
+    
+    statements: list[str] = profile.statements()
+    
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    
+    def on_begin(connection):
+        connection.exec_driver_sql(f"BEGIN {connection.get_execution_options().get('session_manager_sqlite_begin', profile.begin)}")
+    
+    previous = _sqlite_profiled_engines.get(engine)
+    if previous is not None:
+        event.remove(engine, "connect", previous[1])
+        event.remove(engine, "begin", previous[2])
+    event.listen(engine, "connect", on_connect)
+    event.listen(engine, "begin", on_begin)
+    _sqlite_profiled_engines[engine] = (profile, on_connect, on_begin)
+    
+    # the connections already pooled were opened without the profile, an in-memory database would not survive their disposal
+    if not _is_sqlite_memory(engine):
+        engine.dispose(close=False)
+    return profile
+
+
+def _read_sqlite_pragmas(dbapi_connection) -> dict:
+    pragmas: dict = {}
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, names in _sqlite_pragma_names.items():
+            cursor.execute(f"PRAGMA {name}")
+            row = cursor.fetchone()
+            value = row[0] if row else None
+            pragmas[name] = names.get(value, value)
+    finally:
+        cursor.close()
+    return pragmas
+
+
+def _begin_sqlite_transaction(session: Session):
+    # the SQLite drivers begin only before a DML statement, the RELEASE of a SAVEPOINT emitted outside of a transaction commits it
+    connection = session.connection()
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN")
+
+
+def _is_sqlite_memory(engine) -> bool:
+    url = engine.url
+    return url.database in (None, "", ":memory:") or url.query.get("mode") == "memory"
+
+
+# fingerprint of the metadata each SessionManager.ensure_schema call last created the tables of
+_schema_fingerprints: Table = Table(
+    "session_manager_schema", MetaData(),
+    Column("name", String(255), primary_key=True),
+    Column("fingerprint", String(64), nullable=False),
+)
+
+
+def _metadata_fingerprint(metadata: MetaData, dialect) -> str:
+    # the DDL the dialect would emit for the tables and their indexes, in a stable order
+    digest = hashlib.sha256()
+    for table in sorted(metadata.tables.values(), key=lambda table: table.fullname):
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+
+def _ensure_schema(connection, metadata: MetaData, name: str) -> bool:
+    fingerprint: str = _metadata_fingerprint(metadata, connection.dialect)
+    
+    if inspect(connection).has_table(_schema_fingerprints.name):
+        stored = connection.execute(select(_schema_fingerprints.c.fingerprint).where(_schema_fingerprints.c.name == name)).scalar()
+        if stored == fingerprint:
+            return False
+    else:
+        _schema_fingerprints.create(connection)
+    
+    metadata.create_all(connection)
+    connection.execute(delete(_schema_fingerprints).where(_schema_fingerprints.c.name == name))
+    connection.execute(insert(_schema_fingerprints).values(name=name, fingerprint=fingerprint))
+    return True
+
+
+def _compile_statements(engine, statements: list[tuple]) -> Union[int, None]:
+    """
+    Compiles the statements into the statement cache of the engine without executing them.
+    
+    It relies on internals of SQLAlchemy 2.0 and 2.1, see requirements.txt.
+    
+    returns:
+        Union[int, None]: The number of statements compiled, None if the internals are not the expected ones.
+    """
+    
+    engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+    try:
+        compiled_cache = engine.get_execution_options().get("compiled_cache", engine._compiled_cache)
+        if compiled_cache is None:
+            # query_cache_size=0, nothing to fill
+            return 0
+        
+        schema_translate_map = engine.get_execution_options().get("schema_translate_map")
+        for statement, parameter_names in statements:
+            # the arguments Connection.execute() looks the statement up with, so that its executions hit the entry
+            statement._compile_w_cache(
+                dialect=engine.dialect, compiled_cache=compiled_cache, column_keys=sorted(parameter_names), for_executemany=False,
+                schema_translate_map=schema_translate_map, linting=engine.dialect.compiler_linting | compiler.WARN_LINTING,
+            )
+    except (AttributeError, TypeError) as e:
+        logging.warning("compiling the hot statements failed, they are executed instead: %r", e)
+        return None
+    return len(statements)
+
+
+def _execute_statements(connection: Connection, statements: list[tuple]) -> int:
+    """
+    Executes the statements in a transaction rolled back, the executions fill the statement cache of the engine.
+    The fallback of _compile_statements, through the public API: the statements run once, their parameters set to None.
+    """
+    
+    # a SQLite profile begins the transaction without taking the write lock, see apply_sqlite_profile
+    connection = connection.execution_options(session_manager_sqlite_begin="DEFERRED")
+    transaction = connection.begin()
+    try:
+        for statement, parameter_names in statements:
+            connection.execute(statement, dict.fromkeys(parameter_names) or None).close()
+    finally:
+        transaction.rollback()
+    return len(statements)
+
+
+def _warm_statements(engine, statements: list[tuple]) -> int:
+    compiled: Union[int, None] = _compile_statements(engine, statements)
+    if compiled is not None:
+        return compiled
+    if isinstance(engine, AsyncEngine):
+        # executed by the warm-up on the event loop only
+        return 0
+    with engine.connect() as connection:
+        return _execute_statements(connection, statements)
+
+
+class ReplicaRouter:
+    """
+    Chooses the engine of the managed sessions: the primary for the read-write sessions, one of the replicas for the read-only ones.
+    
+    args:
+        primary: The engine of the read-write sessions, used for the read-only ones too when no replica is available.
+        replicas (list): The engines of the read-only sessions.
+        selection (str): "round_robin" to use the replicas in turn, "least_outstanding" to use the replica with the fewest open sessions. Defaults to "round_robin".
+        failure_cooldown (float): Seconds a replica is skipped after a connection failure. Defaults to 30.0.
+    """
+    
+    selections: tuple[str, ...] = ("round_robin", "least_outstanding")
+    
+    def __init__(self, primary, replicas: list, selection: str="round_robin", failure_cooldown: float=30.0):
+        if selection not in self.selections:
+            raise ValueError(f"selection must be one of {self.selections}.")
+        
+        self.primary = primary
+        self.replicas: list = list(replicas)
+        self.selection: str = selection
+        self.failure_cooldown: float = failure_cooldown
+        
+        # engine -> {"sessions", "outstanding", "failures", "fallbacks", "failed_until"}
+        self._stats: dict = {engine: {"sessions": 0, "outstanding": 0, "failures": 0, "fallbacks": 0, "failed_until": 0.0} for engine in [primary] + self.replicas}
+        self._next_replica: int = 0
+        self._lock = threading.Lock()
+        
+        self._listeners: dict = {}
+        for replica in self.replicas:
+            listener = self._failure_listener(replica)
+            self._listeners[replica] = listener
+            event.listen(self._event_target(replica), "handle_error", listener)
+    
+    def acquire(self, read_only: bool):
+        """
+        returns:
+            The engine to bind the new session to, counted as outstanding until released.
+        """
+        
+        with self._lock:
+            engine = self._select_replica() if read_only and self.replicas else self.primary
+            if engine is None:
+                engine = self.primary
+                self._stats[engine]["fallbacks"] += 1
+            
+            self._stats[engine]["sessions"] += 1
+            self._stats[engine]["outstanding"] += 1
+            return engine
+    
+    def release(self, engine):
+        with self._lock:
+            stats = self._stats.get(engine)
+            if stats is not None and stats["outstanding"] > 0:
+                stats["outstanding"] -= 1
+    
+    def fall_back(self, replica):
+        """
+        Releases a replica the session failed to connect to.
+        
+        returns:
+            The primary, counted as outstanding until released.
+        """
+        
+        with self._lock:
+            stats = self._stats[replica]
+            if stats["outstanding"] > 0:
+                stats["outstanding"] -= 1
+            self._stats[self.primary]["sessions"] += 1
+            self._stats[self.primary]["outstanding"] += 1
+            self._stats[self.primary]["fallbacks"] += 1
+            return self.primary
+    
+    def mark_failed(self, engine):
+        logging.warning("replica %s failed, skipping it for %d s...", engine.url, self.failure_cooldown)
+        with self._lock:
+            self._stats[engine]["failures"] += 1
+            self._stats[engine]["failed_until"] = time.monotonic() + self.failure_cooldown
+    
+    def stats(self) -> dict:
+        """
+        returns:
+            dict: {url: {"role", "healthy", "sessions", "outstanding", "failures", "fallbacks"}}, the fallbacks are counted on the primary.
+        """
+        
+        now = time.monotonic()
+        with self._lock:
+            return {
+                engine.url.render_as_string(hide_password=True): {
+                    "role": "primary" if engine is self.primary else "replica",
+                    "healthy": stats["failed_until"] <= now,
+                    "sessions": stats["sessions"],
+                    "outstanding": stats["outstanding"],
+                    "failures": stats["failures"],
+                    "fallbacks": stats["fallbacks"],
+                }
+                for engine, stats in self._stats.items()
+            }
+    
+    def close(self):
+        for replica, listener in self._listeners.items():
+            event.remove(self._event_target(replica), "handle_error", listener)
+        self._listeners.clear()
+    
+    def _select_replica(self):
+        now = time.monotonic()
+        healthy = [replica for replica in self.replicas if self._stats[replica]["failed_until"] <= now]
+        if not healthy:
+            return None
+        
+        if self.selection == "least_outstanding":
+            return min(healthy, key=lambda replica: self._stats[replica]["outstanding"])
+        
+        self._next_replica = (self._next_replica + 1) % len(healthy)
+        return healthy[self._next_replica]
+    
+    def _failure_listener(self, replica):
+        def on_error(context):
+            # connection refused, or an established connection lost
+            if context.connection is None or context.is_disconnect:
+                self.mark_failed(replica)
+        return on_error
+    
+    @staticmethod
+    def _event_target(engine):
+        return engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+
+
+class WriteBuffer:
+    """
+    Write-behind buffer of a SessionManager: collects ORM objects and mappings from any thread and inserts them in batches,
+    one transaction per batch, from a background flusher thread.
+    
+    A batch is written when max_batch_size items are pending or max_delay seconds after its first item was added.
+    Every add returns a Future resolved when the batch of the item is committed, or failed with the error of that batch only.
+    
+    args:
+        manager (SessionManager): The manager opening the sessions of the batches.
+        max_batch_size (int): Number of pending items triggering a flush. Defaults to 500.
+        max_delay (float): Maximum time an item waits before being flushed, in seconds. Defaults to 0.05.
+        max_pending (int): If set, add blocks while this number of items is pending. Defaults to None.
+    
+    close() flushes the pending items and stops the flusher, the buffer can also be used as a context manager.
+    """
+    
+    def __init__(self, manager: "SessionManager", max_batch_size: int=500, max_delay: float=0.05, max_pending: Union[int, None]=None):
+        self.manager: SessionManager = manager
+        self.max_batch_size: int = max_batch_size
+        self.max_delay: float = max_delay
+        self.max_pending: Union[int, None] = max_pending
+        
+        # (ORM object or (mapper, mapping), future) in insertion order
+        self._pending: list[tuple] = []
+        self._first_pending_time: float = 0.0
+        self._flushing: int = 0
+        self._closed: bool = False
+        self._condition = threading.Condition()
+        self._thread: Union[threading.Thread, None] = None
+        self._stats: dict[str, int] = {"items": 0, "batches": 0, "failed_batches": 0, "failed_items": 0}
+    
+    def add(self, obj, mapping: Union[dict, None]=None) -> Future:
+        """
+        Queues an ORM object, or a mapping of column values when obj is a mapped class.
+        
+        returns:
+            Future: Resolved with None when the item is committed.
+        """
+        
+        item = (inspect(obj), mapping) if mapping is not None else obj
+        future: Future = Future()
+        
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("the write buffer is closed.")
+            while self.max_pending is not None and len(self._pending) >= self.max_pending:
+                self._condition.wait()
+            
+            if not self._pending:
+                self._first_pending_time = time.monotonic()
+            self._pending.append((item, future))
+            
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="WriteBuffer", daemon=True)
+                self._thread.start()
+            # wake the flusher to start the delay of a new batch, or to write a full one
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch_size:
+                self._condition.notify_all()
+        
+        return future
+    
+    def flush(self, timeout: Union[float, None]=None):
+        """
+        Writes the pending items now and waits until they are committed or failed.
+        """
+        
+        with self._condition:
+            futures = [future for _, future in self._pending]
+            self._first_pending_time = float("-inf")
+            self._condition.notify_all()
+        
+        for future in futures:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+    
+    def close(self, timeout: Union[float, None]=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+        
+        if thread is not None:
+            thread.join(timeout)
+    
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return dict(self._stats, pending=len(self._pending))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._batch_ready():
+                    if self._closed and not self._pending:
+                        return
+                    timeout = None if not self._pending else max(0.0, self._first_pending_time + self.max_delay - time.monotonic())
+                    self._condition.wait(timeout)
+                
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                if self._pending:
+                    self._first_pending_time = time.monotonic()
+                self._condition.notify_all()
+            
+            self._write_batch(batch)
+    
+    def _batch_ready(self) -> bool:
+        if not self._pending:
+            return False
+        return self._closed or len(self._pending) >= self.max_batch_size or time.monotonic() >= self._first_pending_time + self.max_delay
+    
+    def _write_batch(self, batch: list[tuple]):
+        objects: list = []
+        mappings_by_mapper: dict = {}
+        for item, _ in batch:
+            if isinstance(item, tuple):
+                mapper, mapping = item
+                mappings_by_mapper.setdefault(mapper, []).append(mapping)
+            else:
+                objects.append(item)
+        
+        try:
+            with self.manager._session_scope(False, False, None, True, logging.ERROR, Propagation.REQUIRES_NEW, label="WriteBuffer") as session:
+                for mapper, mappings in mappings_by_mapper.items():
+                    session.execute(insert(mapper), mappings)
+                session.add_all(objects)
+                session.commit()
+        
+        except Exception as e:
+            logging.error("write buffer batch of %d items failed: %s", len(batch), e)
+            with self._condition:
+                self._stats["failed_batches"] += 1
+                self._stats["failed_items"] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        with self._condition:
+            self._stats["batches"] += 1
+            self._stats["items"] += len(batch)
+        for _, future in batch:
+            future.set_result(None)
+
+
+class GroupCommitter:
+    """
+    Group commit of the read-write managed sessions of a SessionManager, see SessionManager.enable_group_commit.
+    
+    The sessions run one at a time on a single writer connection, each one inside a savepoint of a shared transaction,
+    which is committed by a background thread every interval seconds: the concurrent sessions of a tick share one commit.
+    A session failing rolls back its savepoint only, a failing commit fails all the sessions of its tick.
+    A session opened by a thread already holding the writer connection, nested in another session, gets its own savepoint
+    inside the savepoint of the outer session: it does not wait for the tick, the outer session waits for it in its place,
+    and its changes are rolled back with the outer session if that one fails.
+    The work that must wait for the rows to be committed, such as the invalidation of the caches, is deferred with after_commit.
+    
+    args:
+        engine: The engine the writer connection is checked out from.
+        interval (float): Seconds between two commits. Defaults to 0.005.
+    """
+    
+    def __init__(self, engine, interval: float=0.005):
+        self.engine = engine
+        self.interval: float = interval
+        self.connection = engine.connect()
+        
+        # a profiled engine emits BEGIN IMMEDIATE itself, see apply_sqlite_profile
+        self._pysqlite: bool = engine.dialect.name == "sqlite" and engine.dialect.driver == "pysqlite" and engine not in _sqlite_profiled_engines
+        if self._pysqlite:
+            # pysqlite emits its own BEGIN and breaks savepoints, the committer emits BEGIN IMMEDIATE instead
+            self.connection.connection.driver_connection.isolation_level = None
+        
+        self._lock = threading.RLock()
+        # number of sessions holding the writer connection, more than one for the sessions nested in the same thread
+        self._depth: int = 0
+        # a nested session waiting for the tick, the outermost session of its thread waits in its place
+        self._nested_wait: bool = False
+        self._transaction = None
+        self._waiting: list[Future] = []
+        # called once the shared transaction is committed, dropped if it fails
+        self._callbacks: list[Callable[[], None]] = []
+        self._stats: dict[str, int] = {"transactions": 0, "sessions": 0, "failed_transactions": 0}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="GroupCommitter", daemon=True)
+        self._thread.start()
+    
+    def acquire(self):
+        """
+        Takes the writer connection for a session, beginning the shared transaction if needed.
+        """
+        
+        self._lock.acquire()
+        self._depth += 1
+        if self._transaction is None:
+            try:
+                self._transaction = self.connection.begin()
+                if self._pysqlite:
+                    self.connection.exec_driver_sql("BEGIN IMMEDIATE")
+            except BaseException:
+                self._transaction = None
+                self._depth -= 1
+                self._lock.release()
+                raise
+    
+    def release(self, wait: bool) -> Union[Future, None]:
+        """
+        Gives the writer connection back.
+        
+        returns:
+            Union[Future, None]: If wait is True, a future resolved when the shared transaction is committed.
+            None for a nested session: the tick cannot be committed while its thread holds the writer connection.
+        """
+        
+        future: Union[Future, None] = None
+        self._depth -= 1
+        if self._depth > 0:
+            self._nested_wait = self._nested_wait or wait
+        elif wait or self._nested_wait:
+            self._nested_wait = False
+            future = Future()
+            self._waiting.append(future)
+        self._lock.release()
+        return future
+    
+    def after_commit(self, callback: Callable[[], None]):
+        """
+        Calls the callback once the shared transaction of the current tick is committed, it is dropped if the commit fails.
+        To be called by a session holding the writer connection, for example from its after_commit event.
+        """
+        
+        with self._lock:
+            self._callbacks.append(callback)
+    
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+    
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self._commit()
+        
+        if self._pysqlite:
+            # the connection is not usable by the pool anymore
+            self.connection.invalidate()
+        self.connection.close()
+    
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self._commit()
+    
+    def _commit(self):
+        with self._lock:
+            transaction, self._transaction = self._transaction, None
+            waiting, self._waiting = self._waiting, []
+            callbacks, self._callbacks = self._callbacks, []
+            if transaction is None:
+                return
+            
+            try:
+                transaction.commit()
+            except Exception as e:
+                logging.error("group commit of %d sessions failed: %s", len(waiting), e)
+                try:
+                    transaction.rollback()
+                except Exception:
+                    pass
+                self._stats["failed_transactions"] += 1
+                for future in waiting:
+                    future.set_exception(e)
+                return
+            
+            self._stats["transactions"] += 1
+            self._stats["sessions"] += len(waiting)
+        
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.warning("group commit callback failed:", exc_info=True)
+        for future in waiting:
+            future.set_result(None)
+
+
+class EntityCache:
+    """
+    Second-level cache of entities shared by the sessions of a SessionManager, see SessionManager.enable_entity_cache.
+    
+    The column values of the entities are kept per mapper, keyed by primary key, in a bounded LRU with a time to live.
+    The entries of the rows written by a session are invalidated when the session commits, as are all the entries of a mapper
+    targeted by a bulk UPDATE or DELETE statement. Under group commit they are invalidated when the tick of the session commits,
+    and the sessions on the writer connection, which see the writes of the tick not committed yet, neither read nor fill the cache.
+    
+    args:
+        max_entries (int): Maximum number of entities kept per mapper. Defaults to 10000.
+        ttl (float): Seconds an entry is valid, None for no expiration. Defaults to 300.0.
+        classes (list): The mapped classes to cache, None for all of them. Defaults to None.
+    """
+    
+    def __init__(self, max_entries: int=10000, ttl: Union[float, None]=300.0, classes: Union[list, None]=None):
+        self.max_entries: int = max_entries
+        self.ttl: Union[float, None] = ttl
+        self.mappers: Union[frozenset, None] = frozenset(inspect(cls) for cls in classes) if classes is not None else None
+        
+        # mapper -> OrderedDict(identity -> (values, expires_at)), the most recently used last
+        self._entries: dict = {}
+        self._stats: dict = {}
+        # incremented by every invalidation, a value loaded before an invalidation is not stored
+        self._generation: int = 0
+        self._lock = threading.Lock()
+    
+    def get(self, session: Session, cls, primary_key):
+        """
+        Returns the entity of the given primary key, from the session identity map, from the cache, or from the database.
+        
+        returns:
+            The entity attached to the session, None if it does not exist.
+        """
+        
+        mapper = inspect(cls)
+        identity = tuple(primary_key) if isinstance(primary_key, (tuple, list)) else (primary_key,)
+        
+        instance = session.identity_map.get(mapper.identity_key_from_primary_key(identity))
+        if instance is not None or not self.caches(mapper) or "session_manager_group_commit" in session.info:
+            return instance if instance is not None else session.get(cls, identity)
+        
+        values = self._lookup(mapper, identity)
+        if values is not None:
+            instance = mapper.class_manager.new_instance()
+            for key, value in values.items():
+                set_committed_value(instance, key, value)
+            make_transient_to_detached(instance)
+            return session.merge(instance, load=False)
+        
+        generation = self._generation
+        instance = session.get(cls, identity)
+        if instance is not None:
+            self.put(instance, generation)
+        return instance
+    
+    def put(self, instance, generation: Union[int, None]=None):
+        """
+        Stores the loaded column values of a persistent entity. Skipped if an invalidation happened since generation.
+        """
+        
+        state = inspect(instance)
+        mapper = state.mapper
+        if state.key is None or not self.caches(mapper):
+            return
+        
+        values = {attribute.key: state.dict[attribute.key] for attribute in mapper.column_attrs if attribute.key in state.dict}
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            entries = self._entries.setdefault(mapper, OrderedDict())
+            entries[state.identity] = (values, expires_at)
+            entries.move_to_end(state.identity)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self._count(mapper, "evictions")
+    
+    def invalidate(self, mapper, identities: Union[list, None]=None):
+        """
+        Removes the entries of the given identities of the mapper, all of them if identities is None.
+        """
+        
+        with self._lock:
+            self._generation += 1
+            entries = self._entries.get(mapper)
+            if not entries:
+                return
+            if identities is None:
+                self._count(mapper, "invalidations", len(entries))
+                entries.clear()
+                return
+            for identity in identities:
+                if entries.pop(identity, None) is not None:
+                    self._count(mapper, "invalidations")
+    
+    def caches(self, mapper) -> bool:
+        return self.mappers is None or mapper in self.mappers
+    
+    def stats(self) -> dict:
+        """
+        returns:
+            dict: {class name: {"entries", "hits", "misses", "evictions", "invalidations"}}
+        """
+        
+        with self._lock:
+            return {
+                mapper.class_.__name__: dict(stats, entries=len(self._entries.get(mapper, ())))
+                for mapper, stats in self._stats.items()
+            }
+    
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+    
+    def listen(self, target):
+        """
+        Registers the invalidation listeners on a session maker or a session.
+        """
+        
+        event.listen(target, "after_flush", self._after_flush)
+        event.listen(target, "do_orm_execute", self._after_bulk_statement)
+        event.listen(target, "after_commit", self._after_commit)
+    
+    def remove(self, target):
+        event.remove(target, "after_flush", self._after_flush)
+        event.remove(target, "do_orm_execute", self._after_bulk_statement)
+        event.remove(target, "after_commit", self._after_commit)
+    
+    def _lookup(self, mapper, identity: tuple) -> Union[dict, None]:
+        with self._lock:
+            entries = self._entries.get(mapper)
+            entry = entries.get(identity) if entries else None
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                entries.move_to_end(identity)
+                self._count(mapper, "hits")
+                return entry[0]
+            
+            if entry is not None:
+                del entries[identity]
+                self._count(mapper, "evictions")
+            self._count(mapper, "misses")
+            return None
+    
+    def _count(self, mapper, counter: str, count: int=1):
+        stats = self._stats.get(mapper)
+        if stats is None:
+            stats = self._stats[mapper] = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        stats[counter] += count
+    
+    def _after_flush(self, session: Session, flush_context):
+        # the rows are invalidated at commit, until then the other sessions still read the committed values
+        pending: dict = session.info.setdefault("session_manager_cache_pending", {})
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            state = inspect(obj)
+            if state.key is not None and self.caches(state.mapper):
+                identities = pending.setdefault(state.mapper, set())
+                if identities is not None:
+                    identities.add(state.identity)
+    
+    def _after_bulk_statement(self, orm_execute_state):
+        if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None:
+            mapper = orm_execute_state.bind_mapper
+            if self.caches(mapper):
+                # the rows of a bulk statement are unknown, invalidate the whole mapper
+                orm_execute_state.session.info.setdefault("session_manager_cache_pending", {})[mapper] = None
+    
+    def _after_commit(self, session: Session):
+        pending: Union[dict, None] = session.info.pop("session_manager_cache_pending", None)
+        if not pending:
+            return
+        group_commit: Union[GroupCommitter, None] = session.info.get("session_manager_group_commit")
+        if group_commit is not None:
+            # only the savepoint of the session is released, the rows are committed with its tick
+            group_commit.after_commit(lambda: self._invalidate_pending(pending))
+            return
+        self._invalidate_pending(pending)
+    
+    def _invalidate_pending(self, pending: dict):
+        for mapper, identities in pending.items():
+            self.invalidate(mapper, list(identities) if identities is not None else None)
+
+
+class ResultCacheBackend(ABC):
+    """
+    Storage of a ResultCache: the cached rows by key, and a version per table changed every time a committed session writes to the table.
+    The keys and the table names are opaque strings, qualified by the database they belong to.
+    """
+    
+    @abstractmethod
+    def get(self, key: str) -> Union[tuple, None]:
+        """
+        returns:
+            Union[tuple, None]: The (rows, table versions) stored under the key, None if missing or expired.
+        """
+        
+        raise NotImplementedError
+    
+    @abstractmethod
+    def put(self, key: str, rows: list[tuple], versions: tuple, ttl: Union[float, None]):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def table_versions(self, tables: tuple[str, ...]) -> tuple:
+        raise NotImplementedError
+    
+    @abstractmethod
+    def bump(self, tables: set[str]):
+        raise NotImplementedError
+    
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryResultCacheBackend(ResultCacheBackend):
+    """
+    In-process ResultCacheBackend: a bounded LRU of the results.
+    """
+    
+    def __init__(self, max_entries: int=10000):
+        self.max_entries: int = max_entries
+        # key -> (rows, versions, expires_at), the most recently used last
+        self._entries: OrderedDict = OrderedDict()
+        self._versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Union[tuple, None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+    
+    def put(self, key: str, rows: list[tuple], versions: tuple, ttl: Union[float, None]):
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (rows, versions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def table_versions(self, tables: tuple[str, ...]) -> tuple:
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+    
+    def bump(self, tables: set[str]):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileResultCacheBackend(ResultCacheBackend):
+    """
+    ResultCacheBackend storing the results and the table versions as files of a local directory,
+    shared by all the processes of a host using the same directory.
+    
+    The files are pickled, the directory must only be writable by trusted processes.
+    Files are replaced atomically, the oldest results are pruned when there are more than max_entries of them.
+    """
+    
+    # number of stored results between two prunings
+    prune_interval: int = 100
+    
+    def __init__(self, directory: str, max_entries: int=10000):
+        self.directory: str = directory
+        self.max_entries: int = max_entries
+        os.makedirs(os.path.join(directory, "results"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "tables"), exist_ok=True)
+        self._stores: int = 0
+    
+    def get(self, key: str) -> Union[tuple, None]:
+        try:
+            with open(self._path("results", key), "rb") as file:
+                rows, versions, expires_at = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return rows, versions
+    
+    def put(self, key: str, rows: list[tuple], versions: tuple, ttl: Union[float, None]):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._write(self._path("results", key), pickle.dumps((rows, versions, expires_at)))
+        
+        self._stores += 1
+        if self._stores % self.prune_interval == 0:
+            self._prune()
+    
+    def table_versions(self, tables: tuple[str, ...]) -> tuple:
+        versions = []
+        for table in tables:
+            try:
+                with open(self._path("tables", table), "rb") as file:
+                    versions.append(file.read())
+            except OSError:
+                versions.append(b"")
+        return tuple(versions)
+    
+    def bump(self, tables: set[str]):
+        for table in tables:
+            self._write(self._path("tables", table), uuid.uuid4().bytes)
+    
+    def clear(self):
+        for name in os.listdir(os.path.join(self.directory, "results")):
+            try:
+                os.remove(os.path.join(self.directory, "results", name))
+            except OSError:
+                pass
+    
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.directory, kind, hashlib.sha256(name.encode()).hexdigest())
+    
+    @staticmethod
+    def _write(path: str, data: bytes):
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+    
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(os.path.join(self.directory, "results")):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ResultCache:
+    """
+    Cache of query results shared by the sessions of a SessionManager, see SessionManager.enable_result_cache.
+    
+    A result is keyed by its database, compiled statement and bound parameters and stored as plain row tuples.
+    The database is the URL of the engine without its password, a replica counting as its primary: the table versions are kept per database too.
+    It is valid until its time to live expires or a managed session commits a write to one of the tables the query reads from:
+    the versions of these tables are captured before the query runs and compared at every lookup.
+    Under group commit the versions are changed when the tick of the session commits, and the sessions on the writer connection bypass the cache.
+    
+    args:
+        backend (ResultCacheBackend): Where the results are stored. Defaults to a new MemoryResultCacheBackend.
+        ttl (float): Seconds a result is valid, None for no expiration. Defaults to 60.0.
+    """
+    
+    def __init__(self, backend: Union[ResultCacheBackend, None]=None, ttl: Union[float, None]=60.0):
+        self.backend: ResultCacheBackend = backend if backend is not None else MemoryResultCacheBackend()
+        self.ttl: Union[float, None] = ttl
+        self._stats: dict[str, int] = {"hits": 0, "misses": 0, "stale": 0}
+        self._lock = threading.Lock()
+    
+    def execute(self, session: Session, statement) -> list[tuple]:
+        """
+        Executes a select of columns, returning its rows as tuples, from the cache when possible.
+        """
+        
+        for description in getattr(statement, "column_descriptions", ()):
+            if description["entity"] is not None and description["expr"] is description["entity"]:
+                raise ValueError("only the selects of columns can be cached, not the selects of entities.")
+        
+        if "session_manager_group_commit" in session.info:
+            # the writer connection of a group commit sees the writes of the tick not committed yet
+            return [tuple(row) for row in session.execute(statement)]
+        
+        database: str = self._database(session)
+        compiled = statement.compile(dialect=session.get_bind().dialect)
+        key = f"{database}\x00{compiled}\x00{sorted(compiled.params.items())!r}"
+        tables = tuple(sorted({f"{database}\x00{element.fullname}" for element in visitors.iterate(statement) if isinstance(element, Table)}))
+        versions = self.backend.table_versions(tables)
+        
+        entry = self.backend.get(key)
+        if entry is not None and entry[1] == versions:
+            self._count("hits")
+            return entry[0]
+        self._count("stale" if entry is not None else "misses")
+        
+        rows = [tuple(row) for row in session.execute(statement)]
+        self.backend.put(key, rows, versions, self.ttl)
+        return rows
+    
+    def invalidate(self, tables: set[str], bind):
+        """
+        Invalidates the results reading from the tables of the database of bind, an engine, a connection or a session.
+        """
+        
+        database: str = self._database(bind)
+        self.backend.bump({f"{database}\x00{table}" for table in tables})
+    
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+    
+    def listen(self, target):
+        """
+        Registers the invalidation listeners on a session maker or a session.
+        """
+        
+        event.listen(target, "after_flush", self._after_flush)
+        event.listen(target, "do_orm_execute", self._after_statement)
+        event.listen(target, "after_commit", self._after_commit)
+    
+    def remove(self, target):
+        event.remove(target, "after_flush", self._after_flush)
+        event.remove(target, "do_orm_execute", self._after_statement)
+        event.remove(target, "after_commit", self._after_commit)
+    
+    def _count(self, counter: str):
+        with self._lock:
+            self._stats[counter] += 1
+    
+    @staticmethod
+    def _database(bind) -> str:
+        if isinstance(bind, Session):
+            # a replica serves the tables of its primary, see SessionManager.set_replicas
+            bind = bind.info.get("session_manager_primary") or bind.get_bind()
+        url = bind.url if hasattr(bind, "url") else bind.engine.url
+        return url.render_as_string(hide_password=True)
+    
+    def _after_flush(self, session: Session, flush_context):
+        tables: set = session.info.setdefault("session_manager_written_tables", set())
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            tables.update(table.fullname for table in inspect(obj).mapper.tables)
+    
+    def _after_statement(self, orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = orm_execute_state.statement.table
+            orm_execute_state.session.info.setdefault("session_manager_written_tables", set()).update(
+                element.fullname for element in visitors.iterate(table) if isinstance(element, Table)
+            )
+    
+    def _after_commit(self, session: Session):
+        tables: Union[set, None] = session.info.pop("session_manager_written_tables", None)
+        if not tables:
+            return
+        group_commit: Union[GroupCommitter, None] = session.info.get("session_manager_group_commit")
+        if group_commit is not None:
+            # only the savepoint of the session is released, the rows are committed with its tick
+            group_commit.after_commit(lambda: self.invalidate(tables, group_commit.connection))
+            return
+        self.invalidate(tables, session)
+
+
+class SessionInstrument:
+    """
+    Receives the lifecycle measurements of the sessions opened by a SessionManager, see SessionManager.add_instrument.
+    
+    Phases timed by observe: admission_wait, create, body, flush, commit, reload, rollback and close.
+    Counters incremented by increment: commits, rollbacks, errors_swallowed, errors_raised, retries, retries_exhausted,
+    admission_rejected_queue_full and admission_rejected_timeout.
+    
+    The label is the qualified name of the decorated function, or "session_manager" for the context manager.
+    """
+    
+    def observe(self, phase: str, label: str, seconds: float):
+        pass
+    
+    def increment(self, counter: str, label: str):
+        pass
+
+
+class HistogramCollector(SessionInstrument):
+    """
+    In-process SessionInstrument that aggregates the timings in cumulative histograms and the counters in totals.
+    
+    collect() returns a snapshot of the collected values, render() the same values in the Prometheus text format.
+    """
+    
+    # upper bounds of the histogram buckets, in seconds
+    default_buckets: tuple[float, ...] = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, buckets: tuple[float, ...]=default_buckets):
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        self._histograms: dict = {}
+        self._counters: dict = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, phase: str, label: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get((phase, label))
+            if histogram is None:
+                # one slot per bucket plus the +Inf one, then count and sum
+                histogram = self._histograms[(phase, label)] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+    
+    def increment(self, counter: str, label: str):
+        with self._lock:
+            self._counters[(counter, label)] = self._counters.get((counter, label), 0) + 1
+    
+    def collect(self) -> dict:
+        """
+        returns:
+            dict: {"histograms": {(phase, label): {"buckets": {upper_bound: cumulative_count}, "count": int, "sum": float}}, "counters": {(counter, label): int}}
+        """
+        
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+        
+        snapshot: dict = {"histograms": {}, "counters": counters}
+        for key, values in histograms.items():
+            cumulative = list(itertools.accumulate(values[:-2]))
+            snapshot["histograms"][key] = {
+                "buckets": dict(zip(self.buckets + (float("inf"),), cumulative)),
+                "count": values[-2],
+                "sum": values[-1],
+            }
+        return snapshot
+    
+    def render(self, prefix: str="sqlalchemy_session") -> str:
+        snapshot = self.collect()
+        lines: list[str] = []
+        
+        lines.append(f"# TYPE {prefix}_phase_seconds histogram")
+        for (phase, label), histogram in sorted(snapshot["histograms"].items()):
+            labels = f'phase="{phase}",function="{label}"'
+            for upper_bound, count in histogram["buckets"].items():
+                le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                lines.append(f'{prefix}_phase_seconds_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"{prefix}_phase_seconds_count{{{labels}}} {histogram['count']}")
+            lines.append(f"{prefix}_phase_seconds_sum{{{labels}}} {histogram['sum']}")
+        
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for (counter, label), count in sorted(snapshot["counters"].items()):
+            lines.append(f'{prefix}_events_total{{event="{counter}",function="{label}"}} {count}')
+        
+        return "\n".join(lines) + "\n"
+    
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+class AdmissionRejected(RuntimeError):
+    """
+    Raised by a managed session refused by the admission control of its SessionManager, see SessionManager.set_admission_control.
+    
+    reason is "queue_full" when the wait queue was too deep to take the session, "timeout" when the session waited longer than its timeout.
+    """
+    
+    def __init__(self, message: str, reason: str, label: str):
+        super().__init__(message)
+        self.reason: str = reason
+        self.label: str = label
+
+
+class AdmissionController:
+    """
+    Bounds the number of sessions a SessionManager keeps open at the same time, see SessionManager.set_admission_control.
+    
+    A session over the limit waits in a queue served by priority, highest first, then in arrival order.
+    A session arriving on a full queue, or waiting longer than its timeout, is refused with an AdmissionRejected.
+    
+    args:
+        max_sessions (int): Maximum number of sessions open at the same time.
+        max_queue (int): Maximum number of sessions waiting for a slot, None for no limit. Defaults to None.
+        timeout (float): Default number of seconds a session waits for a slot, None to wait forever. Defaults to None.
+        engine: The engine whose pool checked-out connections are reported by stats. Defaults to None.
+    """
+    
+    # upper bounds of the wait time histogram buckets, in seconds
+    default_buckets: tuple[float, ...] = HistogramCollector.default_buckets
+    
+    def __init__(self, max_sessions: int, max_queue: Union[int, None]=None, timeout: Union[float, None]=None, engine=None, buckets: tuple[float, ...]=default_buckets):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1.")
+        if max_queue is not None and max_queue < 0:
+            raise ValueError("max_queue must not be negative.")
+        
+        self.max_sessions: int = max_sessions
+        self.max_queue: Union[int, None] = max_queue
+        self.timeout: Union[float, None] = timeout
+        self.engine = engine
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        
+        self._condition = threading.Condition(threading.Lock())
+        self._active: int = 0
+        # heap of [-priority, arrival, admitted], an entry is admitted in place and dropped by its waiter
+        self._queue: list[list] = []
+        self._waiting: int = 0
+        self._arrivals = itertools.count()
+        self._wait_histogram: list = [0] * (len(self.buckets) + 1) + [0, 0.0]
+        self._stats: dict[str, int] = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "max_active": 0, "max_waiting": 0}
+    
+    def acquire(self, priority: int=0, timeout: Union[float, None]=None, label: str="session_manager") -> float:
+        """
+        Takes a slot for a session, waiting for one if all of them are taken.
+        
+        args:
+            priority (int): Sessions with a higher priority are admitted first. Defaults to 0.
+            timeout (float): Seconds to wait for a slot, None for the timeout of the controller. Defaults to None.
+            label (str): Name of the session, reported by AdmissionRejected. Defaults to "session_manager".
+        
+        returns:
+            float: The seconds waited for the slot.
+        """
+        
+        if timeout is None:
+            timeout = self.timeout
+        
+        with self._condition:
+            if self._active < self.max_sessions and not self._waiting:
+                self._admit(0.0)
+                return 0.0
+            
+            if self.max_queue is not None and self._waiting >= self.max_queue:
+                self._stats["rejected_queue_full"] += 1
+                raise AdmissionRejected(f"{label}: session refused, {self._waiting} sessions already waiting for one of the {self.max_sessions} slots.", "queue_full", label)
+            
+            entry: list = [-priority, next(self._arrivals), False]
+            heapq.heappush(self._queue, entry)
+            self._waiting += 1
+            self._stats["queued"] += 1
+            self._stats["max_waiting"] = max(self._stats["max_waiting"], self._waiting)
+            
+            started: float = time.monotonic()
+            deadline: Union[float, None] = started + timeout if timeout is not None else None
+            try:
+                while not entry[2]:
+                    remaining: Union[float, None] = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        self._stats["rejected_timeout"] += 1
+                        raise AdmissionRejected(f"{label}: session refused after waiting {timeout} seconds for one of the {self.max_sessions} slots.", "timeout", label)
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+                if not entry[2]:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+            
+            waited: float = time.monotonic() - started
+            self._active -= 1
+            self._admit(waited)
+            return waited
+    
+    def release(self):
+        """
+        Gives a slot back, admitting the first session of the queue.
+        """
+        
+        with self._condition:
+            self._active -= 1
+            if self._queue:
+                # the slot is handed over, the admitted waiter counts itself in again
+                entry = heapq.heappop(self._queue)
+                entry[2] = True
+                self._active += 1
+                self._condition.notify_all()
+    
+    def stats(self) -> dict:
+        """
+        returns:
+            dict: The active and waiting sessions, the admission counters, the histogram of the wait times in the HistogramCollector.collect format
+            and the connections checked out of the pool of the engine, if any.
+        """
+        
+        with self._condition:
+            stats: dict = dict(self._stats)
+            stats["active"] = self._active
+            stats["waiting"] = self._waiting
+            histogram = list(self._wait_histogram)
+        
+        stats["wait_seconds"] = {
+            "buckets": dict(zip(self.buckets + (float("inf"),), itertools.accumulate(histogram[:-2]))),
+            "count": histogram[-2],
+            "sum": histogram[-1],
+        }
+        
+        pool = getattr(self.engine, "pool", None)
+        if pool is not None and hasattr(pool, "checkedout"):
+            stats["pool_checked_out"] = pool.checkedout()
+            stats["pool_size"] = pool.size() if hasattr(pool, "size") else None
+        return stats
+    
+    def _admit(self, waited: float):
+        self._active += 1
+        self._stats["admitted"] += 1
+        self._stats["max_active"] = max(self._stats["max_active"], self._active)
+        self._wait_histogram[bisect.bisect_left(self.buckets, waited)] += 1
+        self._wait_histogram[-2] += 1
+        self._wait_histogram[-1] += waited
+
+
+class StatementProfile:
+    """
+    Statements executed while one managed session is open, collected when statement profiling is enabled, see SessionManager.enable_statement_profiling.
+    
+    The statements are grouped by their normalized text: whitespace is collapsed, literals and expanded IN lists are replaced by a single placeholder.
+    The rows are the ones affected by the statements that return none, such as INSERT, UPDATE and DELETE: the DBAPI cannot count
+    the rows of a SELECT, or of a RETURNING, before they are fetched, and -1 on SQLite, so they are recorded as None.
+    """
+    
+    def __init__(self, label: str):
+        self.label: str = label
+        # normalized statement -> [executions, total seconds, total rows affected]
+        self.statements: dict[str, list] = {}
+        # (statement, seconds, rows affected or None) of the statements slower than the threshold
+        self.slow_statements: list[tuple[str, float, Union[int, None]]] = []
+    
+    def record(self, statement: str, seconds: float, rows: Union[int, None], slow_statement_seconds: Union[float, None]=None):
+        normalized = _normalize_statement(statement)
+        totals = self.statements.get(normalized)
+        if totals is None:
+            totals = self.statements[normalized] = [0, 0.0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        if rows is not None and rows > 0:
+            totals[2] += rows
+        
+        if slow_statement_seconds is not None and seconds >= slow_statement_seconds:
+            self.slow_statements.append((" ".join(statement.split()), seconds, rows))
+    
+    def repeated_statements(self, threshold: int) -> list[tuple[str, int]]:
+        """
+        returns:
+            list[tuple[str, int]]: The normalized statements executed more than threshold times, with their number of executions.
+        """
+        
+        return [(statement, totals[0]) for statement, totals in self.statements.items() if totals[0] > threshold]
+    
+    def summary(self) -> str:
+        executions = sum(totals[0] for totals in self.statements.values())
+        seconds = sum(totals[1] for totals in self.statements.values())
+        return f"{self.label}: {executions} statements ({len(self.statements)} distinct) in {seconds * 1000:.1f} ms, {len(self.slow_statements)} slow"
+
+
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_placeholder_list_pattern = re.compile(r"(\?|%s|%\(\w+\)s|:\w+)(\s*,\s*(\?|%s|%\(\w+\)s|:\w+))+")
+
+
+def _normalize_statement(statement: str) -> str:
+    statement = " ".join(statement.split())
+    statement = _literal_pattern.sub("?", statement)
+    return _placeholder_list_pattern.sub("?", statement)
+
+
+# engines of the SessionManagers of this process, their pools are disposed in the parallel_map workers
+_managed_engines: weakref.WeakSet = weakref.WeakSet()
+
+# SessionManager of a parallel_map worker process, built by _parallel_map_initializer
+_parallel_map_manager: Union["SessionManager", None] = None
+
+
+def _engine_options(engine: Engine) -> dict:
+    # create_engine keeps no record of its arguments, the ones readable from the engine, its pool and its dialect are rebuilt.
+    # The connect_args are not, they are given in the engine_options of parallel_map
+    pool = engine.pool
+    options: dict = {"poolclass": type(pool), "echo": engine.echo, "echo_pool": pool.echo, "pool_recycle": pool._recycle, "pool_pre_ping": pool._pre_ping}
+    if isinstance(pool, QueuePool):
+        options.update(pool_size=pool.size(), max_overflow=pool._max_overflow, pool_timeout=pool._timeout, pool_use_lifo=pool._pool.use_lifo)
+    if getattr(engine.dialect, "_on_connect_isolation_level", None) is not None:
+        options["isolation_level"] = engine.dialect._on_connect_isolation_level
+    if engine.get_execution_options():
+        options["execution_options"] = dict(engine.get_execution_options())
+    return options
+
+
+def _parallel_map_initializer(url, engine_options: dict):
+    global _parallel_map_manager
+    
+    # the connections of the pools inherited through fork belong to the parent, leave them to it
+    for engine in list(_managed_engines):
+        engine.dispose(close=False)
+    
+    _parallel_map_manager = SessionManager()
+    _parallel_map_manager.set_engine(create_engine(url, **engine_options))
+
+
+def _parallel_map_chunk(func: Callable, chunk: list, auto_commit: bool) -> list:
+    with _parallel_map_manager.session_manager(auto_commit=auto_commit, raise_on_error=True, propagation=Propagation.REQUIRES_NEW) as session:
+        return [func(item, session=session) for item in chunk]
+
+
+# maximum number of bound parameters of a statement, by dialect
+_upsert_parameter_limits: dict[str, int] = {"postgresql": 32767}
+
+
+def _upsert_parameter_limit(dialect) -> int:
+    if dialect.name == "sqlite":
+        # SQLITE_MAX_VARIABLE_NUMBER, raised from 999 in SQLite 3.32
+        version: tuple = getattr(dialect.dbapi, "sqlite_version_info", (0,))
+        return 32766 if version >= (3, 32) else 999
+    return _upsert_parameter_limits[dialect.name]
+
+
+class Snapshot:
+    """
+    Immutable record holding the column values of an ORM object or of a row, built by make_snapshot.
+    
+    A subclass with __slots__ is generated for every shape: the name of the mapped class, or Row, and the names of the fields.
+    The values are read as attributes, _fields lists their names and _asdict() returns them as a dict.
+    Snapshots compare by value, can be hashed if their values can, and can be pickled.
+    """
+    
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+    
+    _setters: tuple = ()
+    
+    def __init__(self, *values):
+        for setter, value in zip(self._setters, values):
+            setter(self, value)
+    
+    def __setattr__(self, name: str, value):
+        raise AttributeError(f"{type(self).__name__} snapshot is immutable.")
+    
+    def __delattr__(self, name: str):
+        raise AttributeError(f"{type(self).__name__} snapshot is immutable.")
+    
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+    
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and tuple(self) == tuple(other)
+    
+    def __hash__(self) -> int:
+        return hash((type(self).__name__, tuple(self)))
+    
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self._fields) + ")"
+    
+    def __reduce__(self):
+        return _rebuild_snapshot, (type(self).__name__, self._fields, tuple(self))
+    
+    def _asdict(self) -> dict:
+        return {name: getattr(self, name) for name in self._fields}
+
+
+_snapshot_classes: dict[tuple, type] = {}
+
+
+def _snapshot_class(name: str, fields: tuple[str, ...]) -> type:
+    cls = _snapshot_classes.get((name, fields))
+    if cls is None:
+        cls = type(name, (Snapshot,), {"__slots__": fields, "_fields": fields})
+        # the slot descriptors set the values without going through __setattr__
+        cls._setters = tuple(getattr(cls, field).__set__ for field in fields)
+        cls = _snapshot_classes.setdefault((name, fields), cls)
+    return cls
+
+
+def _rebuild_snapshot(name: str, fields: tuple[str, ...], values: tuple) -> Snapshot:
+    return _snapshot_class(name, fields)(*values)
+
+
+# the attributes of Snapshot, a field cannot shadow them
+_snapshot_reserved: frozenset = frozenset(dir(Snapshot))
+
+# (class name, names of the values) -> snapshot class, the fields of a result shape are computed once
+_snapshot_shapes: dict[tuple, type] = {}
+
+# mapper -> keys of its column attributes
+_snapshot_column_keys: dict = {}
+
+# values stored as they are, without looking for ORM objects or rows in them
+_snapshot_scalar_types: frozenset = frozenset((
+    type(None), bool, int, float, str, bytes, decimal.Decimal, datetime.date, datetime.datetime, datetime.time, datetime.timedelta, uuid.UUID,
+))
+
+
+def _snapshot_fields(names) -> tuple[str, ...]:
+    # the names that cannot be slots are replaced by their position, like namedtuple(rename=True)
+    fields: list[str] = []
+    for index, name in enumerate(names):
+        if not isinstance(name, str) or not name.isidentifier() or name.startswith("_") or name in fields or name in _snapshot_reserved:
+            name = f"_{index}"
+        fields.append(name)
+    return tuple(fields)
+
+
+def _snapshot_shape(name: str, names: tuple) -> type:
+    cls = _snapshot_shapes.get((name, names))
+    if cls is None:
+        cls = _snapshot_shapes[(name, names)] = _snapshot_class(name, _snapshot_fields(names))
+    return cls
+
+
+def make_snapshot(value, columns: Union[list[str], None]=None):
+    """
+    Converts ORM objects and rows into Snapshot records, which stay readable once the session is closed.
+    
+    args:
+        value: An ORM object, a Row, a RowMapping, a Result, a ScalarResult, a MappingResult, or a list, tuple, set or dict of them.
+            The results are fetched into lists, the other values are returned as they are.
+        columns (list[str]): The column attributes kept from the ORM objects, loaded if needed. Defaults to the loaded ones.
+    
+    returns:
+        The value with its ORM objects and rows replaced by snapshots.
+    """
+    
+    if type(value) in _snapshot_scalar_types:
+        return value
+    if isinstance(value, (Result, ScalarResult, MappingResult)):
+        return _snapshot_list(value.all(), columns)
+    if isinstance(value, Row):
+        return _snapshot_shape("Row", value._fields)(*_snapshot_cells(value, columns))
+    if isinstance(value, RowMapping):
+        return _snapshot_shape("Row", tuple(value.keys()))(*_snapshot_cells(value.values(), columns))
+    if isinstance(value, list):
+        return _snapshot_list(value, columns)
+    if isinstance(value, (tuple, set, frozenset)):
+        return type(value)(_snapshot_cells(value, columns))
+    if isinstance(value, dict):
+        return {key: item if type(item) in _snapshot_scalar_types else make_snapshot(item, columns) for key, item in value.items()}
+    
+    state = getattr(value, "_sa_instance_state", None)
+    if state is None or isinstance(value, type):
+        return value
+    
+    mapper = state.mapper
+    keys: Union[tuple, None] = _snapshot_column_keys.get(mapper)
+    if keys is None:
+        keys = _snapshot_column_keys[mapper] = tuple(attribute.key for attribute in mapper.column_attrs)
+    if columns is None:
+        # loaded, the values are read from the state without the attribute instrumentation
+        loaded: dict = state.dict
+        names: tuple[str, ...] = tuple(key for key in keys if key in loaded)
+        return _snapshot_shape(mapper.class_.__name__, names)(*(loaded[name] for name in names))
+    
+    unknown = [name for name in columns if name not in keys]
+    if unknown:
+        raise ValueError(f"{mapper.class_.__name__} has no column attribute {', '.join(unknown)}.")
+    return _snapshot_shape(mapper.class_.__name__, tuple(columns))(*(getattr(value, name) for name in columns))
+
+
+def _snapshot_cells(values, columns: Union[list[str], None]) -> list:
+    return [item if type(item) in _snapshot_scalar_types else make_snapshot(item, columns) for item in values]
+
+
+def _snapshot_list(values: list, columns: Union[list[str], None]) -> list:
+    snapshots: list = []
+    metadata = cls = None
+    for item in values:
+        if type(item) in _snapshot_scalar_types:
+            snapshots.append(item)
+        elif isinstance(item, Row):
+            # the rows of a result share their metadata, the shape is looked up once for all of them
+            if item._parent is not metadata:
+                metadata = item._parent
+                cls = _snapshot_shape("Row", item._fields)
+            if all(type(cell) in _snapshot_scalar_types for cell in item):
+                snapshots.append(cls(*item))
+            else:
+                snapshots.append(cls(*_snapshot_cells(item, columns)))
+        else:
+            snapshots.append(make_snapshot(item, columns))
+    return snapshots
+
+
+class _NewSessionScope:
+    """
+    Context manager of a new managed session on the fast path, see SessionManager._fast_path_enabled.
+    
+    Same lifecycle as SessionManager._session_scope without the generator machinery: the error handler, then the cleanup.
+    """
+    
+    __slots__ = ("manager", "label", "auto_commit", "reload_after_commit", "raise_error_types", "raise_on_error", "verbose", "read_only", "loader_profile", "explicit_read_only", "session", "token")
+    
+    def __init__(self, manager, label: str, auto_commit: bool, reload_after_commit: bool, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, verbose: int, read_only: bool, loader_profile: Union[LoaderProfile, None]=None, explicit_read_only: bool=False):
+        self.manager = manager
+        self.label: str = label
+        self.auto_commit: bool = auto_commit
+        self.reload_after_commit: bool = reload_after_commit
+        self.raise_error_types = raise_error_types
+        self.raise_on_error: bool = raise_on_error
+        self.verbose: int = verbose
+        self.read_only: bool = read_only
+        self.loader_profile: Union[LoaderProfile, None] = loader_profile
+        self.explicit_read_only: bool = explicit_read_only
+    
+    def __enter__(self) -> Session:
+        self.session = self.manager._create_session(self.verbose, self.read_only, explicit_read_only=self.explicit_read_only)
+        if self.loader_profile is not None:
+            self.manager._set_loader_profile(self.session, self.loader_profile)
+        if self.auto_commit and self.reload_after_commit:
+            self.manager._track_reload(self.session)
+        self.session.info["session_manager_auto_commit"] = self.auto_commit
+        self.token = self.manager._ambient_session.set(self.session)
+        return self.session
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        try:
+            if exc_value is not None:
+                self.manager._error_handler(exc_value, self.session, self.raise_error_types, self.raise_on_error, self.verbose, self.label)
+        finally:
+            try:
+                self.manager._cleanup_session(self.session, self.auto_commit, self.reload_after_commit, self.verbose, self.manager.reload_chunk_size, self.label)
+            finally:
+                self.manager._ambient_session.reset(self.token)
+        # the error handler returned, the error is swallowed
+        return exc_value is not None
+
+
+class SessionManager:
+    # maximum number of bound parameters used by a single reload query
+    reload_chunk_size: int = 500
+    
+    def __init__(self, engine: _SessionBind):
+        self.engine = engine
+        self.session_maker = sessionmaker(bind=engine)
+
+    def __init__(self, session_maker: sessionmaker):
+        self.engine = None
+        self.session_maker = session_maker
+
+    def __init__(self):
+        self.engine = None
+        self.session_maker = None
+        # session opened by the innermost managed block of the current context
+        self._ambient_session: ContextVar = ContextVar(f"ambient_session_{id(self)}", default=None)
+        self._instruments: list[SessionInstrument] = []
+        # statement profile of the innermost managed session of the current context
+        self._statement_profile: ContextVar = ContextVar(f"statement_profile_{id(self)}", default=None)
+        self._statement_profiling: Union[dict, None] = None
+        self._router: Union[ReplicaRouter, None] = None
+        self._group_commit: Union[GroupCommitter, None] = None
+        self._entity_cache: Union[EntityCache, None] = None
+        self._result_cache: Union[ResultCache, None] = None
+        self._admission: Union[AdmissionController, None] = None
+        self._sqlite_read_engine = None
+        self._sqlite_deferred_engine = None
+        self._hot_statements: list[tuple] = []
+        self._warm_up = None
+        self._startup: dict = {}
+        self._started_at: float = time.perf_counter()
+        self._awaiting_first_query: bool = False
+        self._loader_profiles: dict[str, LoaderProfile] = {}
+
+    def set_engine(self, engine: _SessionBind, sqlite_profile: Union[SQLiteProfile, str, None]=None, sqlite_read_profile: Union[SQLiteProfile, str, None]=None, warm_connections: int=0):
+        """
+        Binds the managed sessions to the engine.
+        
+        args:
+            engine: The engine.
+            sqlite_profile (Union[SQLiteProfile, str]): Profile, or name of one of sqlite_profiles, applied to every new connection of a SQLite engine,
+                see apply_sqlite_profile. Defaults to None, the connections are left as they are.
+            sqlite_read_profile (Union[SQLiteProfile, str]): With a sqlite_profile, the sessions opened with read_only=True run on a second engine
+                on the same database with this profile, such as "read_only". The in-memory databases keep them on the engine. Defaults to None.
+            warm_connections (int): Connections opened in the background into the pool, along with the compilation of the hot statements,
+                see register_hot_statements. At most the pool_size of a QueuePool, the other pools are not warmed. Defaults to 0.
+        
+        With a sqlite_profile the read-only sessions, read_only=True or auto_commit=False by default, begin DEFERRED instead of the BEGIN of the profile.
+        
+        For example:
+        
+        SM.set_engine(create_engine("sqlite:///users.db"), sqlite_profile="balanced", warm_connections=5)
+        """
+        
+        self.engine = engine
+        self.session_maker = sessionmaker(bind=engine)
+        self._register_session_events()
+        _managed_engines.add(engine)
+        self._set_sqlite_profiles(engine, sqlite_profile, sqlite_read_profile)
+        self._start_up(engine, warm_connections)
+
+    def set_session_maker(self, session_maker: sessionmaker):
+        self.engine = None
+        self.session_maker = session_maker
+        self._register_session_events()
+        if isinstance(self._bound_engine(), Engine):
+            _managed_engines.add(self._bound_engine())
+        self._set_sqlite_profiles(None, None, None)
+        self._start_up(self._bound_engine(), 0)
+    
+    def _set_sqlite_profiles(self, engine, sqlite_profile: Union[SQLiteProfile, str, None], sqlite_read_profile: Union[SQLiteProfile, str, None]):
+        if self._sqlite_read_engine is not None:
+            read_engine, self._sqlite_read_engine = self._sqlite_read_engine, None
+            if isinstance(read_engine, AsyncEngine):
+                # closing the async connections needs the event loop, they are dereferenced instead
+                read_engine.sync_engine.dispose(close=False)
+            else:
+                read_engine.dispose()
+        self._sqlite_deferred_engine = None
+        
+        if sqlite_profile is None:
+            return
+        profile: SQLiteProfile = apply_sqlite_profile(engine, sqlite_profile)
+        if profile.begin.upper() != "DEFERRED":
+            # the same pool, its transactions begin without taking the write lock
+            self._sqlite_deferred_engine = engine.execution_options(session_manager_sqlite_begin="DEFERRED")
+        
+        if sqlite_read_profile is not None and not _is_sqlite_memory(engine):
+            read_engine = create_async_engine(engine.url) if isinstance(engine, AsyncEngine) else create_engine(engine.url)
+            apply_sqlite_profile(read_engine, sqlite_read_profile)
+            self._sqlite_read_engine = read_engine
+    
+    def sqlite_pragmas(self, read_only: bool=False) -> dict:
+        """
+        Reads the PRAGMAs in effect on a connection of the engine, or of the engine of the read-only sessions.
+        
+        returns:
+            dict: The journal_mode, synchronous, mmap_size, cache_size, busy_timeout, temp_store, foreign_keys and query_only values,
+            and the begin mode of the profile if one is applied.
+        """
+        
+        engine = self._sqlite_read_engine if read_only and self._sqlite_read_engine is not None else self._bound_engine()
+        if engine is None or engine.dialect.name != "sqlite":
+            raise ValueError("sqlite_pragmas requires a SQLite engine bound to the session_maker.")
+        
+        connection = engine.raw_connection()
+        try:
+            pragmas: dict = _read_sqlite_pragmas(connection)
+        finally:
+            connection.close()
+        
+        if engine in _sqlite_profiled_engines:
+            pragmas["begin"] = _sqlite_profiled_engines[engine][0].begin
+        return pragmas
+    
+    def register_hot_statements(self, *statements):
+        """
+        Registers statements run often, compiled into the statement cache of the engine before their first execution.
+        
+        They are compiled by the warm-up of set_engine, or right away once an engine is bound. A statement is cached for the names of
+        the parameters it is executed with: pass it as a (statement, parameter names) tuple when it is executed with parameters.
+        The values inlined in a statement are not part of its cache key.
+        On a SQLAlchemy version whose internals do not allow the compilation alone, the statements are executed once instead,
+        with their parameters set to None, in a transaction rolled back: register cheap statements, such as lookups by key.
+        
+        For example:
+        
+        SM.register_hot_statements(
+            select(User).where(User.username == "user"),
+            (select(User).where(User.user_id == bindparam("user_id")), ["user_id"]),
+        )
+        """
+        
+        entries: list[tuple] = [statement if isinstance(statement, tuple) else (statement, ()) for statement in statements]
+        self._hot_statements.extend(entries)
+        for engine in self._warm_engines():
+            self._startup["compiled_statements"] = self._startup.get("compiled_statements", 0) + _warm_statements(engine, entries)
+    
+    def ensure_schema(self, metadata: MetaData, name: str="default") -> bool:
+        """
+        Creates the tables of the metadata, unless the database holds the fingerprint of the same metadata from a previous call.
+        
+        The fingerprint hashes the DDL of the tables and indexes, it is stored in the session_manager_schema table under name.
+        A matching fingerprint costs one query instead of the reflection of every table by create_all. Like create_all,
+        the tables already in the database are not altered.
+        
+        returns:
+            bool: Whether create_all was run.
+        
+        For example:
+        
+        SM.ensure_schema(Base.metadata)
+        """
+        
+        engine = self._bound_engine()
+        if engine is None:
+            raise ValueError("ensure_schema requires an engine bound to the session_maker.")
+        
+        start_time: float = time.perf_counter()
+        with engine.begin() as connection:
+            created: bool = _ensure_schema(connection, metadata, name)
+        self._startup["schema_created"] = created
+        self._startup["schema_seconds"] = time.perf_counter() - start_time
+        return created
+    
+    def startup_stats(self) -> dict:
+        """
+        returns:
+            dict: warm_connections, the connections the warm-up opens, opened_connections, compiled_statements, warm_up_seconds
+            from set_engine to the end of the warm-up and warm_up_error, schema_created and schema_seconds of ensure_schema,
+            and time_to_first_query, the seconds from set_engine to the first statement of a managed session. None until known.
+        """
+        
+        return dict(self._startup)
+    
+    def wait_for_warm_up(self, timeout: Union[float, None]=None) -> bool:
+        """
+        Blocks until the warm-up started by set_engine is over.
+        
+        returns:
+            bool: Whether it is over, False if the timeout expired first.
+        """
+        
+        warm_up = self._warm_up
+        if warm_up is None:
+            return True
+        warm_up.join(timeout)
+        return not warm_up.is_alive()
+    
+    def register_loader_profile(self, name: str, profile: LoaderProfile):
+        """
+        Registers a loader profile under a name, usable as the loader_profile of session_manager and session_management.
+        
+        For example:
+        
+        SM.register_loader_profile("user_page", LoaderProfile(selectinload(User.posts), raise_on_lazy_load=True))
+        
+        @SM.session_management(loader_profile="user_page")
+        def get_user(user_id, session=None):
+            ...
+        """
+        
+        if not isinstance(profile, LoaderProfile):
+            raise ValueError(f"{profile!r} is not a LoaderProfile.")
+        self._loader_profiles[name] = profile
+    
+    def _resolve_loader_profile(self, loader_profile: Union[LoaderProfile, str, None]) -> Union[LoaderProfile, None]:
+        if loader_profile is None or isinstance(loader_profile, LoaderProfile):
+            return loader_profile
+        try:
+            return self._loader_profiles[loader_profile]
+        except KeyError:
+            raise ValueError(f"no loader profile registered as {loader_profile!r}.") from None
+    
+    def _set_loader_profile(self, session: Session, loader_profile: Union[LoaderProfile, None]) -> Union[LoaderProfile, None]:
+        previous: Union[LoaderProfile, None] = session.info.get("session_manager_loader_profile")
+        session.info["session_manager_loader_profile"] = loader_profile
+        return previous
+    
+    @contextmanager
+    def _use_loader_profile(self, session: Session, loader_profile: Union[LoaderProfile, None]):
+        if loader_profile is None:
+            yield
+            return
+        previous: Union[LoaderProfile, None] = self._set_loader_profile(session, loader_profile)
+        try:
+            yield
+        finally:
+            session.info["session_manager_loader_profile"] = previous
+    
+    def _start_up(self, engine, warm_connections: int):
+        self._started_at = time.perf_counter()
+        self._startup = {
+            "warm_connections": 0, "opened_connections": 0, "compiled_statements": 0, "warm_up_seconds": None, "warm_up_error": None,
+            "schema_created": None, "schema_seconds": None, "time_to_first_query": None,
+        }
+        self._awaiting_first_query = True
+        self._warm_up = None
+        if engine is None:
+            return
+        
+        plan: list[tuple] = []
+        for warm_engine in self._warm_engines():
+            pool = (warm_engine.sync_engine if isinstance(warm_engine, AsyncEngine) else warm_engine).pool
+            # the other pools hold a connection per thread, or a single one
+            plan.append((warm_engine, min(warm_connections, pool.size()) if isinstance(pool, QueuePool) else 0))
+        self._startup["warm_connections"] = sum(count for _, count in plan)
+        if self._startup["warm_connections"] or self._hot_statements:
+            self._warm_up = self._start_warm_up(plan, self._startup)
+    
+    def _warm_engines(self) -> list:
+        # the engine of the read-only sessions has its own pool and statement cache
+        engine = self._bound_engine()
+        return [warm_engine for warm_engine in (engine, self._sqlite_read_engine) if warm_engine is not None]
+    
+    def _start_warm_up(self, plan: list[tuple], stats: dict):
+        warm_up = threading.Thread(target=self._run_warm_up, args=(plan, stats, self._started_at), name="session_manager_warm_up", daemon=True)
+        warm_up.start()
+        return warm_up
+    
+    def _run_warm_up(self, plan: list[tuple], stats: dict, started_at: float):
+        # the statistics of a previous engine are kept apart if set_engine is called again meanwhile
+        connections: list = []
+        try:
+            for engine, _ in plan:
+                stats["compiled_statements"] += _warm_statements(engine, list(self._hot_statements))
+            # held together, so that the pool opens a new connection each time
+            for engine, count in plan:
+                for _ in range(count):
+                    connections.append(engine.raw_connection())
+                    stats["opened_connections"] += 1
+        except Exception as e:
+            stats["warm_up_error"] = repr(e)
+            logging.warning("warming up the engine failed: %r", e)
+        finally:
+            for connection in connections:
+                connection.close()
+        stats["warm_up_seconds"] = time.perf_counter() - started_at
+        logging.info("engine warmed up in %.3fs: %d connections, %d statements...", stats["warm_up_seconds"], stats["opened_connections"], stats["compiled_statements"])
+    
+    def _on_first_begin(self, session: Session, transaction, connection):
+        # a listener on the connection of the session only, an engine listener would slow down every statement for good.
+        # A connection the session is bound to, like the one of the group commit, outlives it and would keep the listener
+        if self._awaiting_first_query and not isinstance(session.bind, Connection):
+            event.listen(connection, "after_cursor_execute", self._on_first_query, once=True)
+    
+    def _on_first_query(self, connection, cursor, statement, parameters, context, executemany):
+        if self._awaiting_first_query:
+            self._awaiting_first_query = False
+            self._startup["time_to_first_query"] = time.perf_counter() - self._started_at
+    
+    def set_replicas(self, replicas: list, selection: str="round_robin", failure_cooldown: float=30.0):
+        """
+        Routes the read-only sessions to the replica engines, the read-write ones keep using the engine of set_engine or set_session_maker.
+        
+        A replica failing to connect is skipped for failure_cooldown seconds, the read-only sessions fall back to the primary when no replica is available.
+        A read-only session connects to its replica before it is returned, and is moved to the primary if the connection fails.
+        See ReplicaRouter for the args. An empty list of replicas disables the routing.
+        """
+        
+        primary = self._bound_engine()
+        if primary is None:
+            raise ValueError("replicas require an engine bound to the session_maker.")
+        
+        if self._router is not None:
+            self._router.close()
+        self._router = ReplicaRouter(primary, replicas, selection, failure_cooldown) if replicas else None
+    
+    def routing_stats(self) -> dict:
+        """
+        returns:
+            dict: The usage of the primary and of the replicas, see ReplicaRouter.stats. Empty if no replica is set.
+        """
+        
+        return self._router.stats() if self._router is not None else {}
+    
+    def _bound_engine(self):
+        if self.engine is not None:
+            return self.engine
+        return self.session_maker.kw.get("bind") if self.session_maker else None
+    
+    def enable_group_commit(self, interval: float=0.005):
+        """
+        Funnels the read-write managed sessions through a single writer connection and commits them together, once per interval.
+        
+        Meant for SQLite, where concurrent writers otherwise serialize on the file lock and pay one fsync per commit.
+        A session with auto_commit returns once the shared transaction holding its changes is committed, the failure of that commit
+        is handled as an error of the session. The sessions hold the writer connection for their whole block, keep the blocks short.
+        A read-write session nested in another one of the same thread is committed with the tick of the outer session, without waiting for it.
+        The read-only sessions are not affected. See GroupCommitter.
+        """
+        
+        engine = self._bound_engine()
+        if engine is None:
+            raise ValueError("group commit requires an engine bound to the session_maker.")
+        
+        self.disable_group_commit()
+        self._group_commit = GroupCommitter(engine, interval)
+    
+    def disable_group_commit(self):
+        if self._group_commit is not None:
+            group_commit, self._group_commit = self._group_commit, None
+            group_commit.close()
+    
+    def group_commit_stats(self) -> dict[str, int]:
+        return self._group_commit.stats() if self._group_commit is not None else {}
+    
+    def set_admission_control(self, max_sessions: Union[int, None], max_queue: Union[int, None]=None, timeout: Union[float, None]=None) -> Union[AdmissionController, None]:
+        """
+        Bounds the number of managed sessions open at the same time, the ones over the limit wait for a slot instead of for a pool connection.
+        
+        The waiting sessions are admitted by priority, then in arrival order, see the priority and admission_timeout args of session_manager and session_management.
+        A session is refused with an AdmissionRejected, raised to the caller before the session is opened, when max_queue sessions are already waiting
+        or when it waited longer than its timeout. The sessions joining an ambient session do not take a slot.
+        
+        args:
+            max_sessions (int): Maximum number of sessions open at the same time, None disables the admission control.
+            max_queue (int): Maximum number of sessions waiting for a slot, None for no limit. Defaults to None.
+            timeout (float): Default number of seconds a session waits for a slot, None to wait forever. Defaults to None.
+        
+        returns:
+            Union[AdmissionController, None]: The admission controller, whose stats are also returned by admission_stats.
+        
+        Keep max_sessions at or below pool_size + max_overflow of the engine, so that an admitted session never waits for a connection.
+        """
+        
+        self._admission = AdmissionController(max_sessions, max_queue, timeout, self._bound_engine()) if max_sessions is not None else None
+        return self._admission
+    
+    def admission_stats(self) -> dict:
+        """
+        returns:
+            dict: The live sessions, the queue depth, the wait times and the pool checked-out connections, see AdmissionController.stats. Empty if no admission control is set.
+        """
+        
+        return self._admission.stats() if self._admission is not None else {}
+    
+    def enable_entity_cache(self, max_entries: int=10000, ttl: Union[float, None]=300.0, classes: Union[list, None]=None) -> EntityCache:
+        """
+        Enables the second-level entity cache shared by the managed sessions, consulted by cached_get. See EntityCache for the args.
+        
+        The session maker must be set before enabling the cache.
+        """
+        
+        if not self.session_maker:
+            raise ValueError("session_maker is not set.")
+        
+        self.disable_entity_cache()
+        self._entity_cache = EntityCache(max_entries, ttl, classes)
+        self._entity_cache.listen(self._event_target())
+        return self._entity_cache
+    
+    def disable_entity_cache(self):
+        if self._entity_cache is not None:
+            entity_cache, self._entity_cache = self._entity_cache, None
+            entity_cache.remove(self._event_target())
+    
+    def cached_get(self, session: Session, cls, primary_key):
+        """
+        Gets an entity by primary key through the entity cache, like session.get when the cache is not enabled.
+        
+        For example:
+        
+        user = SM.cached_get(session, User, user_id)
+        """
+        
+        if self._entity_cache is None:
+            return session.get(cls, primary_key)
+        return self._entity_cache.get(session, cls, primary_key)
+    
+    def entity_cache_stats(self) -> dict:
+        return self._entity_cache.stats() if self._entity_cache is not None else {}
+    
+    def enable_result_cache(self, backend: Union[ResultCacheBackend, None]=None, ttl: Union[float, None]=60.0) -> ResultCache:
+        """
+        Enables the query result cache shared by the managed sessions, consulted by cached_execute. See ResultCache for the args.
+        
+        Pass the same FileResultCacheBackend directory to the SessionManager of several processes to share the results between them.
+        The session maker must be set before enabling the cache.
+        """
+        
+        if not self.session_maker:
+            raise ValueError("session_maker is not set.")
+        
+        self.disable_result_cache()
+        self._result_cache = ResultCache(backend, ttl)
+        self._result_cache.listen(self._event_target())
+        return self._result_cache
+    
+    def disable_result_cache(self):
+        if self._result_cache is not None:
+            result_cache, self._result_cache = self._result_cache, None
+            result_cache.remove(self._event_target())
+    
+    def cached_execute(self, session: Session, statement) -> list[tuple]:
+        """
+        Executes a select of columns through the result cache, returning its rows as tuples.
+        
+        For example:
+        
+        usernames = SM.cached_execute(session, select(User.user_id, User.username).where(User.user_id < 100))
+        """
+        
+        if self._result_cache is None:
+            return [tuple(row) for row in session.execute(statement)]
+        return self._result_cache.execute(session, statement)
+    
+    def result_cache_stats(self) -> dict[str, int]:
+        return self._result_cache.stats() if self._result_cache is not None else {}
+    
+    def parallel_map(self, func: Callable, items, chunk_size: int=100, processes: Union[int, None]=None, ordered: bool=True, auto_commit: bool=False, return_exceptions: bool=False, engine_options: Union[dict, None]=None, mp_context=None):
+        """
+        Maps a function over the items in a pool of processes, each chunk of items in a managed session of its worker.
+        
+        The function is called as func(item, session=session) and must be picklable, a module-level function for instance.
+        Every worker builds its own engine from the URL and the pool, echo, isolation level and execution options of the engine of this manager,
+        overridden by engine_options. The pools inherited through fork are disposed without closing the connections of the parent.
+        An in-memory SQLite database is not shared with the workers.
+        
+        args:
+            func (Callable): The function called for every item.
+            items (Iterable): The items, consumed lazily.
+            chunk_size (int): Number of items processed in the same session. Defaults to 100.
+            processes (int): Number of worker processes. Defaults to the number of CPUs.
+            ordered (bool): If True, the results are yielded in the order of the items, otherwise as the chunks complete, as (index, result) pairs. Defaults to True.
+            auto_commit (bool): If True, the session of every chunk is committed. Defaults to False.
+            return_exceptions (bool): If True, the error of a failed chunk is yielded in place of the result of each of its items, otherwise it is raised. Defaults to False.
+            engine_options (dict): Keyword arguments of create_engine in the workers, such as the connect_args, which cannot be read from the engine. Defaults to None.
+            mp_context: The multiprocessing context of the pool. Defaults to the default one.
+        
+        For example:
+        
+        for total in SM.parallel_map(score_user, user_ids, chunk_size=500):
+            ...
+        """
+        
+        engine = self._bound_engine()
+        if engine is None:
+            raise ValueError("parallel_map requires an engine bound to the session_maker.")
+        
+        processes = processes or multiprocessing.cpu_count()
+        chunks = self._chunks(items, chunk_size)
+        
+        with ProcessPoolExecutor(processes, mp_context=mp_context, initializer=_parallel_map_initializer, initargs=(engine.url, dict(_engine_options(engine), **(engine_options or {})))) as executor:
+            # (start index, chunk length, future), at most two chunks per worker in flight
+            pending: list[tuple] = []
+            for start, chunk in itertools.islice(chunks, processes * 2):
+                pending.append((start, len(chunk), executor.submit(_parallel_map_chunk, func, chunk, auto_commit)))
+            
+            while pending:
+                if ordered:
+                    done = [pending.pop(0)]
+                    done[0][2].exception()
+                else:
+                    wait([future for _, _, future in pending], return_when=FIRST_COMPLETED)
+                    done = [entry for entry in pending if entry[2].done()]
+                    pending = [entry for entry in pending if not entry[2].done()]
+                
+                for start, length, future in done:
+                    for start, chunk in itertools.islice(chunks, 1):
+                        pending.append((start, len(chunk), executor.submit(_parallel_map_chunk, func, chunk, auto_commit)))
+                    
+                    error = future.exception()
+                    if error is not None and not return_exceptions:
+                        raise error
+                    results = [error] * length if error is not None else future.result()
+                    
+                    for index, result in enumerate(results, start):
+                        yield result if ordered else (index, result)
+    
+    @staticmethod
+    def _chunks(items, chunk_size: int):
+        iterator = iter(items)
+        for start in itertools.count(0, chunk_size):
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield start, chunk
+    
+    def write_buffer(self, max_batch_size: int=500, max_delay: float=0.05, max_pending: Union[int, None]=None) -> WriteBuffer:
+        """
+        Creates a write-behind buffer inserting the objects added from any thread in batches, one commit per batch. See WriteBuffer.
+        """
+        
+        return WriteBuffer(self, max_batch_size, max_delay, max_pending)
+    
+    def upsert(self, model, rows, conflict_columns: Union[list[str], None]=None, update_columns: Union[list[str], None]=None, on_conflict: str="update", chunk_size: Union[int, None]=None, session: Union[Session, None]=None) -> dict[str, int]:
+        """
+        Inserts the rows in a few multi-row INSERT ... ON CONFLICT statements, updating or skipping the rows whose conflict columns already exist.
+        
+        Supported on SQLite and PostgreSQL. The rows are split in chunks staying under the bound parameter limit of the dialect,
+        the rows with the same conflict columns are deduplicated beforehand, the last one wins.
+        
+        args:
+            model: The mapped class or the Table to write to.
+            rows (Iterable[Union[Mapping, dataclass]]): The rows, keyed by the attributes or the columns of the model. A row may omit the columns having a default.
+            conflict_columns (list[str]): The columns of the unique constraint or index detecting the existing rows. Defaults to the primary key.
+            update_columns (list[str]): The columns overwritten on the existing rows. Defaults to all the columns given, except the conflict ones.
+            on_conflict (str): "update" to overwrite the existing rows, "nothing" to keep them as they are. Defaults to "update".
+            chunk_size (int): Maximum number of rows per statement. Defaults to as many as the parameter limit allows.
+            session (Session): The session to execute in, left uncommitted. Defaults to a new managed session, committed at the end.
+        
+        returns:
+            dict[str, int]: The numbers of rows inserted, updated, skipped because they existed, dropped as duplicates, and of INSERT statements executed.
+        
+        The objects already loaded in a session are not refreshed by the upsert.
+        
+        For example:
+        
+        counts = SM.upsert(User, [{"username": "user1", "password": "secret"}], conflict_columns=["username"])
+        """
+        
+        if session is not None:
+            return SessionManager._upsert_rows(session, model, rows, conflict_columns, update_columns, on_conflict, chunk_size)
+        
+        with self.session_manager(auto_commit=True, reload_after_commit=False, raise_on_error=True, read_only=False) as session:
+            return SessionManager._upsert_rows(session, model, rows, conflict_columns, update_columns, on_conflict, chunk_size)
+    
+    @staticmethod
+    def _upsert_rows(session: Session, model, rows, conflict_columns: Union[list[str], None], update_columns: Union[list[str], None], on_conflict: str, chunk_size: Union[int, None]) -> dict[str, int]:
+        if on_conflict not in ("update", "nothing"):
+            raise ValueError(f"on_conflict must be 'update' or 'nothing', not {on_conflict!r}.")
+        
+        if isinstance(model, Table):
+            table: Table = model
+            keys: dict[str, str] = {column.key: column.key for column in table.columns}
+        else:
+            mapper = inspect(model)
+            table: Table = mapper.local_table
+            keys: dict[str, str] = {column.key: column.key for column in table.columns}
+            keys.update({attribute.key: attribute.columns[0].key for attribute in mapper.column_attrs if attribute.columns[0].table is table})
+        
+        dialect = session.get_bind(None if isinstance(model, Table) else model, clause=table).dialect
+        if dialect.name == "postgresql":
+            dialect_insert = postgresql.insert
+        elif dialect.name == "sqlite":
+            dialect_insert = sqlite.insert
+        else:
+            raise NotImplementedError(f"upsert is not supported on {dialect.name}, only on sqlite and postgresql.")
+        
+        conflict: list[str] = [keys[name] for name in conflict_columns] if conflict_columns else [column.key for column in table.primary_key.columns]
+        if not conflict:
+            raise ValueError(f"{table.name} has no primary key, conflict_columns are required.")
+        updatable: Union[set[str], None] = {keys[name] for name in update_columns} if update_columns is not None else None
+        
+        counts: dict[str, int] = {"inserted": 0, "updated": 0, "skipped": 0, "duplicates": 0, "statements": 0}
+        
+        # rows with the same conflict columns are deduplicated, the others are inserted as they are
+        unique_rows: dict = {}
+        unkeyed = object()
+        for position, row in enumerate(rows):
+            if dataclasses.is_dataclass(row) and not isinstance(row, type):
+                row = {field.name: getattr(row, field.name) for field in dataclasses.fields(row)}
+            unknown = [key for key in row if key not in keys]
+            if unknown:
+                raise ValueError(f"{table.name} has no column {', '.join(map(str, unknown))}.")
+            values: dict = {keys[key]: value for key, value in row.items()}
+            
+            if all(values.get(name) is not None for name in conflict):
+                identity = tuple(values[name] for name in conflict)
+                if identity in unique_rows:
+                    counts["duplicates"] += 1
+                    del unique_rows[identity]
+                unique_rows[identity] = values
+            else:
+                unique_rows[(unkeyed, position)] = values
+        
+        # a multi-row VALUES needs the same columns in every row
+        groups: dict[tuple, list[dict]] = {}
+        for values in unique_rows.values():
+            groups.setdefault(tuple(sorted(values)), []).append(values)
+        
+        parameter_limit: int = _upsert_parameter_limit(dialect)
+        for columns, group in groups.items():
+            step: int = max(1, parameter_limit // len(columns))
+            if chunk_size:
+                step = min(step, chunk_size)
+            set_columns: list[str] = [name for name in columns if name not in conflict and (updatable is None or name in updatable)] if on_conflict == "update" else []
+            
+            for start in range(0, len(group), step):
+                chunk: list[dict] = group[start:start + step]
+                statement = dialect_insert(table).values(chunk)
+                if set_columns:
+                    statement = statement.on_conflict_do_update(index_elements=conflict, set_={name: statement.excluded[name] for name in set_columns})
+                else:
+                    statement = statement.on_conflict_do_nothing(index_elements=conflict)
+                
+                if dialect.name == "postgresql":
+                    # xmax is 0 on the row versions created by an insert
+                    inserted: list[bool] = session.execute(statement.returning(literal_column("xmax = 0"))).scalars().all()
+                    written, new = len(inserted), sum(inserted)
+                else:
+                    # SQLite cannot tell the inserted rows from the updated ones, the existing ones are counted first
+                    existing: int = 0
+                    if set_columns:
+                        identities = [tuple(values[name] for name in conflict) for values in chunk if all(values.get(name) is not None for name in conflict)]
+                        if identities:
+                            key_columns = [table.columns[name] for name in conflict]
+                            criterion = key_columns[0].in_([identity[0] for identity in identities]) if len(conflict) == 1 else tuple_(*key_columns).in_(identities)
+                            existing = session.execute(select(func.count()).select_from(table).where(criterion)).scalar()
+                    # the rowcount of SQLite counts the inserted and the updated rows
+                    written = session.execute(statement).rowcount
+                    new = written - existing
+                
+                counts["statements"] += 1
+                counts["inserted"] += new
+                counts["updated"] += written - new
+                counts["skipped"] += len(chunk) - written
+        
+        logging.info("upserted into %s: %d inserted, %d updated, %d skipped in %d statements", table.name, counts["inserted"], counts["updated"], counts["skipped"], counts["statements"])
+        return counts
+    
+    def add_instrument(self, instrument: SessionInstrument):
+        """
+        Registers an instrument receiving the timings and counters of the managed sessions.
+        
+        Without instruments the sessions are not timed at all.
+        """
+        
+        self._instruments = self._instruments + [instrument]
+
+    def remove_instrument(self, instrument: SessionInstrument):
+        self._instruments = [registered for registered in self._instruments if registered is not instrument]
+    
+    def _observe(self, phase: str, label: str, seconds: float):
+        for instrument in self._instruments:
+            instrument.observe(phase, label, seconds)
+    
+    def _increment(self, counter: str, label: str):
+        for instrument in self._instruments:
+            instrument.increment(counter, label)
+    
+    def enable_statement_profiling(self, slow_statement_seconds: float=0.1, repeat_threshold: int=10, report: Union[Callable[[StatementProfile], None], None]=None):
+        """
+        Tracks the statements executed while each managed session is open, to find slow statements and N+1 query patterns.
+        
+        When the session is closed a summary is logged, with a warning for every statement slower than slow_statement_seconds
+        and for every normalized statement executed more than repeat_threshold times.
+        The engine must be set before enabling the profiling.
+        
+        args:
+            slow_statement_seconds (float): Duration from which a statement is reported as slow. Defaults to 0.1.
+            repeat_threshold (int): Number of executions of the same normalized statement from which the session is flagged as a possible N+1. Defaults to 10.
+            report (Callable[[StatementProfile], None]): Called with the StatementProfile of each managed session when it is closed. Defaults to None.
+        """
+        
+        engine = self._bound_engine()
+        if engine is None:
+            raise ValueError("statement profiling requires an engine bound to the session_maker.")
+        if isinstance(engine, AsyncEngine):
+            engine = engine.sync_engine
+        
+        self.disable_statement_profiling()
+        
+        self._statement_profiling = {
+            "engine": engine,
+            "slow_statement_seconds": slow_statement_seconds,
+            "repeat_threshold": repeat_threshold,
+            "report": report,
+            # bound methods are created on every access, keep the registered ones to remove them
+            "before_cursor_execute": self._before_cursor_execute,
+            "after_cursor_execute": self._after_cursor_execute,
+        }
+        event.listen(engine, "before_cursor_execute", self._statement_profiling["before_cursor_execute"])
+        event.listen(engine, "after_cursor_execute", self._statement_profiling["after_cursor_execute"])
+    
+    def disable_statement_profiling(self):
+        if self._statement_profiling is None:
+            return
+        
+        engine = self._statement_profiling["engine"]
+        event.remove(engine, "before_cursor_execute", self._statement_profiling["before_cursor_execute"])
+        event.remove(engine, "after_cursor_execute", self._statement_profiling["after_cursor_execute"])
+        self._statement_profiling = None
+    
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._statement_profile.get() is not None:
+            conn.info.setdefault("session_manager_start_times", []).append(time.perf_counter())
+    
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile: Union[StatementProfile, None] = self._statement_profile.get()
+        start_times: Union[list, None] = conn.info.get("session_manager_start_times")
+        if profile is None or not start_times or self._statement_profiling is None:
+            return
+        
+        # the rows of a statement returning rows are not counted yet, see StatementProfile
+        rows: Union[int, None] = cursor.rowcount if cursor.description is None and cursor.rowcount >= 0 else None
+        profile.record(statement, time.perf_counter() - start_times.pop(), rows, self._statement_profiling["slow_statement_seconds"])
+    
+    def _report_statements(self, profile: StatementProfile):
+        """
+        Logs the summary of the statements executed by a managed session, its slow statements and its repeated statements.
+        """
+        
+        profiling = self._statement_profiling
+        if profiling is None:
+            return
+        
+        logging.info(profile.summary())
+        for statement, seconds, rows in profile.slow_statements:
+            if rows is None:
+                logging.warning("%s: slow statement (%d ms): %s", profile.label, seconds * 1000, statement)
+            else:
+                logging.warning("%s: slow statement (%d ms, %d rows): %s", profile.label, seconds * 1000, rows, statement)
+        for statement, executions in profile.repeated_statements(profiling["repeat_threshold"]):
+            logging.warning("%s: statement executed %d times in one session, possible N+1: %s", profile.label, executions, statement)
+        
+        if profiling["report"]:
+            profiling["report"](profile)
+        
+    def session_manager(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[BaseException, tuple[BaseException]]=None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR, propagation: Propagation=Propagation.REQUIRED, read_only: Union[bool, None]=None, priority: int=0, admission_timeout: Union[float, None]=None, loader_profile: Union[LoaderProfile, str, None]=None, policy: Union[SessionPolicy, None]=None):
+        """
+        Context manager to manage the session for the database operations.
+
+        If a session is provided as a parameter, it will be used. Otherwise, a new session will be created and closed after the function is called.
+
+        args:
+            auto_commit (bool): If True, the session will be committed after the function is called and all the attributes of the session. Defaults to False.
+            reload_after_commit (bool): If True, all the objects in the session will be reloaded after the commit. Defaults to auto_commit. If auto_commit is False, this parameter is ignored.
+            raise_error_types (Union[Exception, tuple[Exception]]): If an exception of this type is raised, the error will be raised after the session is rolled back. Defaults to None.
+            raise_on_error (bool): If True, the exception will be raised after the session is rolled back. Defaults to False.
+            verbose (Union[int, bool]): If True, the logging level will be set to logging.INFO. If False, the logging level will be set to logging.ERROR. If an int, the logging level will be set to that value. Defaults to logging.ERROR.
+            propagation (Propagation): How to behave when a managed session is already open in the current context. Defaults to Propagation.REQUIRED, joining it.
+            read_only (bool): If True, the session is routed to a replica when replicas are set, see set_replicas, or to the read engine of a SQLite profile, see set_engine. Defaults to not auto_commit.
+            priority (int): Sessions with a higher priority are admitted first when the admission control is set, see set_admission_control. Defaults to 0.
+            admission_timeout (float): Seconds to wait for a slot of the admission control, None for its default timeout. Defaults to None.
+            loader_profile (Union[LoaderProfile, str]): Loader options added to the ORM selects of the block, or the name of a profile
+                registered with register_loader_profile. Defaults to None.
+            policy (SessionPolicy): Settings resolved beforehand, replacing all the other args. Defaults to None.
+
+
+        This context manager is used to manage the session for the database operations.
+        
+        This function can be used as a context manager to manage the session for the database operations.
+        
+        For example:
+        
+        with session_manager(auto_commit=True) as session:
+            # perform database operations using the session
+            ...
+        """
+        
+        if policy is not None:
+            loader_profile = self._resolve_loader_profile(policy.loader_profile)
+            if self._fast_path_enabled() and (policy.propagation is Propagation.REQUIRES_NEW or self._ambient_session.get() is None):
+                return _NewSessionScope(self, "session_manager", policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose, policy.read_only, loader_profile, policy._explicit_read_only)
+            return self._session_scope(policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose, policy.propagation, label="session_manager", read_only=policy.read_only, priority=policy.priority, admission_timeout=policy.admission_timeout, loader_profile=loader_profile, explicit_read_only=policy._explicit_read_only)
+        
+        explicit_read_only: bool = read_only is True
+        if reload_after_commit is None:
+            reload_after_commit = auto_commit
+        
+        if read_only is None:
+            read_only = not auto_commit
+
+        # Set up logging
+        if isinstance(verbose, bool):
+            verbose = logging.INFO if verbose else logging.ERROR
+
+        logging.basicConfig(level=verbose)
+
+        logging.info("session management called...")
+        
+        loader_profile = self._resolve_loader_profile(loader_profile)
+        if self._fast_path_enabled() and (propagation is Propagation.REQUIRES_NEW or self._ambient_session.get() is None):
+            return _NewSessionScope(self, "session_manager", auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, read_only, loader_profile, explicit_read_only)
+        return self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label="session_manager", read_only=read_only, priority=priority, admission_timeout=admission_timeout, loader_profile=loader_profile, explicit_read_only=explicit_read_only)
+
+
+    def session_management(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[Exception, tuple[Exception], None]= None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR, propagation: Propagation=Propagation.REQUIRED, yield_per: int=1000, retry: Union[RetryPolicy, None]=None, read_only: Union[bool, None]=None, priority: int=0, admission_timeout: Union[float, None]=None, snapshot: Union[bool, list[str]]=False, loader_profile: Union[LoaderProfile, str, None]=None, policy: Union[SessionPolicy, None]=None):
+        """
+        Decorator to manage the session for the database operations.
+
+        If a session is provided as a parameter, it will be used. Otherwise, a new session will be created and closed after the function is called.
+
+        args:
+            auto_commit (bool): If True, the session will be committed after the function is called and all the attributes of the session. Defaults to False.
+            reload_after_commit (bool): If True, all the objects in the session will be reloaded after the commit. Defaults to auto_commit. If auto_commit is False, this parameter is ignored.
+            raise_error_types (Union[Exception, tuple[Exception]]): If an exception of this type is raised, the error will be raised after the session is rolled back. Defaults to None.
+            raise_on_error (bool): If True, the exception will be raised after the session is rolled back. Defaults to False.
+            verbose (Union[int, bool]): If True, the logging level will be set to logging.INFO. If False, the logging level will be set to logging.ERROR. If an int, the logging level will be set to that value. Defaults to logging.ERROR.
+            propagation (Propagation): How to behave when a managed session is already open in the current context. Defaults to Propagation.REQUIRED, joining it.
+            read_only (bool): If True, the session is routed to a replica when replicas are set, see set_replicas, or to the read engine of a SQLite profile, see set_engine. Defaults to not auto_commit.
+            priority (int): Sessions with a higher priority are admitted first when the admission control is set, see set_admission_control. Defaults to 0.
+            admission_timeout (float): Seconds to wait for a slot of the admission control, None for its default timeout. Defaults to None.
+            yield_per (int): Batch size of the rows fetched by the queries of a generator function, see below. Defaults to 1000.
+            retry (RetryPolicy): If set, the function is called again in a new session when it fails with a transient error. Defaults to None.
+            snapshot (Union[bool, list[str]]): If set, the return value is converted by make_snapshot before the session is closed, keeping the loaded columns
+                of the ORM objects, or the ones listed. Defaults to False.
+            loader_profile (Union[LoaderProfile, str]): Loader options added to the ORM selects of the function, or the name of a profile
+                registered with register_loader_profile. Defaults to None.
+            policy (SessionPolicy): Settings resolved beforehand, replacing all the other args. Defaults to None.
+
+
+        This decorator is used to manage the session for the database operations.
+
+        Add to the parameters of the function to be decorated a parameter called session with a default value of None.
+
+        The function will be called with the session as a parameter, and the session will be closed after the function is called.
+
+        If the function raises an exception, the session will be rolled back and closed.
+        
+        With a retry policy, the errors classified as transient are retried until the policy gives up, then handled as any other error.
+        The retry is skipped when the call joins an ambient session, the outermost managed call retries the whole unit of work.
+        Generator functions are never retried.
+        
+        If the function is a generator, the session is kept open until the generator is exhausted or closed,
+        and its queries are executed with yield_per so that the rows are streamed from a server-side cursor in batches.
+        A session opened by a generator is not shared with the managed calls made while it is suspended.
+        
+        With snapshot, the ORM objects and rows returned by the function are flushed then copied into immutable Snapshot records,
+        readable after the session is closed and safe to share between threads or to cache. Generator functions are not converted.
+        
+        With a loader_profile, the relationships the function returns are loaded by its queries instead of one lazy load per object,
+        see LoaderProfile. A call joining an ambient session applies its profile to the session until it returns.
+        
+        The settings are resolved once, when the function is decorated. When no optional feature of the manager is enabled
+        (instruments, statement profiling, replicas, group commit or admission control) and no ambient session is joined,
+        a call runs on a fast path that opens and closes the session without the context manager machinery.
+        """
+        
+        if policy is None:
+            policy = SessionPolicy(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, read_only, retry, yield_per, priority, admission_timeout, snapshot, loader_profile)
+        
+        auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose = policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose
+        propagation, read_only, retry, yield_per, priority, admission_timeout, snapshot = policy.propagation, policy.read_only, policy.retry, policy.yield_per, policy.priority, policy.admission_timeout, policy.snapshot
+        # a name is looked up at each call, the profile may be registered after the function is decorated
+        loader_profile = policy.loader_profile
+        explicit_read_only: bool = policy._explicit_read_only
+
+        def decorator(func):
+            if pyinspect.isgeneratorfunction(func):
+                @wraps(func)
+                def stream_wrapper(*args, **kwargs):
+                    logging.info("session management called...")
+                    
+                    if "session" in kwargs and kwargs["session"]:
+                        logging.info("session provided...")
+                        yield from func(*args, **kwargs)
+                        return
+                    
+                    with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, yield_per, func.__qualname__, read_only=read_only, priority=priority, admission_timeout=admission_timeout, loader_profile=self._resolve_loader_profile(loader_profile), explicit_read_only=explicit_read_only) as session:
+                        kwargs["session"] = session
+                        try:
+                            yield from func(*args, **kwargs)
+                        except GeneratorExit:
+                            logging.info("stream closed...")
+                
+                return stream_wrapper
+            
+            if snapshot:
+                func = self._snapshot_results(func, None if snapshot is True else list(snapshot))
+            
+            label: str = func.__qualname__
+            
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if logging.root.isEnabledFor(logging.INFO):
+                    logging.info("session management called...")
+                
+                if kwargs.get("session"):
+                    logging.info("session provided...")
+                    return func(*args, **kwargs)
+                
+                if retry is None and self._fast_path_enabled() and (propagation is Propagation.REQUIRES_NEW or self._ambient_session.get() is None):
+                    return self._call_in_new_session(policy, label, func, args, kwargs)
+                
+                if retry is not None and not self._joins_ambient_session(propagation, read_only, auto_commit):
+                    return self._call_with_retry(retry, func, args, kwargs, auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, read_only, priority, admission_timeout, self._resolve_loader_profile(loader_profile), explicit_read_only)
+                
+                with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label=func.__qualname__, read_only=read_only, priority=priority, admission_timeout=admission_timeout, loader_profile=self._resolve_loader_profile(loader_profile), explicit_read_only=explicit_read_only) as session:
+                    kwargs["session"] = session
+                    result = func(*args, **kwargs)
+                    return result
+
+            return wrapper
+
+        return decorator
+    
+    @staticmethod
+    def _snapshot_results(func, columns: Union[list[str], None]):
+        @wraps(func)
+        def snapshot_wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            # flushed first, so that the snapshots hold the generated keys
+            kwargs["session"].flush()
+            return make_snapshot(result, columns)
+        return snapshot_wrapper
+    
+    def _fast_path_enabled(self) -> bool:
+        """
+        True when no optional feature changes the lifecycle of the sessions: a new session is then opened by a _NewSessionScope.
+        """
+        
+        return not (self._instruments or self._statement_profiling or self._router is not None or self._group_commit is not None or self._admission is not None)
+    
+    def _call_in_new_session(self, policy: SessionPolicy, label: str, func, args: tuple, kwargs: dict):
+        with _NewSessionScope(self, label, policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose, policy.read_only, self._resolve_loader_profile(policy.loader_profile), policy._explicit_read_only) as session:
+            kwargs["session"] = session
+            return func(*args, **kwargs)
+    
+    @contextmanager
+    def _session_scope(self, auto_commit: bool, reload_after_commit: bool, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, verbose: int, propagation: Propagation, yield_per: Union[int, None]=None, label: str="session_manager", retryable: Union[Callable[[BaseException], bool], None]=None, read_only: bool=False, priority: int=0, admission_timeout: Union[float, None]=None, loader_profile: Union[LoaderProfile, None]=None, explicit_read_only: bool=False):
+        """
+        Opens, joins or nests the managed session according to the propagation mode.
+        A read-write block never joins a session bound to a replica, it opens its own session on the primary,
+        and a block with auto_commit never joins a session that does not commit, it opens its own session.
+        
+        If yield_per is set the session is opened for a stream: its queries are executed with yield_per and it is not published as the ambient session.
+        A new session takes a slot of the admission control first, an AdmissionRejected is raised as is.
+        A block joining a session with a loader_profile applies it until the block ends.
+        A block joining a session without raise_on_error runs in a savepoint, see Propagation.REQUIRED.
+        """
+        
+        ambient: Union[Session, None] = self._joinable_ambient_session(read_only, auto_commit)
+        
+        if ambient is not None and propagation is Propagation.REQUIRED and raise_on_error:
+            logging.info("joining ambient session...")
+            with self._use_loader_profile(ambient, loader_profile):
+                yield ambient
+            return
+        
+        # a joined block swallowing its errors must not roll back the changes of the outer block
+        if ambient is not None and propagation is not Propagation.REQUIRES_NEW:
+            logging.info("opening savepoint on ambient session...")
+            if ambient.get_bind().dialect.name == "sqlite":
+                _begin_sqlite_transaction(ambient)
+            savepoint = ambient.begin_nested()
+            try:
+                with self._use_loader_profile(ambient, loader_profile):
+                    yield ambient
+            except BaseException as e:
+                self._savepoint_error_handler(e, savepoint, raise_error_types, raise_on_error, verbose, label)
+            else:
+                if savepoint.is_active:
+                    savepoint.commit()
+            return
+        
+        instrumented: bool = bool(self._instruments)
+        
+        admission: Union[AdmissionController, None] = self._admission
+        if admission is not None:
+            try:
+                waited: float = admission.acquire(priority, admission_timeout, label)
+            except AdmissionRejected as e:
+                logging.warning(str(e))
+                if instrumented:
+                    self._increment(f"admission_rejected_{e.reason}", label)
+                raise
+            if instrumented:
+                self._observe("admission_wait", label, waited)
+        
+        if instrumented:
+            start_time = time.perf_counter()
+        
+        group_commit: Union[GroupCommitter, None] = self._group_commit if not read_only and not yield_per else None
+        try:
+            if group_commit is not None:
+                group_commit.acquire()
+            try:
+                session: Session = self._create_session(verbose=verbose, read_only=read_only, group_commit=group_commit, explicit_read_only=explicit_read_only)
+                if self._router is not None and session.info.get("session_manager_replica"):
+                    session = self._connect_replica(session)
+            except BaseException:
+                if group_commit is not None:
+                    group_commit.release(wait=False)
+                raise
+        except BaseException:
+            if admission is not None:
+                admission.release()
+            raise
+        token, profile_token = self._open_session_scope(session, auto_commit, reload_after_commit, yield_per, loader_profile, label)
+        
+        if instrumented:
+            body_start_time = time.perf_counter()
+            self._observe("create", label, body_start_time - start_time)
+        
+        failed: bool = False
+        group_commit_done: Union[Future, None] = None
+
+        try:
+            yield session
+        
+        except BaseException as e: 
+            failed = True
+            if instrumented:
+                self._observe("body", label, time.perf_counter() - body_start_time)
+            self._error_handler(e, session, raise_error_types, raise_on_error, verbose, label, retryable)
+        
+        else:
+            if instrumented:
+                self._observe("body", label, time.perf_counter() - body_start_time)
+        
+        finally:
+            try:
+                self._cleanup_session(session, auto_commit, reload_after_commit, verbose, self.reload_chunk_size, label)
+            finally:
+                if group_commit is not None:
+                    group_commit_done = group_commit.release(wait=auto_commit and not failed)
+                if admission is not None:
+                    admission.release()
+                self._close_session_scope(session, token, profile_token)
+        
+        if group_commit_done is not None:
+            logging.info("waiting for group commit...")
+            try:
+                group_commit_done.result()
+            except Exception as e:
+                self._raise_or_log(e, raise_error_types, raise_on_error, label)
+    
+    def _open_session_scope(self, session, auto_commit: bool, reload_after_commit: bool, yield_per: Union[int, None], loader_profile: Union[LoaderProfile, None], label: str) -> tuple:
+        """
+        Sets up the new session of a managed block, the sync or the async one.
+        
+        returns:
+            tuple: The tokens of the ambient session and of the statement profile, None for a stream, reset by _close_session_scope.
+        """
+        
+        if loader_profile is not None:
+            self._set_loader_profile(session, loader_profile)
+        if auto_commit and reload_after_commit:
+            self._track_reload(session)
+        if yield_per:
+            session.info["session_manager_yield_per"] = yield_per
+            return None, None
+        
+        session.info["session_manager_auto_commit"] = auto_commit
+        return self._ambient_session.set(session), self._statement_profile.set(StatementProfile(label)) if self._statement_profiling else None
+    
+    def _close_session_scope(self, session, token, profile_token):
+        if self._router is not None:
+            self._router.release(session.info.get("session_manager_engine"))
+        if token is not None:
+            self._ambient_session.reset(token)
+        if profile_token is not None:
+            profile: StatementProfile = self._statement_profile.get()
+            self._statement_profile.reset(profile_token)
+            self._report_statements(profile)
+    
+    def _joinable_ambient_session(self, read_only: bool=False, auto_commit: bool=False):
+        ambient = self._ambient_session.get()
+        if ambient is not None and not read_only and ambient.info.get("session_manager_replica"):
+            logging.info("ambient session is bound to a replica, not joining it...")
+            return None
+        if ambient is not None and auto_commit and not ambient.info.get("session_manager_auto_commit", True):
+            # joined, the writes of the block would be discarded with the ambient session
+            logging.warning("ambient session does not commit, opening a new session for a block with auto_commit...")
+            return None
+        return ambient
+    
+    def _joins_ambient_session(self, propagation: Propagation, read_only: bool=False, auto_commit: bool=False) -> bool:
+        return propagation is not Propagation.REQUIRES_NEW and self._joinable_ambient_session(read_only, auto_commit) is not None
+    
+    def _call_with_retry(self, retry: RetryPolicy, func, args: tuple, kwargs: dict, auto_commit: bool, reload_after_commit: bool, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, verbose: int, propagation: Propagation, read_only: bool=False, priority: int=0, admission_timeout: Union[float, None]=None, loader_profile: Union[LoaderProfile, None]=None, explicit_read_only: bool=False):
+        """
+        Calls the function in a managed session, again in a new session every time it fails with an error classified as transient by the retry policy.
+        """
+        
+        label: str = func.__qualname__
+        started: float = time.monotonic()
+        retry._count(calls=1)
+        
+        for attempt in itertools.count(1):
+            retry._count(attempts=1)
+            result = None
+            try:
+                with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label=label, retryable=retry.classifier, read_only=read_only, priority=priority, admission_timeout=admission_timeout, loader_profile=loader_profile, explicit_read_only=explicit_read_only) as session:
+                    kwargs["session"] = session
+                    result = func(*args, **kwargs)
+                return result
+            
+            except BaseException as e:
+                if not retry.classifier(e):
+                    raise
+                
+                delay = self._retry_delay(retry, e, attempt, started, label, raise_error_types, raise_on_error)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+    
+    def _retry_delay(self, retry: RetryPolicy, e: BaseException, attempt: int, started: float, label: str, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool) -> Union[float, None]:
+        """
+        returns:
+            float: The delay before the next attempt after the transient error, None if the policy gives up, once the error is raised or logged.
+        """
+        
+        delay = retry.next_delay(attempt, started)
+        if delay is None:
+            logging.warning("%s: giving up after %d attempts: %s", label, attempt, e)
+            retry._count(exhausted=1)
+            if self._instruments:
+                self._increment("retries_exhausted", label)
+            self._raise_or_log(e, raise_error_types, raise_on_error, label)
+            return None
+        
+        logging.warning("%s: transient error on attempt %d, retrying in %d ms: %s", label, attempt, delay * 1000, e)
+        retry._count(retries=1)
+        if self._instruments:
+            self._increment("retries", label)
+        return delay
+    
+    def _cleanup_session(self, session: Session, auto_commit: bool=False, reload_after_commit: bool=None, verbose: int=logging.ERROR, reload_chunk_size: int=reload_chunk_size, label: str="session_manager"):
+        """
+        Cleans up the session after the function is called, see _cleanup_steps.
+        """
+        
+        SessionManager._run_steps(session, self._cleanup_steps(session, auto_commit, reload_after_commit, reload_chunk_size, label))
+    
+    def _cleanup_steps(self, session, auto_commit: bool, reload_after_commit: bool, reload_chunk_size: int, label: str):
+        """
+        Commits the session if auto_commit, rolling it back if the commit fails, reloads the objects written if reload_after_commit, and closes it.
+        
+        The decisions are shared by SessionManager and AsyncSessionManager: the steps yield the operations to run on the session,
+        the name of a method or a function of the sync session, and receive their result or error, see _run_steps.
+        """
+        
+        log_info: bool = logging.root.isEnabledFor(logging.INFO)
+        instrumented: bool = bool(self._instruments)
+        
+        if not session or not session.is_active:
+            logging.warning("session is None or inactive!")
+            return
+            
+        if auto_commit:
+            try:
+                if log_info:
+                    logging.info("committing session...")
+                try:
+                    if instrumented:
+                        start_time = time.perf_counter()
+                        yield "flush"
+                        flushed_time = time.perf_counter()
+                        self._observe("flush", label, flushed_time - start_time)
+                    yield "commit"
+                    if instrumented:
+                        self._observe("commit", label, time.perf_counter() - flushed_time)
+                        self._increment("commits", label)
+                except IntegrityError:
+                    if log_info:
+                        logging.info("rolling back session...")
+                    
+                    # the stack trace is only formatted if the error is emitted
+                    logging.error("integrity error on commit, rolling back:", exc_info=True)
+                    
+                    start_time = time.perf_counter()
+                    yield "rollback"
+                    if instrumented:
+                        self._observe("rollback", label, time.perf_counter() - start_time)
+                        self._increment("rollbacks", label)
+                        self._increment("errors_swallowed", label)
+                    yield "close"
+                except BaseException:
+                    # the connection, and the write lock of SQLite, are given back before the error is raised or retried
+                    start_time = time.perf_counter()
+                    try:
+                        yield "rollback"
+                    except Exception:
+                        logging.warning("rolling back after a failed commit failed:", exc_info=True)
+                    finally:
+                        yield "close"
+                    if instrumented:
+                        self._observe("rollback", label, time.perf_counter() - start_time)
+                        self._increment("rollbacks", label)
+                    raise
+                    
+                if log_info:
+                    logging.info("committed!")
+                # reload the objects written in this transaction
+                if reload_after_commit and session.info.get("session_manager_committed"):
+                    if log_info:
+                        logging.info("reloading objects...")
+                    start_time = time.perf_counter()
+                    objects, queries = yield partial(SessionManager._reload_objects, chunk_size=reload_chunk_size)
+                    reload_time = time.perf_counter() - start_time
+                    if instrumented:
+                        self._observe("reload", label, reload_time)
+                    if log_info:
+                        logging.info("reloaded %d objects with %d queries in %d ms!", objects, queries, reload_time * 1000)
+            except InvalidRequestError:
+                pass
+        else:
+            if reload_after_commit:
+                logging.warning("reload_after_commit is set to True, but auto_commit is set to False. Ignoring reload_after_commit.")
+        
+        
+        if session.is_active:
+            try:
+                if log_info:
+                    logging.info("closing session...")
+                start_time = time.perf_counter()
+                yield "close"
+                if instrumented:
+                    self._observe("close", label, time.perf_counter() - start_time)
+                if log_info:
+                    logging.info("closed!")
+                pass
+                
+            except InvalidRequestError:
+                if log_info:
+                    logging.info("already closed!")
+                pass
+    
+    @staticmethod
+    def _run_steps(target, steps):
+        """
+        Runs the operations yielded by the steps on the session or the savepoint, sending back their result or throwing their error in.
+        """
+        
+        send, throw = steps.send, steps.throw
+        result = error = None
+        while True:
+            try:
+                step = send(result) if error is None else throw(error)
+            except StopIteration:
+                return
+            result = error = None
+            try:
+                result = step(target) if callable(step) else getattr(target, step)()
+            except BaseException as e:
+                error = e
+    
+    def _register_session_events(self):
+        """
+        Registers on the session maker the listeners used by the managed sessions:
+        the flush and transaction listeners that record the objects inserted or updated, the listener that applies yield_per to streamed queries,
+        the listener that applies the loader profiles, and the listener that times the first query for startup_stats.
+        """
+        
+        target = self._event_target()
+        if not event.contains(target, "after_flush", SessionManager._record_flushed_objects):
+            event.listen(target, "after_flush", SessionManager._record_flushed_objects)
+        if not event.contains(target, "after_commit", SessionManager._keep_committed_objects):
+            event.listen(target, "after_commit", SessionManager._keep_committed_objects)
+        if not event.contains(target, "after_transaction_end", SessionManager._discard_flushed_objects):
+            event.listen(target, "after_transaction_end", SessionManager._discard_flushed_objects)
+        if not event.contains(target, "do_orm_execute", self._apply_yield_per):
+            event.listen(target, "do_orm_execute", self._apply_yield_per)
+        if not event.contains(target, "do_orm_execute", SessionManager._apply_loader_profile):
+            event.listen(target, "do_orm_execute", SessionManager._apply_loader_profile)
+        if not event.contains(target, "after_begin", self._on_first_begin):
+            event.listen(target, "after_begin", self._on_first_begin)
+    
+    def _event_target(self):
+        """
+        returns:
+            The target of the listeners of the managed sessions, the session maker.
+        """
+        
+        return self.session_maker
+    
+    def _track_reload(self, session: Session):
+        """
+        Makes the session record the objects it flushes, so that they are reloaded after its commit.
+        The objects are held by weak references: those dropped by the application are not reloaded.
+        """
+        
+        session.info["session_manager_written"] = weakref.WeakSet()
+    
+    @staticmethod
+    def _record_flushed_objects(session: Session, flush_context):
+        # only the sessions reloading after their commit record, see _track_reload
+        written: Union[weakref.WeakSet, None] = session.info.get("session_manager_written")
+        if written is None:
+            return
+        for obj in itertools.chain(session.new, session.dirty):
+            written.add(inspect(obj))
+    
+    @staticmethod
+    def _keep_committed_objects(session: Session):
+        # the objects of the last commit are reloaded, the ones of a commit made earlier by the function are not
+        written: Union[weakref.WeakSet, None] = session.info.get("session_manager_written")
+        if written:
+            session.info["session_manager_committed"] = written
+            session.info["session_manager_written"] = weakref.WeakSet()
+    
+    @staticmethod
+    def _discard_flushed_objects(session: Session, transaction):
+        # what is left at the end of a transaction was flushed in a transaction rolled back
+        if transaction.parent is None:
+            written: Union[weakref.WeakSet, None] = session.info.get("session_manager_written")
+            if written:
+                written.clear()
+    
+    @staticmethod
+    def _apply_yield_per(orm_execute_state):
+        yield_per: Union[int, None] = orm_execute_state.session.info.get("session_manager_yield_per")
+        if not yield_per or not orm_execute_state.is_select or "yield_per" in orm_execute_state.execution_options:
+            return
+        # the lazy loads, the expired column loads and the eager relationship loads are consumed whole by the ORM
+        if orm_execute_state.is_relationship_load or orm_execute_state.is_column_load or orm_execute_state.lazy_loaded_from is not None:
+            return
+        orm_execute_state.update_execution_options(yield_per=yield_per)
+    
+    @staticmethod
+    def _apply_loader_profile(orm_execute_state):
+        profile: Union[LoaderProfile, None] = orm_execute_state.session.info.get("session_manager_loader_profile")
+        if profile is None or not orm_execute_state.is_select:
+            return
+        
+        if orm_execute_state.lazy_loaded_from is not None:
+            if profile.raise_on_lazy_load:
+                loaded: str = ", ".join(mapper.class_.__name__ for mapper in orm_execute_state.all_mappers)
+                raise InvalidRequestError(f"lazy load of {loaded} from a {orm_execute_state.lazy_loaded_from.class_.__name__} refused by the loader profile, "
+                                          f"add a loader option for the relationship: {profile!r}")
+            return
+        
+        # the loads of the expired columns and of the eager relationships inherit the options of their select
+        if not orm_execute_state.is_column_load and not orm_execute_state.is_relationship_load:
+            orm_execute_state.statement = profile.apply(orm_execute_state.statement)
+    
+    @staticmethod
+    def _reload_objects(session: Session, chunk_size: int=reload_chunk_size) -> tuple[int, int]:
+        """
+        Reloads the objects inserted or updated in the session, grouped by mapper and selected in chunks by primary key.
+        
+        returns:
+            tuple[int, int]: The number of reloaded objects and the number of queries issued.
+        """
+        
+        written: Union[weakref.WeakSet, None] = session.info.pop("session_manager_committed", None)
+        if not written:
+            return 0, 0
+        
+        identities_by_mapper: dict = {}
+        for state in list(written):
+            if not state.persistent or state.session_id != session.hash_key:
+                continue
+            identities_by_mapper.setdefault(state.mapper, []).append(state.identity)
+        
+        objects = queries = 0
+        for mapper, identities in identities_by_mapper.items():
+            pk_columns = mapper.primary_key
+            step = max(1, chunk_size // len(pk_columns))
+            for start in range(0, len(identities), step):
+                chunk = identities[start:start + step]
+                if len(pk_columns) == 1:
+                    criterion = pk_columns[0].in_([identity[0] for identity in chunk])
+                else:
+                    criterion = tuple_(*pk_columns).in_(chunk)
+                
+                statement = select(mapper).where(criterion).execution_options(populate_existing=True)
+                objects += len(session.execute(statement).scalars().unique().all())
+                queries += 1
+        
+        return objects, queries
+    
+    def _error_handler(self, e: BaseException, session: Session, raise_error_types: Union[BaseException, tuple[BaseException], None]=None, raise_on_error: bool=False, verbose: int=logging.ERROR, label: str="session_manager", retryable: Union[Callable[[BaseException], bool], None]=None):
+        SessionManager._run_steps(session, self._error_steps(e, raise_error_types, raise_on_error, label, retryable))
+    
+    def _error_steps(self, e: BaseException, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, label: str, retryable: Union[Callable[[BaseException], bool], None]):
+        # rolls back and closes the session of a failed block, then raises or logs the error, see _run_steps
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info("rolling back session...")
+        start_time = time.perf_counter()
+        yield "rollback"
+        if self._instruments:
+            self._observe("rollback", label, time.perf_counter() - start_time)
+            self._increment("rollbacks", label)
+        yield "close"
+        
+        # a transient error is raised to the retry loop, which decides how to handle it
+        if retryable is not None and retryable(e):
+            raise e
+        
+        self._raise_or_log(e, raise_error_types, raise_on_error, label)
+            
+    def _savepoint_error_handler(self, e: BaseException, savepoint, raise_error_types: Union[BaseException, tuple[BaseException], None]=None, raise_on_error: bool=False, verbose: int=logging.ERROR, label: str="session_manager"):
+        SessionManager._run_steps(savepoint, self._savepoint_error_steps(e, savepoint, raise_error_types, raise_on_error, label))
+    
+    def _savepoint_error_steps(self, e: BaseException, savepoint, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, label: str):
+        if logging.root.isEnabledFor(logging.INFO):
+            logging.info("rolling back savepoint...")
+        if savepoint.is_active:
+            yield "rollback"
+            if self._instruments:
+                self._increment("rollbacks", label)
+        
+        self._raise_or_log(e, raise_error_types, raise_on_error, label)
+    
+    def _raise_or_log(self, e: BaseException, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, label: str):
+        """
+        Raises the exception if requested by raise_error_types or raise_on_error, otherwise prints its stack trace.
+        """
+        
+        if (raise_error_types and isinstance(e, raise_error_types)) or raise_on_error:
+            if self._instruments:
+                self._increment("errors_raised", label)
+            raise e
+        
+        if self._instruments:
+            self._increment("errors_swallowed", label)
+                
+        # print the stack trace
+        import traceback
+        traceback.print_exc()
+            
+    def _create_session(self, verbose: int = logging.ERROR, read_only: bool = False, group_commit: Union[GroupCommitter, None] = None, explicit_read_only: bool = False) -> Session:
+        
+        # the level is checked once, the messages are not built when they are not emitted
+        log_info: bool = logging.root.isEnabledFor(logging.INFO)
+        
+        if not self.session_maker:
+            raise ValueError("session_maker is not set.")
+        else:
+            if log_info:
+                logging.info("session_maker is set.")
+            
+        if log_info:
+            logging.info("session not provided, creating one...")
+        if group_commit is not None:
+            # the session commits and rolls back a savepoint of the shared transaction
+            session: Union[Session | None] = self.session_maker(bind=group_commit.connection, join_transaction_mode="create_savepoint")
+            session.info["session_manager_group_commit"] = group_commit
+        elif self._router is None:
+            if explicit_read_only and self._sqlite_read_engine is not None:
+                session: Union[Session | None] = self.session_maker(bind=self._sqlite_read_engine)
+                # the read engine is query only, a read-write block must not join its sessions
+                session.info["session_manager_replica"] = True
+            elif read_only and self._sqlite_deferred_engine is not None:
+                # a session read-only by default may still write, it stays on the engine
+                session: Union[Session | None] = self.session_maker(bind=self._sqlite_deferred_engine)
+            else:
+                session: Union[Session | None] = self.session_maker()
+        else:
+            session: Union[Session | None] = self._routed_session(self._router.acquire(read_only))
+        if log_info:
+            logging.info("session created...")
+        
+        return session
+    
+    def _routed_session(self, engine):
+        session = self.session_maker(bind=engine)
+        session.info["session_manager_engine"] = engine
+        session.info["session_manager_replica"] = engine is not self._router.primary
+        session.info["session_manager_primary"] = self._router.primary
+        return session
+    
+    def _connect_replica(self, session: Session) -> Session:
+        # connected before the session is returned, a replica refusing the connection fails here and not in the caller's block
+        try:
+            session.connection()
+        except DBAPIError:
+            engine = session.info["session_manager_engine"]
+            session.close()
+            logging.warning("connecting to replica %s failed, using the primary...", engine.url)
+            return self._routed_session(self._router.fall_back(engine))
+        return session
 
-class SessionManager:
-    def __init__(self, engine: _SessionBind):
-        self.engine = engine
-        self.session_maker = sessionmaker(bind=engine)
 
-    def __init__(self, session_maker: sessionmaker):
-        self.engine = None
-        self.session_maker = session_maker
 
+class AsyncSessionManager(SessionManager):
+    """
+    asyncio counterpart of SessionManager, built on async_sessionmaker and AsyncSession.
+    
+    The commit, rollback, reload and raise decisions are the ones of SessionManager: both managers run the same steps, see _cleanup_steps,
+    the async one awaiting their operations.
+    It requires the asyncio extension of SQLAlchemy, installed with sqlalchemy[asyncio].
+    """
+    
     def __init__(self):
-        self.session_maker = None
-
-    def set_engine(self, engine: _SessionBind):
+        if async_sessionmaker is None:
+            raise ImportError("AsyncSessionManager requires the asyncio extension of SQLAlchemy, install sqlalchemy[asyncio].")
+        super().__init__()
+    
+    def set_engine(self, engine: AsyncEngine, sqlite_profile: Union[SQLiteProfile, str, None]=None, sqlite_read_profile: Union[SQLiteProfile, str, None]=None, warm_connections: int=0):
         self.engine = engine
-        self.session_maker = sessionmaker(bind=engine)
+        self.session_maker = async_sessionmaker(bind=engine)
+        self._register_session_events()
+        self._set_sqlite_profiles(engine, sqlite_profile, sqlite_read_profile)
+        self._start_up(engine, warm_connections)
 
-    def set_session_maker(self, session_maker: sessionmaker):
+    def set_session_maker(self, session_maker: async_sessionmaker):
         self.engine = None
         self.session_maker = session_maker
+        self._register_session_events()
+        self._set_sqlite_profiles(None, None, None)
+        self._start_up(self._bound_engine(), 0)
+    
+    async def sqlite_pragmas(self, read_only: bool=False) -> dict:
+        engine = self._sqlite_read_engine if read_only and self._sqlite_read_engine is not None else self._bound_engine()
+        if engine is None or engine.dialect.name != "sqlite":
+            raise ValueError("sqlite_pragmas requires a SQLite engine bound to the session_maker.")
         
-    @contextmanager
-    def session_manager(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[BaseException, tuple[BaseException]]=None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR):
+        async with engine.connect() as connection:
+            raw_connection = await connection.get_raw_connection()
+            # the cursor of the adapted driver connection runs in the greenlet of the connection
+            pragmas: dict = await connection.run_sync(lambda sync_connection: _read_sqlite_pragmas(raw_connection))
+        
+        if engine.sync_engine in _sqlite_profiled_engines:
+            pragmas["begin"] = _sqlite_profiled_engines[engine.sync_engine][0].begin
+        return pragmas
+    
+    async def ensure_schema(self, metadata: MetaData, name: str="default") -> bool:
+        engine = self._bound_engine()
+        if engine is None:
+            raise ValueError("ensure_schema requires an engine bound to the session_maker.")
+        
+        start_time: float = time.perf_counter()
+        async with engine.begin() as connection:
+            created: bool = await connection.run_sync(_ensure_schema, metadata, name)
+        self._startup["schema_created"] = created
+        self._startup["schema_seconds"] = time.perf_counter() - start_time
+        return created
+    
+    async def wait_for_warm_up(self, timeout: Union[float, None]=None) -> bool:
+        warm_up = self._warm_up
+        if warm_up is None:
+            return True
+        done, _ = await asyncio.wait({warm_up}, timeout=timeout)
+        return bool(done)
+    
+    def _start_warm_up(self, plan: list[tuple], stats: dict):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if stats["warm_connections"]:
+                raise RuntimeError("the connections of an AsyncEngine are warmed up on the event loop, call set_engine from a coroutine.") from None
+            # the compilation alone does not need the loop
+            for engine, _ in plan:
+                stats["compiled_statements"] += _warm_statements(engine, list(self._hot_statements))
+            stats["warm_up_seconds"] = time.perf_counter() - self._started_at
+            return None
+        return loop.create_task(self._run_warm_up(plan, stats, self._started_at))
+    
+    async def _run_warm_up(self, plan: list[tuple], stats: dict, started_at: float):
+        connections: list = []
+        try:
+            for engine, _ in plan:
+                compiled: Union[int, None] = _compile_statements(engine, list(self._hot_statements))
+                if compiled is None:
+                    async with engine.connect() as connection:
+                        compiled = await connection.run_sync(_execute_statements, list(self._hot_statements))
+                stats["compiled_statements"] += compiled
+            for engine, count in plan:
+                for _ in range(count):
+                    connections.append(await engine.connect())
+                    # the pool checks out its connection on the first use
+                    await connections[-1].get_raw_connection()
+                    stats["opened_connections"] += 1
+        except Exception as e:
+            stats["warm_up_error"] = repr(e)
+            logging.warning("warming up the engine failed: %r", e)
+        finally:
+            for connection in connections:
+                await connection.close()
+        stats["warm_up_seconds"] = time.perf_counter() - started_at
+        logging.info("engine warmed up in %.3fs: %d connections, %d statements...", stats["warm_up_seconds"], stats["opened_connections"], stats["compiled_statements"])
+    
+    def write_buffer(self, max_batch_size: int=500, max_delay: float=0.05, max_pending: Union[int, None]=None) -> WriteBuffer:
+        raise NotImplementedError("the write buffer flushes from a thread and requires a synchronous SessionManager.")
+    
+    def enable_group_commit(self, interval: float=0.005):
+        raise NotImplementedError("group commit shares a connection between threads and requires a synchronous SessionManager.")
+    
+    def set_admission_control(self, max_sessions: Union[int, None], max_queue: Union[int, None]=None, timeout: Union[float, None]=None) -> Union[AdmissionController, None]:
+        raise NotImplementedError("the admission control makes the waiting sessions block their thread and requires a synchronous SessionManager.")
+    
+    def parallel_map(self, func: Callable, items, chunk_size: int=100, processes: Union[int, None]=None, ordered: bool=True, auto_commit: bool=False, return_exceptions: bool=False, engine_options: Union[dict, None]=None, mp_context=None):
+        raise NotImplementedError("parallel_map builds synchronous engines in the workers and requires a synchronous SessionManager.")
+    
+    def _event_target(self):
+        # async_sessionmaker is not an event target, the listeners are registered on the class of the sync sessions it creates,
+        # a subclass made once for the session maker as sessionmaker does
+        sync_session_class: type = self.session_maker.kw.get("sync_session_class") or Session
+        if not sync_session_class.__dict__.get("_session_manager_events", False):
+            sync_session_class = type(sync_session_class.__name__, (sync_session_class,), {"_session_manager_events": True})
+            self.session_maker.configure(sync_session_class=sync_session_class)
+        return sync_session_class
+    
+    async def cached_execute(self, session: AsyncSession, statement) -> list[tuple]:
+        if self._result_cache is None:
+            return [tuple(row) for row in await session.execute(statement)]
+        return await session.run_sync(self._result_cache.execute, statement)
+    
+    async def upsert(self, model, rows, conflict_columns: Union[list[str], None]=None, update_columns: Union[list[str], None]=None, on_conflict: str="update", chunk_size: Union[int, None]=None, session: Union[AsyncSession, None]=None) -> dict[str, int]:
+        if session is not None:
+            return await session.run_sync(SessionManager._upsert_rows, model, rows, conflict_columns, update_columns, on_conflict, chunk_size)
+        
+        async with self.session_manager(auto_commit=True, reload_after_commit=False, raise_on_error=True, read_only=False) as session:
+            return await session.run_sync(SessionManager._upsert_rows, model, rows, conflict_columns, update_columns, on_conflict, chunk_size)
+    
+    async def cached_get(self, session: AsyncSession, cls, primary_key):
+        if self._entity_cache is None:
+            return await session.get(cls, primary_key)
+        return await session.run_sync(self._entity_cache.get, cls, primary_key)
+    
+    def session_manager(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[BaseException, tuple[BaseException]]=None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR, propagation: Propagation=Propagation.REQUIRED, read_only: Union[bool, None]=None, loader_profile: Union[LoaderProfile, str, None]=None, policy: Union[SessionPolicy, None]=None):
         """
-        Context manager to manage the session for the database operations.
-
-        If a session is provided as a parameter, it will be used. Otherwise, a new session will be created and closed after the function is called.
+        Async context manager to manage the session for the database operations.
 
         args:
-            auto_commit (bool): If True, the session will be committed after the function is called and all the attributes of the session. Defaults to False.
-            reload_after_commit (bool): If True, all the objects in the session will be reloaded after the commit. Defaults to auto_commit. If auto_commit is False, this parameter is ignored.
+            auto_commit (bool): If True, the session will be committed after the block is executed. Defaults to False.
+            reload_after_commit (bool): If True, the objects written in the session will be reloaded after the commit. Defaults to auto_commit. If auto_commit is False, this parameter is ignored.
             raise_error_types (Union[Exception, tuple[Exception]]): If an exception of this type is raised, the error will be raised after the session is rolled back. Defaults to None.
             raise_on_error (bool): If True, the exception will be raised after the session is rolled back. Defaults to False.
             verbose (Union[int, bool]): If True, the logging level will be set to logging.INFO. If False, the logging level will be set to logging.ERROR. If an int, the logging level will be set to that value. Defaults to logging.ERROR.
-
-
-        This context manager is used to manage the session for the database operations.
-        
-        This function can be used as a context manager to manage the session for the database operations.
+            propagation (Propagation): How to behave when a managed session is already open in the current context. Defaults to Propagation.REQUIRED, joining it.
+            read_only (bool): If True, the session is routed to a replica when replicas are set, see set_replicas, or to the read engine of a SQLite profile, see set_engine. Defaults to not auto_commit.
+            loader_profile (Union[LoaderProfile, str]): Loader options added to the ORM selects of the block, or the name of a registered profile. Defaults to None.
+            policy (SessionPolicy): Settings resolved beforehand, replacing all the other args. Defaults to None.
         
         For example:
         
-        with session_manager(auto_commit=True) as session:
+        async with session_manager(auto_commit=True) as session:
             # perform database operations using the session
             ...
         """
         
-        if not reload_after_commit:
+        if policy is not None:
+            return self._session_scope(policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose, policy.propagation, label="session_manager", read_only=policy.read_only, loader_profile=self._resolve_loader_profile(policy.loader_profile), explicit_read_only=policy._explicit_read_only)
+        
+        explicit_read_only: bool = read_only is True
+        if reload_after_commit is None:
             reload_after_commit = auto_commit
+        
+        if read_only is None:
+            read_only = not auto_commit
 
         # Set up logging
         if isinstance(verbose, bool):
@@ -67,164 +3596,357 @@ class SessionManager:
 
         logging.info("session management called...")
         
-        session: Union[Session | None] = self._create_session(verbose=verbose)
-
-        try:
-            yield session
-        
-        except BaseException as e: 
-            self._error_handler(e, session, raise_error_types, raise_on_error, verbose)
-        
-        finally:
-            self._cleanup_session(session, auto_commit, reload_after_commit, verbose)
+        return self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label="session_manager", read_only=read_only, loader_profile=self._resolve_loader_profile(loader_profile), explicit_read_only=explicit_read_only)
 
-
-    def session_management(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[Exception, tuple[Exception], None]= None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR):
+    def session_management(self, auto_commit: bool=False, reload_after_commit: bool=None, raise_error_types: Union[Exception, tuple[Exception], None]= None, raise_on_error: bool=False, verbose: Union[int, bool]=logging.ERROR, propagation: Propagation=Propagation.REQUIRED, yield_per: int=1000, retry: Union[RetryPolicy, None]=None, read_only: Union[bool, None]=None, snapshot: Union[bool, list[str]]=False, loader_profile: Union[LoaderProfile, str, None]=None, policy: Union[SessionPolicy, None]=None):
         """
-        Decorator to manage the session for the database operations.
-
-        If a session is provided as a parameter, it will be used. Otherwise, a new session will be created and closed after the function is called.
-
-        args:
-            auto_commit (bool): If True, the session will be committed after the function is called and all the attributes of the session. Defaults to False.
-            reload_after_commit (bool): If True, all the objects in the session will be reloaded after the commit. Defaults to auto_commit. If auto_commit is False, this parameter is ignored.
-            raise_error_types (Union[Exception, tuple[Exception]]): If an exception of this type is raised, the error will be raised after the session is rolled back. Defaults to None.
-            raise_on_error (bool): If True, the exception will be raised after the session is rolled back. Defaults to False.
-            verbose (Union[int, bool]): If True, the logging level will be set to logging.INFO. If False, the logging level will be set to logging.ERROR. If an int, the logging level will be set to that value. Defaults to logging.ERROR.
-
-
-        This decorator is used to manage the session for the database operations.
+        Decorator to manage the session for the database operations of a coroutine function.
 
         Add to the parameters of the function to be decorated a parameter called session with a default value of None.
 
-        The function will be called with the session as a parameter, and the session will be closed after the function is called.
+        The coroutine will be awaited with the session as a parameter, and the session will be closed after it returns.
+        
+        If the function is an async generator, the session is kept open until the generator is exhausted or closed,
+        and the queries executed with session.stream() or session.stream_scalars() fetch the rows in batches of yield_per.
+        
+        With a retry policy, the coroutine is awaited again in a new session when it fails with a transient error.
+        
+        With snapshot, the value returned by the coroutine is converted by make_snapshot before the session is closed.
+        
+        With a loader_profile, the ORM selects of the coroutine get the loader options of the profile, see LoaderProfile.
 
-        If the function raises an exception, the session will be rolled back and closed.
+        args are the same as the ones of session_manager.
         """
         
-        if not reload_after_commit:
-            reload_after_commit = auto_commit
-
-        # Set up logging
-        if isinstance(verbose, bool):
-            verbose: int = logging.INFO if verbose else logging.ERROR
-        else:
-            verbose: int = verbose
-
-        logging.basicConfig(level=verbose)
+        if policy is None:
+            policy = SessionPolicy(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, read_only, retry, yield_per, snapshot=snapshot, loader_profile=loader_profile)
+        
+        auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose = policy.auto_commit, policy.reload_after_commit, policy.raise_error_types, policy.raise_on_error, policy.verbose
+        propagation, read_only, retry, yield_per, snapshot, loader_profile = policy.propagation, policy.read_only, policy.retry, policy.yield_per, policy.snapshot, policy.loader_profile
+        explicit_read_only: bool = policy._explicit_read_only
 
         def decorator(func):
+            if pyinspect.isasyncgenfunction(func):
+                @wraps(func)
+                async def stream_wrapper(*args, **kwargs):
+                    logging.info("session management called...")
+                    
+                    if "session" in kwargs and kwargs["session"]:
+                        logging.info("session provided...")
+                        async for item in func(*args, **kwargs):
+                            yield item
+                        return
+                    
+                    async with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, yield_per, func.__qualname__, read_only=read_only, loader_profile=self._resolve_loader_profile(loader_profile), explicit_read_only=explicit_read_only) as session:
+                        kwargs["session"] = session
+                        stream = func(*args, **kwargs)
+                        try:
+                            async for item in stream:
+                                yield item
+                        except GeneratorExit:
+                            logging.info("stream closed...")
+                        finally:
+                            await stream.aclose()
+                
+                return stream_wrapper
+            
+            if not pyinspect.iscoroutinefunction(func):
+                raise TypeError(f"{func.__qualname__} is neither a coroutine function nor an async generator function.")
+            
+            if snapshot:
+                func = self._snapshot_results(func, None if snapshot is True else list(snapshot))
+            
             @wraps(func)
-            def wrapper(*args, **kwargs):
+            async def wrapper(*args, **kwargs):
                 logging.info("session management called...")
                 
                 if "session" in kwargs and kwargs["session"]:
                     logging.info("session provided...")
-                    return func(*args, **kwargs)
+                    return await func(*args, **kwargs)
                 
-                session: Session = self._create_session(verbose=verbose)
-
-                try:
+                if retry is not None and not self._joins_ambient_session(propagation, read_only, auto_commit):
+                    return await self._call_with_retry(retry, func, args, kwargs, auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, read_only, self._resolve_loader_profile(loader_profile), explicit_read_only)
+                
+                async with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label=func.__qualname__, read_only=read_only, loader_profile=self._resolve_loader_profile(loader_profile), explicit_read_only=explicit_read_only) as session:
                     kwargs["session"] = session
-                    result = func(*args, **kwargs)
+                    result = await func(*args, **kwargs)
                     return result
-                
-                
-                except BaseException as e:
-                    self._error_handler(e, session, raise_error_types, raise_on_error, verbose)
-                    
-                finally:
-                    self._cleanup_session(session, auto_commit, reload_after_commit, verbose)
-                        
-                        
 
             return wrapper
 
         return decorator
     
-    @staticmethod
-    def _cleanup_session(session: Session, auto_commit: bool=False, reload_after_commit: bool=None, verbose: int=logging.ERROR):
+    @asynccontextmanager
+    async def _session_scope(self, auto_commit: bool, reload_after_commit: bool, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, verbose: int, propagation: Propagation, yield_per: Union[int, None]=None, label: str="session_manager", retryable: Union[Callable[[BaseException], bool], None]=None, read_only: bool=False, loader_profile: Union[LoaderProfile, None]=None, explicit_read_only: bool=False):
         """
-        Cleans up the session after the function is called.
+        Opens, joins or nests the managed session according to the propagation mode.
+        A read-write block never joins a session bound to a replica, it opens its own session on the primary,
+        and a block with auto_commit never joins a session that does not commit, it opens its own session.
+        
+        If yield_per is set the session is opened for a stream: its streamed queries are executed with yield_per and it is not published as the ambient session.
+        A block joining a session with a loader_profile applies it until the block ends.
+        A block joining a session without raise_on_error runs in a savepoint, see Propagation.REQUIRED.
         """
         
-        logging.basicConfig(level=verbose)
+        ambient: Union[AsyncSession, None] = self._joinable_ambient_session(read_only, auto_commit)
         
-        if not session or not session.is_active:
-            logging.warning("session is None or inactive!")
+        if ambient is not None and propagation is Propagation.REQUIRED and raise_on_error:
+            logging.info("joining ambient session...")
+            with self._use_loader_profile(ambient, loader_profile):
+                yield ambient
             return
-            
-        if auto_commit:
+        
+        # a joined block swallowing its errors must not roll back the changes of the outer block
+        if ambient is not None and propagation is not Propagation.REQUIRES_NEW:
+            logging.info("opening savepoint on ambient session...")
+            if ambient.get_bind().dialect.name == "sqlite":
+                await ambient.run_sync(_begin_sqlite_transaction)
+            savepoint = await ambient.begin_nested()
             try:
-                logging.info("committing session...")
-                try:
-                    session.commit()
-                except IntegrityError:
-                    logging.info("rolling back session...")
-                    
-                    import traceback
-                    exception_str = traceback.format_exc()
-                    logging.error(exception_str)
-                    
-                    session.rollback()
-                    session.close()
-                    
-                logging.info("committed!")
-                # reload all the objects
-                if reload_after_commit:
-                    logging.info("reloading objects...")
-                    start_time = time.time()
-                    for obj in session:
-                        session.refresh(obj)
-                    end_time = time.time()
-                    logging.info("reloaded in %d ms!", (end_time - start_time) * 1000)
-            except InvalidRequestError:
-                pass
-        else:
-            if reload_after_commit:
-                logging.warning("reload_after_commit is set to True, but auto_commit is set to False. Ignoring reload_after_commit.")
+                with self._use_loader_profile(ambient, loader_profile):
+                    yield ambient
+            except BaseException as e:
+                await self._savepoint_error_handler(e, savepoint, raise_error_types, raise_on_error, verbose, label)
+            else:
+                if savepoint.is_active:
+                    await savepoint.commit()
+            return
         
+        instrumented: bool = bool(self._instruments)
+        if instrumented:
+            start_time = time.perf_counter()
         
-        if session.is_active:
+        session: AsyncSession = self._create_session(verbose=verbose, read_only=read_only, explicit_read_only=explicit_read_only)
+        if self._router is not None and session.info.get("session_manager_replica"):
+            session = await self._connect_replica(session)
+        token, profile_token = self._open_session_scope(session, auto_commit, reload_after_commit, yield_per, loader_profile, label)
+        
+        if instrumented:
+            body_start_time = time.perf_counter()
+            self._observe("create", label, body_start_time - start_time)
+
+        try:
+            yield session
+        
+        except BaseException as e: 
+            if instrumented:
+                self._observe("body", label, time.perf_counter() - body_start_time)
+            await self._error_handler(e, session, raise_error_types, raise_on_error, verbose, label, retryable)
+        
+        else:
+            if instrumented:
+                self._observe("body", label, time.perf_counter() - body_start_time)
+        
+        finally:
             try:
-                logging.info("closing session...")
-                session.close()
-                logging.info("closed!")
-                pass
-                
-            except InvalidRequestError:
-                logging.info("already closed!")
-                pass
+                await self._cleanup_session(session, auto_commit, reload_after_commit, verbose, self.reload_chunk_size, label)
+            finally:
+                self._close_session_scope(session, token, profile_token)
     
-    @staticmethod    
-    def _error_handler(e: BaseException, session: Session, raise_error_types: Union[BaseException, tuple[BaseException], None]=None, raise_on_error: bool=False, verbose: int=logging.ERROR):
-        logging.basicConfig(level=verbose)
+    async def _call_with_retry(self, retry: RetryPolicy, func, args: tuple, kwargs: dict, auto_commit: bool, reload_after_commit: bool, raise_error_types: Union[BaseException, tuple[BaseException], None], raise_on_error: bool, verbose: int, propagation: Propagation, read_only: bool=False, loader_profile: Union[LoaderProfile, None]=None, explicit_read_only: bool=False):
+        """
+        Awaits the coroutine in a managed session, again in a new session every time it fails with an error classified as transient by the retry policy.
+        """
         
-        logging.info("rolling back session...")
-        session.rollback()
-        session.close()
-                    
-        if raise_error_types and isinstance(e, raise_error_types):
-            raise e
-                
-        if raise_on_error:
-            raise e
-                
-        # print the stack trace
-        import traceback
-        traceback.print_exc()
+        label: str = func.__qualname__
+        started: float = time.monotonic()
+        retry._count(calls=1)
+        
+        for attempt in itertools.count(1):
+            retry._count(attempts=1)
+            result = None
+            try:
+                async with self._session_scope(auto_commit, reload_after_commit, raise_error_types, raise_on_error, verbose, propagation, label=label, retryable=retry.classifier, read_only=read_only, loader_profile=loader_profile, explicit_read_only=explicit_read_only) as session:
+                    kwargs["session"] = session
+                    result = await func(*args, **kwargs)
+                return result
             
-    def _create_session(self, verbose: int = logging.ERROR) -> Session:
+            except BaseException as e:
+                if not retry.classifier(e):
+                    raise
+                
+                delay = self._retry_delay(retry, e, attempt, started, label, raise_error_types, raise_on_error)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+    
+    async def _cleanup_session(self, session: AsyncSession, auto_commit: bool=False, reload_after_commit: bool=None, verbose: int=logging.ERROR, reload_chunk_size: int=SessionManager.reload_chunk_size, label: str="session_manager"):
+        await AsyncSessionManager._run_steps(session, self._cleanup_steps(session, auto_commit, reload_after_commit, reload_chunk_size, label))
+    
+    async def _error_handler(self, e: BaseException, session: AsyncSession, raise_error_types: Union[BaseException, tuple[BaseException], None]=None, raise_on_error: bool=False, verbose: int=logging.ERROR, label: str="session_manager", retryable: Union[Callable[[BaseException], bool], None]=None):
+        await AsyncSessionManager._run_steps(session, self._error_steps(e, raise_error_types, raise_on_error, label, retryable))
+    
+    async def _savepoint_error_handler(self, e: BaseException, savepoint, raise_error_types: Union[BaseException, tuple[BaseException], None]=None, raise_on_error: bool=False, verbose: int=logging.ERROR, label: str="session_manager"):
+        await AsyncSessionManager._run_steps(savepoint, self._savepoint_error_steps(e, savepoint, raise_error_types, raise_on_error, label))
+    
+    @staticmethod
+    async def _run_steps(target, steps):
+        # the operations are awaited, the functions of the sync session run in its greenlet
+        send, throw = steps.send, steps.throw
+        result = error = None
+        while True:
+            try:
+                step = send(result) if error is None else throw(error)
+            except StopIteration:
+                return
+            result = error = None
+            try:
+                result = await target.run_sync(step) if callable(step) else await getattr(target, step)()
+            except BaseException as e:
+                error = e
+    
+    @staticmethod
+    def _snapshot_results(func, columns: Union[list[str], None]):
+        @wraps(func)
+        async def snapshot_wrapper(*args, **kwargs):
+            result = await func(*args, **kwargs)
+            await kwargs["session"].flush()
+            # in the greenlet of the session, the requested columns not loaded yet can be loaded
+            return await kwargs["session"].run_sync(lambda session: make_snapshot(result, columns))
+        return snapshot_wrapper
+    
+    @staticmethod
+    def _apply_yield_per(orm_execute_state):
+        # AsyncSession.execute() buffers the whole result, only the streamed queries can use yield_per
+        if orm_execute_state.execution_options.get("stream_results"):
+            SessionManager._apply_yield_per(orm_execute_state)
+    
+    async def _connect_replica(self, session: AsyncSession) -> AsyncSession:
+        try:
+            await session.connection()
+        except DBAPIError:
+            engine = session.info["session_manager_engine"]
+            await session.close()
+            logging.warning("connecting to replica %s failed, using the primary...", engine.url)
+            return self._routed_session(self._router.fall_back(engine))
+        return session
+
+
+
+class ShardResult:
+    """
+    Outcome of a fan_out call on one SessionManager.
+    
+    attributes:
+        manager (SessionManager): The manager of the shard.
+        result: The return value of the function, None if it failed.
+        error (BaseException): The error of the function or of the commit, None if it succeeded.
+        committed (bool): True if the changes of the shard are committed.
+        seconds (float): Time spent on the shard, commit included.
+    """
+    
+    __slots__ = ("manager", "result", "error", "committed", "seconds")
+    
+    def __init__(self, manager: SessionManager, result=None, error: Union[BaseException, None]=None, committed: bool=False, seconds: float=0.0):
+        self.manager: SessionManager = manager
+        self.result = result
+        self.error: Union[BaseException, None] = error
+        self.committed: bool = committed
+        self.seconds: float = seconds
+    
+    def __repr__(self) -> str:
+        return f"ShardResult(result={self.result!r}, error={self.error!r}, committed={self.committed}, seconds={self.seconds:.3f})"
+
+
+def fan_out(managers: list, func: Callable, *args, max_workers: Union[int, None]=None, auto_commit: bool=True, atomic: bool=False, **kwargs) -> list[ShardResult]:
+    """
+    Runs the same unit of work on several databases concurrently, in a bounded pool of threads.
+    
+    The function is called as func(*args, session=session, **kwargs) in a new session of every manager.
+    
+    args:
+        managers (list[SessionManager]): The managers of the databases.
+        func (Callable): The unit of work.
+        max_workers (int): Maximum number of shards processed at the same time. Defaults to the number of managers.
+        auto_commit (bool): If True, the session of every shard is committed. Defaults to True.
+        atomic (bool): If True, the shards are committed all or nothing: with a two-phase commit when the dialects of all the
+            databases support it, otherwise by committing only once every shard has succeeded and flushed its changes,
+            in which case a failing commit cannot undo the commits already done. Defaults to False.
+    
+    returns:
+        list[ShardResult]: The result, error, commit status and timing of every shard, in the order of the managers.
+    
+    For example:
+    
+    results = fan_out([db1.SM, db2.SM], purge_sessions, older_than=cutoff)
+    """
+    
+    if not managers:
+        return []
+    
+    shards: list[ShardResult] = [ShardResult(manager) for manager in managers]
+    with ThreadPoolExecutor(max_workers or len(managers), thread_name_prefix="fan_out") as executor:
+        if not atomic:
+            list(executor.map(lambda shard: _fan_out_shard(shard, func, args, kwargs, auto_commit), shards))
+            return shards
         
-        logging.basicConfig(level=verbose)
+        two_phase = all(_supports_two_phase(shard.manager._bound_engine()) for shard in shards)
+        if not two_phase:
+            logging.warning("two-phase commit is not supported by every database, committing once every shard has flushed...")
         
-        if not self.session_maker:
-            raise ValueError("session_maker is not set.")
+        sessions: list = list(executor.map(lambda shard: _fan_out_prepare(shard, func, args, kwargs, two_phase), shards))
+        commit = all(shard.error is None for shard in shards)
+        list(executor.map(lambda pair: _fan_out_finish(pair[0], pair[1], commit), zip(shards, sessions)))
+    
+    return shards
+
+
+def _supports_two_phase(engine) -> bool:
+    if engine is None:
+        return False
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    return type(engine.dialect).do_prepare_twophase is not DefaultDialect.do_prepare_twophase
+
+
+def _fan_out_shard(shard: ShardResult, func: Callable, args: tuple, kwargs: dict, auto_commit: bool):
+    start_time = time.perf_counter()
+    try:
+        # committed in the block, so that a failing commit is raised instead of logged by _cleanup_session
+        with shard.manager.session_manager(raise_on_error=True, propagation=Propagation.REQUIRES_NEW, read_only=False) as session:
+            result = func(*args, session=session, **kwargs)
+            if auto_commit:
+                session.commit()
+        shard.result = result
+        shard.committed = auto_commit
+    except BaseException as e:
+        shard.error = e
+    shard.seconds = time.perf_counter() - start_time
+
+
+def _fan_out_prepare(shard: ShardResult, func: Callable, args: tuple, kwargs: dict, two_phase: bool) -> Union[Session, None]:
+    start_time = time.perf_counter()
+    session: Union[Session, None] = None
+    try:
+        session = shard.manager.session_maker(twophase=two_phase)
+        result = func(*args, session=session, **kwargs)
+        session.flush()
+        if two_phase:
+            session.prepare()
+        # set once the shard is prepared, the result of a failed shard is None
+        shard.result = result
+    except BaseException as e:
+        shard.error = e
+    shard.seconds = time.perf_counter() - start_time
+    return session
+
+
+def _fan_out_finish(shard: ShardResult, session: Union[Session, None], commit: bool):
+    if session is None:
+        return
+    
+    start_time = time.perf_counter()
+    try:
+        if commit:
+            session.commit()
+            shard.committed = True
         else:
-            logging.info("session_maker is set.")
-            
-        logging.info("session not provided, creating one...")
-        session: Union[Session | None] = self.session_maker()
-        logging.info("session created...")
-        
-        return session
+            session.rollback()
+    except BaseException as e:
+        logging.error("fan_out shard failed to %s: %s", "commit" if commit else "roll back", e)
+        shard.error = e
+        if commit:
+            shard.result = None
+    finally:
+        session.close()
+    shard.seconds += time.perf_counter() - start_time
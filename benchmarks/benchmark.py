@@ -0,0 +1,276 @@
+# Description: Benchmark of the overhead and throughput of SessionManager against the raw use of a Session, on in-memory and file-backed SQLite.
+#
+# Run from the root of the repository:
+#
+#   python benchmarks/benchmark.py --output results.json
+#   python benchmarks/benchmark.py --baseline results.json --threshold 0.15
+#
+# With --baseline the results are compared to a previous run, and the exit code is 1 if a timing regressed by more than the threshold.
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, create_engine, delete, select
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SessionManager import SessionManager
+
+
+Base = declarative_base()
+
+
+class BenchRow(Base):
+    __tablename__ = "bench_rows"
+    row_id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False)
+    amount = Column(Integer, nullable=False)
+
+
+def body_empty(session: Session):
+    pass
+
+
+def body_single_insert(session: Session):
+    session.add(BenchRow(name="row", amount=1))
+
+
+def body_bulk_insert(session: Session):
+    session.add_all([BenchRow(name="row", amount=i) for i in range(1000)])
+
+
+def body_read_only_query(session: Session):
+    return session.execute(select(BenchRow).limit(100)).scalars().all()
+
+
+# name: (body, auto_commit, reload_after_commit, share of the calls of a round, rows inserted before the scenario)
+SCENARIOS: dict = {
+    "empty_body": (body_empty, False, False, 1.0, 0),
+    "single_insert": (body_single_insert, True, False, 1.0, 0),
+    "insert_1k_rows": (body_bulk_insert, True, False, 0.02, 0),
+    "insert_1k_rows_reload": (body_bulk_insert, True, True, 0.02, 0),
+    "read_only_query": (body_read_only_query, False, False, 0.5, 1000),
+    "threaded_writers": (body_single_insert, True, False, 1.0, 0),
+}
+
+VARIANTS: tuple[str, ...] = ("raw", "session_manager", "session_management")
+
+DATABASES: tuple[str, ...] = ("memory", "file")
+
+
+def make_engine(database: str, directory: str):
+    if database == "memory":
+        # a single connection, the in-memory database lives as long as it
+        return create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    return create_engine(f"sqlite:///{os.path.join(directory, 'benchmark.db')}", connect_args={"timeout": 30})
+
+
+def make_call(variant: str, manager: SessionManager, session_maker: sessionmaker, body, auto_commit: bool, reload_after_commit: bool):
+    """
+    returns:
+        Callable[[], None]: One unit of work running body in a new session, the way the variant opens and closes it.
+    """
+
+    if variant == "raw":
+        def raw_call():
+            session = session_maker()
+            try:
+                body(session)
+                if auto_commit:
+                    session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+        return raw_call
+
+    if variant == "session_manager":
+        def session_manager_call():
+            with manager.session_manager(auto_commit=auto_commit, reload_after_commit=reload_after_commit, raise_on_error=True) as session:
+                body(session)
+        return session_manager_call
+
+    @manager.session_management(auto_commit=auto_commit, reload_after_commit=reload_after_commit, raise_on_error=True)
+    def session_management_call(session: Session=None):
+        body(session)
+    return session_management_call
+
+
+def time_round(call, calls: int, threads: int) -> float:
+    """
+    returns:
+        float: The wall-clock seconds taken by calls calls, split between threads threads.
+    """
+
+    if threads <= 1:
+        start_time = time.perf_counter()
+        for _ in range(calls):
+            call()
+        return time.perf_counter() - start_time
+
+    errors: list[BaseException] = []
+    barrier = threading.Barrier(threads + 1)
+
+    def writer(count: int):
+        barrier.wait()
+        try:
+            for _ in range(count):
+                call()
+        except BaseException as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=writer, args=(calls // threads + (1 if i < calls % threads else 0),)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start_time
+    if errors:
+        raise errors[0]
+    return seconds
+
+
+def run(databases: list[str], scenarios: list[str], calls: int, repeat: int, threads: int) -> dict:
+    results: list[dict] = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for database in databases:
+            engine = make_engine(database, directory)
+            Base.metadata.create_all(engine)
+            session_maker = sessionmaker(bind=engine)
+            manager = SessionManager()
+            manager.set_engine(engine)
+
+            for scenario in scenarios:
+                body, auto_commit, reload_after_commit, share, seed_rows = SCENARIOS[scenario]
+                scenario_threads = threads if scenario == "threaded_writers" else 1
+                if scenario == "threaded_writers" and database == "memory":
+                    # every thread would share the single connection of the in-memory database
+                    logging.warning("skipping threaded_writers on the in-memory database...")
+                    continue
+
+                scenario_calls = max(1, int(calls * share))
+                raw_median: float = None
+
+                for variant in VARIANTS:
+                    with session_maker.begin() as session:
+                        session.execute(delete(BenchRow))
+                        session.add_all([BenchRow(name="seed", amount=i) for i in range(seed_rows)])
+
+                    call = make_call(variant, manager, session_maker, body, auto_commit, reload_after_commit)
+                    # warm up the pool, the statement cache and the mappers
+                    time_round(call, max(1, scenario_calls // 10), scenario_threads)
+
+                    per_call: list[float] = [time_round(call, scenario_calls, scenario_threads) / scenario_calls for _ in range(repeat)]
+                    median: float = statistics.median(per_call)
+                    if variant == "raw":
+                        raw_median = median
+
+                    results.append({
+                        "database": database,
+                        "scenario": scenario,
+                        "variant": variant,
+                        "threads": scenario_threads,
+                        "calls": scenario_calls,
+                        "repeat": repeat,
+                        "seconds_per_call_median": median,
+                        "seconds_per_call_min": min(per_call),
+                        "calls_per_second": 1 / median if median else None,
+                        "overhead_vs_raw": median / raw_median - 1 if raw_median else None,
+                    })
+                    print(f"{database:6} {scenario:22} {variant:18} {median * 1e6:12.1f} us/call {1 / median:12.0f} calls/s", file=sys.stderr)
+
+            engine.dispose()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "calls": calls,
+            "repeat": repeat,
+            "threads": threads,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[dict]:
+    """
+    Compares the median time per call of the results found in both runs.
+
+    returns:
+        list[dict]: One entry per result in both runs, with the baseline and current medians, their relative change and whether it is a regression.
+    """
+
+    key = lambda result: (result["database"], result["scenario"], result["variant"])
+    baseline_results: dict = {key(result): result for result in baseline["results"]}
+
+    comparison: list[dict] = []
+    for result in current["results"]:
+        previous = baseline_results.get(key(result))
+        if previous is None:
+            continue
+        change: float = result["seconds_per_call_median"] / previous["seconds_per_call_median"] - 1
+        comparison.append({
+            "database": result["database"],
+            "scenario": result["scenario"],
+            "variant": result["variant"],
+            "baseline_seconds_per_call": previous["seconds_per_call_median"],
+            "current_seconds_per_call": result["seconds_per_call_median"],
+            "change": change,
+            "regression": change > threshold,
+        })
+    return comparison
+
+
+def main(argv: list[str]=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks SessionManager against the raw use of a Session on SQLite.")
+    parser.add_argument("--database", choices=DATABASES, action="append", help="database to run on, repeatable. Defaults to all of them.")
+    parser.add_argument("--scenario", choices=tuple(SCENARIOS), action="append", help="scenario to run, repeatable. Defaults to all of them.")
+    parser.add_argument("--calls", type=int, default=2000, help="calls per round of the cheapest scenarios, the heavy ones run a share of them. Defaults to 2000.")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds per measure, the median is reported. Defaults to 5.")
+    parser.add_argument("--threads", type=int, default=4, help="writer threads of the threaded_writers scenario. Defaults to 4.")
+    parser.add_argument("--output", help="file the JSON results are written to. Defaults to the standard output.")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown reported as a regression. Defaults to 0.10.")
+    args = parser.parse_args(argv)
+
+    report = run(args.database or list(DATABASES), args.scenario or list(SCENARIOS), args.calls, args.repeat, args.threads)
+
+    regressions: list[dict] = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        report["comparison"] = compare(report, baseline, args.threshold)
+        report["threshold"] = args.threshold
+        regressions = [entry for entry in report["comparison"] if entry["regression"]]
+        for entry in regressions:
+            print(f"regression: {entry['database']} {entry['scenario']} {entry['variant']} {entry['change']:+.1%}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
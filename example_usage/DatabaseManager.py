@@ -11,13 +11,14 @@ class DatabaseManager:
         self.engine = create_engine(database_uri, echo=True)
         self.metadata = MetaData()
         self.session_maker = sessionmaker(bind=self.engine)
-        self.create_tables()
         
         self.SM = SessionManager()
         self.SM.set_session_maker(self.session_maker)
+        self.create_tables()
 
     def create_tables(self):
-        Base.metadata.create_all(self.engine)
+        # create_all only runs when the tables of Base changed since the last start
+        self.SM.ensure_schema(Base.metadata)
         
         
     @property
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+from conftest import User, count_users
+from SessionManager import AdmissionRejected
+
+
+def hold_session(manager, entered: threading.Event, leave: threading.Event):
+    # keeps the only slot until leave is set
+    with manager.session_manager(raise_on_error=True):
+        entered.set()
+        leave.wait(5)
+
+
+def start_holder(manager):
+    entered, leave = threading.Event(), threading.Event()
+    thread = threading.Thread(target=hold_session, args=(manager, entered, leave))
+    thread.start()
+    assert entered.wait(5)
+    return thread, leave
+
+
+def test_session_over_the_limit_waits_for_a_slot(manager, engine):
+    manager.set_admission_control(1)
+    thread, leave = start_holder(manager)
+    
+    threading.Timer(0.05, leave.set).start()
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.add(User(name="a"))
+    thread.join(5)
+    
+    stats = manager.admission_stats()
+    assert stats["admitted"] == 2 and stats["queued"] == 1 and stats["active"] == 0
+    assert stats["wait_seconds"]["sum"] > 0
+    assert count_users(engine) == 1
+
+
+@pytest.mark.parametrize("max_queue, timeout, reason", [(0, None, "queue_full"), (None, 0.05, "timeout")])
+def test_session_is_refused_when_the_queue_is_full_or_the_wait_too_long(manager, max_queue, timeout, reason):
+    manager.set_admission_control(1, max_queue=max_queue)
+    thread, leave = start_holder(manager)
+    try:
+        with pytest.raises(AdmissionRejected) as rejected:
+            with manager.session_manager(raise_on_error=True, admission_timeout=timeout):
+                pass
+    finally:
+        leave.set()
+        thread.join(5)
+    
+    assert rejected.value.reason == reason
+    assert manager.admission_stats()["active"] == 0
+    with manager.session_manager(raise_on_error=True):
+        pass
+
+
+def test_waiting_sessions_are_admitted_by_priority(manager):
+    manager.set_admission_control(1)
+    thread, leave = start_holder(manager)
+    admitted = []
+    
+    def wait_for_slot(priority):
+        with manager.session_manager(raise_on_error=True, priority=priority):
+            admitted.append(priority)
+    
+    waiters = []
+    for priority in (0, 2, 1):
+        waiters.append(threading.Thread(target=wait_for_slot, args=(priority,)))
+        waiters[-1].start()
+        while manager.admission_stats()["waiting"] < len(waiters):
+            time.sleep(0.001)
+    leave.set()
+    for waiter in [thread] + waiters:
+        waiter.join(5)
+    
+    assert admitted == [2, 1, 0]
+
+
+def test_joined_block_does_not_take_a_slot(manager, engine):
+    manager.set_admission_control(1, timeout=1)
+    
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as outer:
+        with manager.session_manager(auto_commit=True, raise_on_error=True) as inner:
+            assert inner is outer
+            inner.add(User(name="a"))
+    
+    assert count_users(engine) == 1
@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+from sqlalchemy import inspect, select, update
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import selectinload
+
+from conftest import Item, User, count_users
+from SessionManager import AsyncSessionManager, LoaderProfile, RetryPolicy
+
+
+@pytest.fixture
+def run(database_url, engine):
+    # runs a coroutine taking a new AsyncSessionManager on the test database
+    def run(test, **manager_options):
+        async def main():
+            async_engine = create_async_engine(database_url.replace("sqlite://", "sqlite+aiosqlite://"))
+            manager = AsyncSessionManager()
+            manager.set_engine(async_engine)
+            try:
+                return await test(manager)
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(main())
+    return run
+
+
+async def add_user(manager, name="a", **options):
+    async with manager.session_manager(auto_commit=True, raise_on_error=True, **options) as session:
+        user = User(name=name, items=[Item()])
+        session.add(user)
+    return user
+
+
+def test_objects_are_reloaded_after_commit(run):
+    async def test(manager):
+        reloaded = await add_user(manager)
+        expired = await add_user(manager, reload_after_commit=False)
+        return inspect(reloaded).expired, inspect(expired).expired
+    
+    assert run(test) == (False, True)
+
+
+def test_loader_profile_applies_to_the_session(run):
+    async def test(manager):
+        await add_user(manager)
+        profile = LoaderProfile(selectinload(User.items), raise_on_lazy_load=True)
+        async with manager.session_manager(raise_on_error=True, loader_profile=profile) as session:
+            user = (await session.scalars(select(User))).one()
+            assert len(user.items) == 1
+            session.expunge_all()
+            item = (await session.scalars(select(Item))).one()
+            with pytest.raises(InvalidRequestError):
+                await session.run_sync(lambda sync_session: item.user)
+    
+    run(test)
+
+
+def test_entity_cache_is_invalidated_by_committed_writes(run):
+    async def test(manager):
+        user_id = (await add_user(manager)).id
+        manager.enable_entity_cache()
+        for _ in range(2):
+            async with manager.session_manager(raise_on_error=True) as session:
+                assert (await manager.cached_get(session, User, user_id)).name == "a"
+        async with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+            await session.execute(update(User).values(name="b"))
+        async with manager.session_manager(raise_on_error=True) as session:
+            assert (await manager.cached_get(session, User, user_id)).name == "b"
+        return manager.entity_cache_stats()["User"]
+    
+    stats = run(test)
+    assert stats["hits"] == 1 and stats["invalidations"] >= 1
+
+
+def test_listeners_are_registered_on_the_session_maker_only(run):
+    async def test(manager):
+        other_maker = async_sessionmaker(bind=manager.engine)
+        async with other_maker() as session:
+            session.add(User(name="a"))
+            await session.flush()
+            assert "session_manager_written" not in session.info
+        async with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+            return type(session.sync_session) is manager._event_target()
+    
+    assert run(test)
+
+
+class TransientError(Exception):
+    pass
+
+
+def test_transient_error_is_retried_in_a_new_session(run, engine):
+    retry = RetryPolicy(max_attempts=3, base_delay=0, classifier=lambda e: isinstance(e, TransientError))
+    attempts = []
+    
+    async def test(manager):
+        @manager.session_management(auto_commit=True, raise_on_error=True, retry=retry)
+        async def write(session):
+            attempts.append(session)
+            session.add(User(name=str(len(attempts))))
+            await session.flush()
+            if len(attempts) < 3:
+                raise TransientError()
+            return len(attempts)
+        return await write()
+    
+    assert run(test) == 3
+    assert len(set(map(id, attempts))) == 3
+    assert retry.stats()["retries"] == 2
+    assert count_users(engine) == 1
+
+
+def test_error_is_swallowed_or_raised_after_rollback(run, engine):
+    async def test(manager):
+        @manager.session_management(auto_commit=True)
+        async def swallowed(session):
+            session.add(User(name="a"))
+            await session.flush()
+            raise ValueError("swallowed")
+        
+        @manager.session_management(auto_commit=True, raise_error_types=ValueError)
+        async def raised(session):
+            session.add(User(name="b"))
+            raise ValueError("raised")
+        
+        assert await swallowed() is None
+        with pytest.raises(ValueError, match="raised"):
+            await raised()
+    
+    run(test)
+    assert count_users(engine) == 0
+
+
+def test_integrity_error_on_commit_is_rolled_back(run, engine):
+    async def test(manager):
+        await add_user(manager)
+        async with manager.session_manager(auto_commit=True) as session:
+            session.add(User(id=1, name="duplicate"))
+        async with manager.session_manager(raise_on_error=True) as session:
+            return (await session.scalars(select(User.name))).all()
+    
+    assert run(test) == ["a"]
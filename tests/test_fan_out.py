@@ -0,0 +1,96 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+
+from conftest import Base, User, count_users
+import SessionManager as SessionManager_module
+from SessionManager import SessionManager, fan_out
+
+
+@pytest.fixture
+def shards(tmp_path):
+    engines = [create_engine(f"sqlite:///{tmp_path / f'shard{index}.db'}") for index in range(2)]
+    managers = []
+    for engine in engines:
+        Base.metadata.create_all(engine)
+        manager = SessionManager()
+        manager.set_engine(engine)
+        managers.append(manager)
+    yield managers, engines
+    for engine in engines:
+        engine.dispose()
+
+
+def add_user(user_id, session):
+    session.add(User(id=user_id, name="a"))
+    return user_id
+
+
+def test_atomic_fan_out_commits_every_shard(shards):
+    managers, engines = shards
+    
+    results = fan_out(managers, add_user, 1, atomic=True)
+    
+    assert [(shard.result, shard.error, shard.committed) for shard in results] == [(1, None, True), (1, None, True)]
+    assert [count_users(engine) for engine in engines] == [1, 1]
+
+
+def test_atomic_fan_out_reports_no_result_for_a_shard_failing_to_flush(shards):
+    managers, engines = shards
+    fan_out(managers[1:], add_user, 1)
+    
+    results = fan_out(managers, add_user, 1, atomic=True)
+    
+    assert results[0].result == 1 and results[0].error is None and not results[0].committed
+    assert results[1].result is None and isinstance(results[1].error, IntegrityError) and not results[1].committed
+    assert [count_users(engine) for engine in engines] == [0, 1]
+
+
+def test_fan_out_reports_no_result_for_a_shard_failing_to_commit(shards):
+    managers, engines = shards
+    fan_out(managers[1:], add_user, 1)
+    
+    results = fan_out(managers, add_user, 1)
+    
+    assert results[0].result == 1 and results[0].committed
+    assert results[1].result is None and isinstance(results[1].error, IntegrityError)
+
+
+@pytest.fixture
+def two_phase(shards, monkeypatch):
+    # SQLite has no two-phase commit, its transactions stand in for the prepared ones
+    managers, engines = shards
+    prepared = []
+    monkeypatch.setattr(SessionManager_module, "_supports_two_phase", lambda engine: True)
+    for engine in engines:
+        monkeypatch.setattr(engine.dialect, "do_begin_twophase", lambda connection, xid: None, raising=False)
+        monkeypatch.setattr(engine.dialect, "do_prepare_twophase", lambda connection, xid, engine=engine: prepared.append(engine), raising=False)
+        monkeypatch.setattr(engine.dialect, "do_commit_twophase", lambda connection, xid, is_prepared=True, recover=False: connection.connection.commit(), raising=False)
+        monkeypatch.setattr(engine.dialect, "do_rollback_twophase", lambda connection, xid, is_prepared=True, recover=False: connection.connection.rollback(), raising=False)
+    return managers, engines, prepared
+
+
+def test_two_phase_fan_out_commits_once_every_shard_is_prepared(two_phase):
+    managers, engines, prepared = two_phase
+    
+    results = fan_out(managers, add_user, 1, atomic=True)
+    
+    assert sorted(prepared, key=engines.index) == engines
+    assert all(shard.committed and shard.result == 1 for shard in results)
+    assert [count_users(engine) for engine in engines] == [1, 1]
+
+
+def test_two_phase_fan_out_rolls_back_the_prepared_shards_when_one_fails(two_phase):
+    managers, engines, prepared = two_phase
+    
+    def add_user_or_fail(session):
+        if session.get_bind() is engines[1]:
+            raise ValueError("shard failed")
+        return add_user(1, session=session)
+    
+    results = fan_out(managers, add_user_or_fail, atomic=True)
+    
+    assert prepared == engines[:1]
+    assert results[0].result == 1 and not results[0].committed
+    assert results[1].result is None and isinstance(results[1].error, ValueError)
+    assert [count_users(engine) for engine in engines] == [0, 0]
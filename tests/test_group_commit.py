@@ -0,0 +1,80 @@
+import threading
+
+from conftest import User, count_users
+from SessionManager import Propagation
+
+
+def run_with_timeout(target, timeout: float=10.0):
+    errors: list = []
+    
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "deadlocked"
+    if errors:
+        raise errors[0]
+
+
+def test_concurrent_sessions_share_commits(manager, engine):
+    manager.enable_group_commit(interval=0.01)
+    
+    def write(i):
+        with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+            session.add(User(name=f"user{i}"))
+    
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    
+    assert count_users(engine) == 8
+    stats = manager.group_commit_stats()
+    assert stats["sessions"] == 8
+    assert stats["transactions"] <= 8
+
+
+def test_requires_new_inside_auto_commit_does_not_deadlock(manager, engine):
+    manager.enable_group_commit(interval=0.01)
+    
+    def nested():
+        with manager.session_manager(auto_commit=True, raise_on_error=True) as outer:
+            outer.add(User(name="outer"))
+            with manager.session_manager(auto_commit=True, raise_on_error=True, propagation=Propagation.REQUIRES_NEW) as inner:
+                assert inner is not outer
+                inner.add(User(name="inner"))
+    
+    run_with_timeout(nested)
+    assert count_users(engine) == 2
+
+
+def test_auto_commit_inside_read_write_session_does_not_deadlock(manager, engine):
+    manager.enable_group_commit(interval=0.01)
+    
+    def nested():
+        with manager.session_manager(read_only=False, raise_on_error=True) as outer:
+            with manager.session_manager(auto_commit=True, raise_on_error=True) as inner:
+                assert inner is not outer
+                inner.add(User(name="inner"))
+    
+    run_with_timeout(nested)
+    assert count_users(engine) == 1
+
+
+def test_failed_session_rolls_back_only_its_savepoint(manager, engine):
+    manager.enable_group_commit(interval=0.01)
+    
+    with manager.session_manager(auto_commit=True) as session:
+        session.add(User(name="kept"))
+    with manager.session_manager(auto_commit=True) as session:
+        session.add(User(name="lost"))
+        session.flush()
+        raise ValueError("swallowed")
+    
+    assert count_users(engine) == 1
@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import User
+from SessionManager import HistogramCollector, SessionInstrument
+
+
+class RecordingInstrument(SessionInstrument):
+    def __init__(self):
+        self.phases = []
+        self.counters = []
+    
+    def observe(self, phase, label, seconds):
+        assert seconds >= 0
+        self.phases.append((phase, label))
+    
+    def increment(self, counter, label):
+        self.counters.append((counter, label))
+
+
+@pytest.fixture
+def instrument(manager):
+    instrument = RecordingInstrument()
+    manager.add_instrument(instrument)
+    return instrument
+
+
+def test_committed_session_reports_every_phase(manager, instrument):
+    @manager.session_management(auto_commit=True)
+    def add_user(session):
+        user = User(name="a")
+        session.add(user)
+        # the objects dropped by the caller are not reloaded
+        return user
+    
+    user = add_user()
+    
+    label = add_user.__qualname__
+    assert [phase for phase, _ in instrument.phases] == ["create", "body", "flush", "commit", "reload", "close"]
+    assert {phase_label for _, phase_label in instrument.phases} == {label}
+    assert instrument.counters == [("commits", label)]
+    assert user.name == "a"
+
+
+def test_failed_session_reports_its_rollback_and_error(manager, instrument):
+    with manager.session_manager(auto_commit=True):
+        raise ValueError("swallowed")
+    with pytest.raises(ValueError):
+        with manager.session_manager(auto_commit=True, raise_on_error=True):
+            raise ValueError("raised")
+    
+    assert ("rollback", "session_manager") in instrument.phases
+    assert instrument.counters.count(("rollbacks", "session_manager")) == 2
+    assert instrument.counters.count(("errors_swallowed", "session_manager")) == 1
+    assert instrument.counters.count(("errors_raised", "session_manager")) == 1
+
+
+def test_removed_instrument_receives_nothing(manager, instrument):
+    manager.remove_instrument(instrument)
+    
+    with manager.session_manager(auto_commit=True):
+        pass
+    
+    assert instrument.phases == [] and instrument.counters == []
+
+
+def test_histogram_collector_renders_the_collected_values(manager):
+    collector = HistogramCollector(buckets=(0.5, 0.1))
+    manager.add_instrument(collector)
+    
+    for _ in range(2):
+        with manager.session_manager(auto_commit=True):
+            pass
+    
+    snapshot = collector.collect()
+    assert snapshot["histograms"][("commit", "session_manager")]["count"] == 2
+    assert list(snapshot["histograms"][("commit", "session_manager")]["buckets"]) == [0.1, 0.5, float("inf")]
+    assert snapshot["counters"][("commits", "session_manager")] == 2
+    
+    text = collector.render()
+    assert 'sqlalchemy_session_phase_seconds_count{phase="commit",function="session_manager"} 2' in text
+    assert 'sqlalchemy_session_events_total{event="commits",function="session_manager"} 2' in text
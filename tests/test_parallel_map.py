@@ -0,0 +1,35 @@
+import multiprocessing
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from conftest import Base, User, count_users
+from SessionManager import SessionManager, _managed_engines
+
+
+def pool_size_of_worker(item, session):
+    session.add(User(name=str(item)))
+    return session.get_bind().pool.size()
+
+
+def test_set_session_maker_registers_its_engine(engine):
+    manager = SessionManager()
+    manager.set_session_maker(sessionmaker(bind=engine))
+    
+    assert engine in _managed_engines
+
+
+def test_workers_build_their_engine_with_the_options_of_the_parent(database_url):
+    engine = create_engine(database_url, poolclass=QueuePool, pool_size=3, max_overflow=2)
+    Base.metadata.create_all(engine)
+    manager = SessionManager()
+    manager.set_session_maker(sessionmaker(bind=engine))
+    # a connection of the parent pool is inherited by the forked workers
+    assert count_users(engine) == 0
+    
+    sizes = list(manager.parallel_map(pool_size_of_worker, range(6), chunk_size=2, processes=2, auto_commit=True, mp_context=multiprocessing.get_context("fork")))
+    
+    assert sizes == [3] * 6
+    assert count_users(engine) == 6
+    engine.dispose()
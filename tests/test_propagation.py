@@ -0,0 +1,113 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from conftest import User, count_users
+from SessionManager import AsyncSessionManager, Propagation
+
+
+def test_inner_call_joins_outer_session(manager):
+    sessions: list = []
+    
+    @manager.session_management(auto_commit=True)
+    def inner(session):
+        sessions.append(session)
+    
+    @manager.session_management(auto_commit=True)
+    def outer(session):
+        sessions.append(session)
+        inner()
+    
+    outer()
+    assert sessions[0] is sessions[1]
+
+
+def test_swallowed_error_of_joined_call_keeps_outer_writes(manager, engine):
+    @manager.session_management(auto_commit=True)
+    def inner(session):
+        session.add(User(name="inner"))
+        session.flush()
+        raise ValueError("swallowed by the inner policy")
+    
+    @manager.session_management(auto_commit=True, raise_on_error=True)
+    def outer(session):
+        session.add(User(name="outer"))
+        assert inner() is None
+        return "done"
+    
+    assert outer() == "done"
+    with manager.session_manager() as session:
+        assert session.scalars(select(User.name)).all() == ["outer"]
+
+
+def test_raised_error_of_joined_call_reaches_outer(manager, engine):
+    @manager.session_management(auto_commit=True, raise_error_types=ValueError)
+    def inner(session):
+        session.add(User(name="inner"))
+        raise ValueError("raised by the inner policy")
+    
+    @manager.session_management(auto_commit=True)
+    def outer(session):
+        session.add(User(name="outer"))
+        inner()
+    
+    assert outer() is None
+    assert count_users(engine) == 0
+
+
+def test_auto_commit_block_does_not_join_uncommitted_session(manager, engine):
+    with manager.session_manager() as outer:
+        with manager.session_manager(auto_commit=True) as inner:
+            assert inner is not outer
+            inner.add(User(name="inner"))
+    assert count_users(engine) == 1
+
+
+def test_requires_new_opens_own_session(manager, engine):
+    with manager.session_manager(auto_commit=True) as outer:
+        with manager.session_manager(auto_commit=True, propagation=Propagation.REQUIRES_NEW) as inner:
+            assert inner is not outer
+            inner.add(User(name="inner"))
+        outer.add(User(name="outer"))
+    assert count_users(engine) == 2
+
+
+def test_async_swallowed_error_of_joined_call_keeps_outer_writes(database_url, engine):
+    async def run():
+        async_engine = create_async_engine(database_url.replace("sqlite://", "sqlite+aiosqlite://"))
+        manager = AsyncSessionManager()
+        manager.set_engine(async_engine)
+        
+        @manager.session_management(auto_commit=True)
+        async def inner(session):
+            session.add(User(name="inner"))
+            await session.flush()
+            raise ValueError("swallowed by the inner policy")
+        
+        @manager.session_management(auto_commit=True, raise_on_error=True)
+        async def outer(session):
+            session.add(User(name="outer"))
+            assert await inner() is None
+        
+        await outer()
+        await async_engine.dispose()
+    
+    asyncio.run(run())
+    assert count_users(engine) == 1
+
+
+def test_joined_call_is_rolled_back_with_outer_read_only_transaction(manager, engine):
+    @manager.session_management(auto_commit=True)
+    def inner(session):
+        session.add(User(name="inner"))
+    
+    @manager.session_management(auto_commit=True)
+    def outer(session):
+        # only a SELECT so far, the driver has not begun the transaction yet
+        session.scalars(select(User)).all()
+        inner()
+        raise ValueError("rolls back the joined writes too")
+    
+    assert outer() is None
+    assert count_users(engine) == 0
@@ -0,0 +1,13 @@
+import pytest
+from sqlalchemy import inspect
+
+from conftest import User
+
+
+@pytest.mark.parametrize("reload_after_commit, reloaded", [(None, True), (True, True), (False, False)])
+def test_auto_commit_reloads_unless_disabled(manager, reload_after_commit, reloaded):
+    with manager.session_manager(auto_commit=True, reload_after_commit=reload_after_commit, raise_on_error=True) as session:
+        user = User(name="a")
+        session.add(user)
+    
+    assert inspect(user).expired is not reloaded
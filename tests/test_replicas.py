@@ -0,0 +1,54 @@
+import asyncio
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from conftest import User
+from SessionManager import AsyncSessionManager
+
+DEAD_REPLICA_URL = "sqlite:////nonexistent/directory/replica.db"
+
+
+def test_read_only_session_falls_back_to_primary_when_replica_fails_to_connect(manager, engine):
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.add(User(name="a"))
+    replica = create_engine(DEAD_REPLICA_URL)
+    manager.set_replicas([replica])
+    
+    with manager.session_manager(read_only=True, raise_on_error=True) as session:
+        assert session.scalars(select(User.name)).all() == ["a"]
+        assert session.get_bind() is engine
+    
+    stats = manager.routing_stats()
+    assert stats[DEAD_REPLICA_URL]["failures"] == 1 and not stats[DEAD_REPLICA_URL]["healthy"]
+    assert stats[str(engine.url)]["fallbacks"] == 1
+    assert all(engine_stats["outstanding"] == 0 for engine_stats in stats.values())
+
+
+def test_read_only_session_uses_a_healthy_replica(manager, engine, database_url):
+    replica = create_engine(database_url)
+    manager.set_replicas([replica])
+    
+    with manager.session_manager(read_only=True, raise_on_error=True) as session:
+        assert session.get_bind() is replica
+    
+    assert manager.routing_stats()[str(engine.url)]["fallbacks"] == 0
+    replica.dispose()
+
+
+def test_async_read_only_session_falls_back_to_primary(database_url, engine):
+    async def run():
+        primary = create_async_engine(database_url.replace("sqlite://", "sqlite+aiosqlite://"))
+        replica = create_async_engine(DEAD_REPLICA_URL.replace("sqlite://", "sqlite+aiosqlite://"))
+        manager = AsyncSessionManager()
+        manager.set_engine(primary)
+        manager.set_replicas([replica])
+        
+        async with manager.session_manager(read_only=True, raise_on_error=True) as session:
+            assert (await session.scalars(select(User.name))).all() == []
+            assert session.bind is primary
+        
+        assert manager.routing_stats()[str(primary.url)]["fallbacks"] == 1
+        await primary.dispose()
+    
+    asyncio.run(run())
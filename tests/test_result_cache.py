@@ -0,0 +1,43 @@
+import pytest
+from sqlalchemy import select, update
+
+from conftest import User
+from SessionManager import FileResultCacheBackend, ResultCacheBackend
+
+
+def names(manager):
+    with manager.session_manager(raise_on_error=True) as session:
+        return manager.cached_execute(session, select(User.name).order_by(User.id))
+
+
+@pytest.mark.parametrize("file_backend", [False, True])
+def test_committed_write_invalidates_the_cached_results(manager, tmp_path, file_backend):
+    manager.enable_result_cache(FileResultCacheBackend(str(tmp_path / "cache")) if file_backend else None)
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.add(User(name="a"))
+    
+    assert names(manager) == [("a",)]
+    assert names(manager) == [("a",)]
+    assert manager.result_cache_stats()["hits"] == 1
+    
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.execute(update(User).values(name="b"))
+    
+    assert names(manager) == [("b",)]
+
+
+def test_rolled_back_write_keeps_the_cached_results(manager):
+    manager.enable_result_cache()
+    assert names(manager) == []
+    
+    with manager.session_manager(raise_on_error=True) as session:
+        session.add(User(name="a"))
+        session.flush()
+    
+    assert names(manager) == []
+    assert manager.result_cache_stats()["hits"] == 1
+
+
+def test_backend_must_implement_the_storage():
+    with pytest.raises(TypeError):
+        ResultCacheBackend()
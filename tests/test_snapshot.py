@@ -0,0 +1,52 @@
+import pickle
+
+import pytest
+from sqlalchemy import literal_column, select
+from sqlalchemy.orm import Session
+
+from conftest import Item, User
+from SessionManager import Snapshot, make_snapshot
+
+
+def add_users(engine):
+    with Session(engine) as session:
+        session.add_all([User(id=1, name="a", items=[Item(id=1)]), User(id=2, name="b")])
+        session.commit()
+
+
+def test_rows_of_a_result_share_one_snapshot_class(engine):
+    add_users(engine)
+    with Session(engine) as session:
+        snapshots = make_snapshot(session.execute(select(User.id, User.name).order_by(User.id)))
+    
+    assert [tuple(snapshot) for snapshot in snapshots] == [(1, "a"), (2, "b")]
+    assert type(snapshots[0]) is type(snapshots[1])
+    assert snapshots[1].name == "b" and snapshots[1]._asdict() == {"id": 2, "name": "b"}
+
+
+def test_orm_objects_in_rows_are_converted(engine):
+    add_users(engine)
+    with Session(engine) as session:
+        snapshots = make_snapshot(session.execute(select(User, Item.id.label("item_id")).join(User.items)).all())
+    
+    row = snapshots[0]
+    assert isinstance(row.User, Snapshot) and row.User.name == "a"
+    assert row.item_id == 1
+
+
+def test_fields_that_cannot_be_slots_are_renamed(engine):
+    with Session(engine) as session:
+        row = make_snapshot(session.execute(select(literal_column("1").label("_fields"), literal_column("2").label("x"))).one())
+    
+    assert row._fields == ("_0", "x")
+    assert tuple(row) == (1, 2)
+
+
+def test_snapshots_are_immutable_and_can_be_pickled(engine):
+    add_users(engine)
+    with Session(engine) as session:
+        user = make_snapshot(session.get(User, 1), columns=["id", "name"])
+    
+    assert pickle.loads(pickle.dumps(user)) == user
+    with pytest.raises(AttributeError):
+        user.name = "c"
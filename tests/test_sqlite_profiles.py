@@ -0,0 +1,58 @@
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.exc import OperationalError
+
+from conftest import User, count_users
+from SessionManager import SessionManager, SQLiteProfile
+
+
+@pytest.fixture
+def begins(engine):
+    # the BEGIN statements emitted on the engine
+    statements = []
+    
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith("BEGIN"):
+            statements.append(statement)
+    
+    event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine, "before_cursor_execute", record)
+
+
+def test_profile_is_applied_to_the_connections(manager, engine):
+    manager.set_engine(engine, sqlite_profile="balanced")
+    
+    pragmas = manager.sqlite_pragmas()
+    assert pragmas["journal_mode"] == "wal" and pragmas["synchronous"] == "NORMAL" and pragmas["busy_timeout"] == 5000
+    assert pragmas["begin"] == "IMMEDIATE"
+
+
+def test_read_write_sessions_begin_immediate_and_read_only_ones_deferred(manager, engine, begins):
+    manager.set_engine(engine, sqlite_profile=SQLiteProfile(begin="IMMEDIATE"))
+    
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.add(User(name="a"))
+    with manager.session_manager(read_only=True, raise_on_error=True) as session:
+        session.scalars(select(User)).all()
+    
+    assert begins == ["BEGIN IMMEDIATE", "BEGIN DEFERRED"]
+
+
+def test_read_only_sessions_run_on_the_read_profile(manager, engine):
+    manager.set_engine(engine, sqlite_profile="balanced", sqlite_read_profile="read_only")
+    with manager.session_manager(auto_commit=True, raise_on_error=True) as session:
+        session.add(User(name="a"))
+    
+    assert manager.sqlite_pragmas(read_only=True)["query_only"] == 1
+    with manager.session_manager(read_only=True, raise_on_error=True) as session:
+        assert session.scalars(select(User.name)).all() == ["a"]
+        session.add(User(name="b"))
+        with pytest.raises(OperationalError):
+            session.flush()
+    assert count_users(engine) == 1
+
+
+def test_unknown_profile_is_rejected(engine):
+    with pytest.raises(ValueError):
+        SessionManager().set_engine(engine, sqlite_profile="unknown")